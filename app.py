@@ -1,20 +1,121 @@
 # -*- coding: utf-8 -*-
 import io
 import os
+import re
+import html
 import json
+import zipfile
+import shutil
+import gzip
+import lzma
 import sqlite3
-from datetime import datetime, date, timedelta
+import queue
+import hashlib
+import secrets
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, date, timedelta, timezone
 from dateutil.relativedelta import relativedelta
+from xml.sax.saxutils import escape as xml_escape
+import xml.etree.ElementTree as ET
 
-import bcrypt
 import streamlit as st
-from openpyxl import load_workbook
+from streamlit.errors import StreamlitAPIException
+# bcrypt and openpyxl are imported where they are used: openpyxl alone
+# (with numpy and PIL behind it) adds ~0.4s to every cold start, and the
+# fast Excel renderer does not need it.
+
+import ky_export
+import ky_import
 
 APP_TITLE = "安全指示KY（クラウド・ログイン版）"
 DB_PATH = os.environ.get("KY_DB_PATH", "/tmp/ky_app.sqlite3")
 TEMPLATE_PATH = os.environ.get("KY_TEMPLATE_PATH", "安全指示ＫＹ記録書.xlsx")
 SEED_PATH = os.environ.get("KY_SEED_PATH", "seed.json")
 RETENTION_YEARS = int(os.environ.get("KY_RETENTION_YEARS", "3"))
+# Per-tenant storage: each company's records and name candidates live in
+# tenants/<company_id>.sqlite3 next to KY_DB_PATH; companies, auth and export
+# jobs stay in the central file. Existing data is moved with ky_cli.py shard-split.
+SHARDING = os.environ.get("KY_SHARDING", "0") == "1"
+TENANT_POOL_SIZE = int(os.environ.get("KY_TENANT_POOL_SIZE", "4"))
+DB_POOL_SIZE = int(os.environ.get("KY_DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("KY_DB_BUSY_TIMEOUT_MS", "5000"))
+# Saves from every session go through one writer thread, which commits all
+# that is queued for a DB file as one transaction (group commit). It lingers
+# up to KY_WRITE_GROUP_MS for more to arrive, takes at most KY_WRITE_GROUP_MAX,
+# and holds KY_WRITE_QUEUE_MAX waiting saves (0 = no queue, write directly);
+# a save that finds it full waits KY_WRITE_QUEUE_WAIT_MS, then is refused.
+# A save waits at most KY_WRITE_TIMEOUT_MS for its commit; if the writer has
+# not started it by then it is dropped and refused the same way.
+# KY_WRITE_SYNC=FULL fsyncs each group, so a returned save survives power loss.
+WRITE_GROUP_MS = float(os.environ.get("KY_WRITE_GROUP_MS", "0"))
+WRITE_GROUP_MAX = int(os.environ.get("KY_WRITE_GROUP_MAX", "64"))
+WRITE_QUEUE_MAX = int(os.environ.get("KY_WRITE_QUEUE_MAX", "256"))
+WRITE_QUEUE_WAIT_MS = float(os.environ.get("KY_WRITE_QUEUE_WAIT_MS", "3000"))
+WRITE_TIMEOUT_MS = float(os.environ.get("KY_WRITE_TIMEOUT_MS", "30000"))
+WRITE_SYNC = os.environ.get("KY_WRITE_SYNC", "NORMAL").upper()
+if WRITE_SYNC not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"KY_WRITE_SYNC must be one of OFF, NORMAL, FULL, EXTRA: {WRITE_SYNC!r}")
+RETENTION_INTERVAL_HOURS = float(os.environ.get("KY_RETENTION_INTERVAL_HOURS", "24"))
+RETENTION_BATCH = int(os.environ.get("KY_RETENTION_BATCH", "500"))
+# What retention does with expired records: "delete" them, or "archive" them
+# into compressed monthly JSONL files (archive/ next to the DB) that stay
+# searchable from 自社履歴. Archived records older than KY_ARCHIVE_YEARS
+# (counted from creation; 0 = never) are removed for good.
+RETENTION_MODE = os.environ.get("KY_RETENTION_MODE", "delete")
+ARCHIVE_DIR = os.environ.get("KY_ARCHIVE_DIR", "")
+ARCHIVE_COMPRESSION = os.environ.get("KY_ARCHIVE_COMPRESSION", "gzip")
+ARCHIVE_YEARS = float(os.environ.get("KY_ARCHIVE_YEARS", "0"))
+# Online backups: gzip snapshots of the DB (and tenant files) in backups/
+# next to the DB, taken every KY_BACKUP_INTERVAL_HOURS (0 = only via
+# ky_cli.py backup), newest KY_BACKUP_KEEP kept. The copy runs in steps of
+# KY_BACKUP_PAGES pages with KY_BACKUP_PAUSE_MS between them.
+BACKUP_DIR = os.environ.get("KY_BACKUP_DIR", "")
+BACKUP_INTERVAL_HOURS = float(os.environ.get("KY_BACKUP_INTERVAL_HOURS", "0"))
+BACKUP_KEEP = int(os.environ.get("KY_BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.environ.get("KY_BACKUP_PAGES", "1024"))
+BACKUP_PAUSE_MS = float(os.environ.get("KY_BACKUP_PAUSE_MS", "10"))
+# The session token travels in the URL (?sid=), so it can leak through
+# browser history, bookmarks, shared links and proxy logs: it is replaced on
+# every resume and lives KY_SESSION_HOURS from its last use.
+SESSION_HOURS = float(os.environ.get("KY_SESSION_HOURS", "2"))
+BCRYPT_WORKERS = int(os.environ.get("KY_BCRYPT_WORKERS", "2"))
+CANDIDATE_CACHE_TTL = float(os.environ.get("KY_CANDIDATE_CACHE_TTL", "300"))
+# decoded records kept in memory, and how long the latest version of one is
+# trusted before a cheap updated_at check against the DB
+RECORD_CACHE_SIZE = int(os.environ.get("KY_RECORD_CACHE_SIZE", "2000"))
+RECORD_CACHE_TTL = float(os.environ.get("KY_RECORD_CACHE_TTL", "5"))
+LOGIN_MAX_FAILURES = int(os.environ.get("KY_LOGIN_MAX_FAILURES", "5"))
+LOGIN_WINDOW_MINUTES = float(os.environ.get("KY_LOGIN_WINDOW_MINUTES", "15"))
+LOGIN_LOCKOUT_MINUTES = float(os.environ.get("KY_LOGIN_LOCKOUT_MINUTES", "15"))
+# Failures on a company from all addresses only slow its logins down (up to
+# this many seconds per attempt); a lockout would let anyone shut a crew out.
+LOGIN_DELAY_MAX_SEC = float(os.environ.get("KY_LOGIN_DELAY_MAX_SEC", "8"))
+SLOW_OP_MS = float(os.environ.get("KY_SLOW_MS", "200"))
+METRICS_FILE = os.environ.get("KY_METRICS_FILE", "")
+METRICS_INTERVAL_SEC = float(os.environ.get("KY_METRICS_INTERVAL_SEC", "30"))
+EXPORT_WORKERS = int(os.environ.get("KY_EXPORT_WORKERS", "0"))
+BULK_EXPORT_UI_MAX = int(os.environ.get("KY_BULK_EXPORT_UI_MAX", "500"))
+# rendered .xlsx cache; defaults to xlsx_cache/ next to the DB. 0 MB disables it.
+XLSX_CACHE_DIR = os.environ.get("KY_XLSX_CACHE_DIR", "")
+XLSX_CACHE_MB = float(os.environ.get("KY_XLSX_CACHE_MB", "256"))
+# Background export jobs: worker threads per process, jobs one company may
+# run at once / have waiting, attempts before a job is marked failed, and
+# how long finished files stay downloadable. Files go to exports/ next to the DB.
+EXPORT_JOB_WORKERS = int(os.environ.get("KY_EXPORT_JOB_WORKERS", "2"))
+EXPORT_JOBS_PER_COMPANY = int(os.environ.get("KY_EXPORT_JOBS_PER_COMPANY", "1"))
+EXPORT_QUEUE_PER_COMPANY = int(os.environ.get("KY_EXPORT_QUEUE_PER_COMPANY", "5"))
+EXPORT_JOB_ATTEMPTS = int(os.environ.get("KY_EXPORT_JOB_ATTEMPTS", "3"))
+EXPORT_KEEP_HOURS = float(os.environ.get("KY_EXPORT_KEEP_HOURS", "24"))
+EXPORT_DIR = os.environ.get("KY_EXPORT_DIR", "")
+
+log = logging.getLogger("ky_app")
 
 # ---- Excel cell mapping (based on the provided template) ----
 # Top section (these feed the report section via formulas)
@@ -64,17 +165,338 @@ FINISH_ITEMS = {
     "その他(終了確認)": "E46",
 }
 
-def _connect():
+# Bit i of ky_records.<kind>_mask is the i-th label of the catalog, so the
+# catalogs are append-only: never reorder or remove a label. The その他 bit is
+# set when the matching *_other text is filled in.
+CHECK_CATALOGS = {"hazards": HAZARD_ITEMS, "avoid": AVOID_ITEMS, "finish": FINISH_ITEMS}
+
+def _items_mask(kind: str, selected, other: str | None = None) -> int:
+    mask = 0
+    selected = set(selected or [])
+    for bit, label in enumerate(CHECK_CATALOGS[kind]):
+        if label.startswith("その他") and (other or "").strip():
+            mask |= 1 << bit
+        elif label in selected:
+            mask |= 1 << bit
+    return mask
+
+def _mask_items(kind: str, mask: int) -> list:
+    # その他 is carried by the *_other text, not by the selection list
+    return [label for bit, label in enumerate(CHECK_CATALOGS[kind])
+            if mask >> bit & 1 and not label.startswith("その他")]
+
+def _connect(path: str | None = None):
+    path = path or DB_PATH
     # Ensure the parent directory exists (Render Free: use /tmp by default)
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    con = sqlite3.connect(path, check_same_thread=False,
+                          timeout=DB_BUSY_TIMEOUT_MS / 1000, cached_statements=256)
     con.row_factory = sqlite3.Row
+    # WAL lets readers run alongside the single writer; NORMAL sync is durable
+    # across app crashes in WAL mode and saves an fsync per commit.
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA cache_size=-16000")      # ~16MB page cache per connection
+    con.execute("PRAGMA mmap_size=67108864")     # 64MB memory-mapped reads
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.set_trace_callback(_get_metrics().trace)
     return con
 
-def _init_db():
-    con = _connect()
-    cur = con.cursor()
-    cur.executescript("""
+class _ConnectionPool:
+    """Bounded pool of tuned connections to one SQLite file.
+
+    A thread keeps the connection it checked out for nested ``connection()``
+    calls, so helpers can call each other without taking a second slot.
+    Statement caching is per connection, so reusing connections also reuses
+    the prepared statements of the hot queries.
+    """
+
+    def __init__(self, path: str, size: int, max_idle: int | None = None):
+        self.path = path
+        self.max_idle = size if max_idle is None else max_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "con", None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        if not self._slots.acquire(blocking=False):
+            # every connection is in use: time the wait (pool_wait in the metrics)
+            t0 = time.perf_counter()
+            self._slots.acquire()
+            _get_metrics().observe("pool_wait", time.perf_counter() - t0)
+        try:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                con = _connect(self.path)
+        except Exception:
+            self._slots.release()
+            raise
+        self._local.con, self._local.depth = con, 0
+        try:
+            yield con
+        finally:
+            self._local.con = None
+            if con.in_transaction:
+                # never hand a half-finished transaction to the next borrower
+                con.rollback()
+            if self._idle.qsize() < self.max_idle:
+                self._idle.put(con)
+            else:
+                con.close()
+            self._slots.release()
+
+    def close_idle(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+@st.cache_resource(show_spinner=False)
+def _pool(db_path: str):
+    return _ConnectionPool(db_path, DB_POOL_SIZE)
+
+# Resolved process-wide objects for this script run. A cache_resource lookup
+# costs ~70µs, more than a primary-key read, so hot paths look it up once.
+_resolved = {}
+
+def _central_pool() -> _ConnectionPool:
+    pool = _resolved.get(("pool", DB_PATH))
+    if pool is None:
+        pool = _resolved[("pool", DB_PATH)] = _pool(DB_PATH)
+    return pool
+
+def _db():
+    return _central_pool().connection()
+
+# ---- Tenant storage ----
+_TENANT_NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+# attached tenant files per fan-out query (SQLite allows 10 by default)
+ATTACH_BATCH = 8
+
+def _tenants_dir() -> str:
+    return os.path.join(os.path.dirname(DB_PATH) or ".", "tenants")
+
+def _tenant_name(company_id: str) -> str:
+    # company ids are operator-chosen; anything unusual is hashed into the name
+    if _TENANT_NAME_RE.fullmatch(company_id):
+        return company_id
+    return "h-" + hashlib.sha256(company_id.encode("utf-8")).hexdigest()[:24]
+
+def _tenant_path(company_id: str) -> str:
+    return os.path.join(_tenants_dir(), f"{_tenant_name(company_id)}.sqlite3")
+
+@st.cache_resource(show_spinner=False)
+def _tenant_pool(path: str) -> _ConnectionPool:
+    # Most tenants are idle most of the time: keep one spare connection each.
+    pool = _ConnectionPool(path, TENANT_POOL_SIZE, max_idle=1)
+    with pool.connection() as con:
+        _init_schema(con)
+    return pool
+
+def _tenant_store(company_id: str) -> _ConnectionPool:
+    if not SHARDING:
+        return _central_pool()
+    key = ("tenant", DB_PATH, company_id)
+    pool = _resolved.get(key)
+    if pool is None:
+        pool = _resolved[key] = _tenant_pool(_tenant_path(company_id))
+    return pool
+
+def _tenant_db(company_id: str):
+    """Connection holding ``company_id``'s records and name candidates."""
+    return _tenant_store(company_id).connection()
+
+def _record_stores() -> list:
+    # every file that may hold ky_records: the central DB (all data when not
+    # sharding, leftovers of a split otherwise) and each tenant file
+    stores = [_central_pool()]
+    if SHARDING and os.path.isdir(_tenants_dir()):
+        stores += [_tenant_pool(os.path.join(_tenants_dir(), n))
+                   for n in sorted(os.listdir(_tenants_dir())) if n.endswith(".sqlite3")]
+    return stores
+
+def _fanout(company_ids: list, sql: str) -> list:
+    """Run ``sql`` against each company's tenant file and return all rows.
+
+    ``sql`` reads from ``{db}.table``; the tenant files are ATTACHed to one
+    central connection a batch at a time and queried with UNION ALL.
+    """
+    paths = []
+    for cid in company_ids:
+        path = _tenant_path(cid)
+        if os.path.exists(path) and path not in paths:
+            paths.append(path)
+    rows = []
+    with _db() as con:
+        for i in range(0, len(paths), ATTACH_BATCH):
+            chunk = paths[i:i + ATTACH_BATCH]
+            attached = 0
+            try:
+                for n, path in enumerate(chunk):
+                    con.execute(f"ATTACH DATABASE ? AS t{n}", (path,))
+                    attached += 1
+                union = " UNION ALL ".join(sql.format(db=f"t{n}") for n in range(len(chunk)))
+                rows += [dict(r) for r in con.execute(union)]
+            finally:
+                for n in range(attached):
+                    con.execute(f"DETACH DATABASE t{n}")
+    return rows
+
+# ---- In-process metrics ----
+# 'text' and X'blob' literals in traced SQL
+_SQL_LITERAL = re.compile(r"[xX]?'(?:[^']|'')*'")
+
+class _Metrics:
+    """Rolling latency samples per operation plus a log of slow operations.
+
+    SQL is captured through each connection's trace callback while an
+    instrumented operation is running on that thread, so a slow entry lists
+    the statements it executed. The callback sees them with their values
+    bound; string and blob literals (record text, password and token hashes)
+    are masked before they are kept.
+
+    Time spent in ``excluded`` blocks (bcrypt, which is slow by design) is
+    recorded as its own op and does not count towards an operation's slow
+    threshold, so logins do not crowd real slow queries out of the log.
+    """
+
+    def __init__(self, window: int = 2048, slow_keep: int = 50):
+        self._lock = threading.Lock()
+        self._window = window
+        self._ops = {}  # op -> [count, total seconds, deque of recent seconds]
+        self.slow = deque(maxlen=slow_keep)  # dicts: at, op, ms, sql
+        self._local = threading.local()
+
+    @contextmanager
+    def timed(self, op: str):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append([[], 0.0])  # statements, seconds excluded
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            statements, excluded = stack.pop()
+            self.observe(op, elapsed, statements, slow_seconds=elapsed - excluded)
+
+    @contextmanager
+    def excluded(self, op: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.observe(op, elapsed, slow_seconds=0.0)
+            for frame in getattr(self._local, "stack", None) or ():
+                frame[1] += elapsed
+
+    def trace(self, sql: str):
+        stack = getattr(self._local, "stack", None)
+        # "-- TRIGGER x" lines are trigger bodies, already implied by their statement
+        if stack and len(stack[-1][0]) < 50 and not sql.startswith("--"):
+            stack[-1][0].append(_SQL_LITERAL.sub("'…'", sql))
+
+    def observe(self, op: str, seconds: float, statements=(), slow_seconds: float | None = None):
+        with self._lock:
+            entry = self._ops.get(op)
+            if entry is None:
+                entry = self._ops[op] = [0, 0.0, deque(maxlen=self._window)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2].append(seconds)
+            if (seconds if slow_seconds is None else slow_seconds) * 1000 >= SLOW_OP_MS:
+                self.slow.appendleft({"at": datetime.utcnow().isoformat(timespec="seconds"), "op": op,
+                                      "ms": seconds * 1000, "sql": list(statements)})
+
+    def snapshot(self) -> list:
+        with self._lock:
+            items = [(op, e[0], e[1], sorted(e[2])) for op, e in self._ops.items()]
+        out = []
+        for op, count, total, samples in sorted(items):
+            q = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+            out.append({"op": op, "count": count, "mean_ms": total / count * 1000,
+                        "p50_ms": q(0.50), "p95_ms": q(0.95), "p99_ms": q(0.99), "max_ms": samples[-1] * 1000})
+        return out
+
+    def prometheus(self) -> str:
+        lines = ["# HELP ky_op_duration_seconds Latency of app operations (recent window quantiles).",
+                 "# TYPE ky_op_duration_seconds summary"]
+        for r in self.snapshot():
+            label = f'op="{r["op"]}"'
+            for q, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lines.append(f'ky_op_duration_seconds{{{label},quantile="{q}"}} {r[key] / 1000:.6f}')
+            lines.append(f"ky_op_duration_seconds_sum{{{label}}} {r['mean_ms'] * r['count'] / 1000:.6f}")
+            lines.append(f"ky_op_duration_seconds_count{{{label}}} {r['count']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def _metrics():
+    return _Metrics()
+
+def _get_metrics() -> _Metrics:
+    m = _resolved.get("metrics")
+    if m is None:
+        m = _resolved["metrics"] = _metrics()
+    return m
+
+def _instrumented(fn):
+    op = fn.__name__.lstrip("_")
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _get_metrics().timed(op):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def _write_metrics_file(path: str):
+    # write-then-rename so a textfile collector never reads a partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(_get_metrics().prometheus())
+    os.replace(tmp, path)
+
+def _metrics_file_loop(path: str):
+    while True:
+        time.sleep(METRICS_INTERVAL_SEC)
+        try:
+            _write_metrics_file(path)
+        except OSError:
+            log.exception("writing %s failed", path)
+
+@st.cache_resource(show_spinner=False)
+def _start_metrics_exporter(path: str):
+    t = threading.Thread(target=_metrics_file_loop, args=(path,), name="ky-metrics", daemon=True)
+    t.start()
+    return t
+
+def _explain_sql(sql: str) -> list:
+    # Plan of a captured statement; only for SELECT/UPDATE/DELETE/INSERT text.
+    if not re.match(r"\s*(SELECT|UPDATE|DELETE|INSERT|WITH)\b", sql, re.I):
+        return []
+    try:
+        with _db() as con:
+            return [r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+    except sqlite3.Error as e:
+        return [f"(plan unavailable: {e})"]
+
+def _migration_1(con):
+    # Initial schema. IF NOT EXISTS keeps it safe on DBs created before versioning.
+    con.execute("""
     CREATE TABLE IF NOT EXISTS companies (
       company_id TEXT PRIMARY KEY,
       company_name TEXT NOT NULL,
@@ -82,15 +504,15 @@ def _init_db():
       is_admin INTEGER NOT NULL DEFAULT 0,
       is_enabled INTEGER NOT NULL DEFAULT 1,
       created_at TEXT NOT NULL
-    );
-
+    )""")
+    con.execute("""
     CREATE TABLE IF NOT EXISTS name_candidates (
       company_id TEXT NOT NULL,
       name TEXT NOT NULL,
       PRIMARY KEY (company_id, name),
       FOREIGN KEY (company_id) REFERENCES companies(company_id)
-    );
-
+    )""")
+    con.execute("""
     CREATE TABLE IF NOT EXISTS ky_records (
       id TEXT PRIMARY KEY,
       company_id TEXT NOT NULL,
@@ -115,196 +537,2042 @@ def _init_db():
       finish_other TEXT,
       notes TEXT,
       FOREIGN KEY (company_id) REFERENCES companies(company_id)
-    );
-    """)
-    con.commit()
-    con.close()
+    )""")
+
+def _migration_2(con):
+    # History listing (company_id + newest first) and retention (created_at range)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_ky_records_company_created ON ky_records(company_id, created_at DESC)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_ky_records_created ON ky_records(created_at)")
+
+def _migration_3(con):
+    # Small key/value table for process-independent bookkeeping (job last-run times etc.)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS app_meta (
+      key TEXT PRIMARY KEY,
+      value TEXT
+    )""")
+
+FTS_COLUMNS = ("work_title", "location", "work_content", "inputter_name", "notes")
+
+def _migration_4(con):
+    # Keyset pagination on (created_at, id) needs id in the index; it also
+    # serves every query the old (company_id, created_at) index did.
+    con.execute("CREATE INDEX IF NOT EXISTS idx_ky_records_company_created_id ON ky_records(company_id, created_at DESC, id DESC)")
+    con.execute("DROP INDEX IF EXISTS idx_ky_records_company_created")
+
+    # Full-text index over the history fields. External content (no second
+    # copy of the text), kept in sync by triggers. The trigram tokenizer gives
+    # substring matching, which suits Japanese text without word breaks.
+    # It is keyed on ky_records' implicit rowid, which a VACUUM may renumber:
+    # `ky_cli.py vacuum` rebuilds it afterwards; after any other VACUUM run
+    # `ky_cli.py search-index`, or 自社履歴 search returns the wrong rows.
+    cols = ", ".join(FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    con.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS ky_records_fts USING fts5(
+      {cols}, content='ky_records', content_rowid='rowid', tokenize='trigram'
+    )""")
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_records_fts_ai AFTER INSERT ON ky_records BEGIN
+      INSERT INTO ky_records_fts(rowid, {cols}) VALUES (new.rowid, {new_cols});
+    END""")
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_records_fts_ad AFTER DELETE ON ky_records BEGIN
+      INSERT INTO ky_records_fts(ky_records_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+    END""")
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_records_fts_au AFTER UPDATE OF {cols} ON ky_records BEGIN
+      INSERT INTO ky_records_fts(ky_records_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+      INSERT INTO ky_records_fts(rowid, {cols}) VALUES (new.rowid, {new_cols});
+    END""")
+    con.execute("INSERT INTO ky_records_fts(ky_records_fts) VALUES ('rebuild')")
+
+def _sync_check_items(con):
+    # Mirror the catalogs into SQL for the rollup triggers (append-only, see CHECK_CATALOGS)
+    con.executemany(
+        "INSERT OR IGNORE INTO check_items(kind, bit, label) VALUES (?,?,?)",
+        [(kind, bit, label) for kind, catalog in CHECK_CATALOGS.items() for bit, label in enumerate(catalog)],
+    )
+
+def _rollup_sql(sign: str, ref: str) -> list:
+    # Statements adding (sign '+') or removing ('-') one record, referenced as
+    # new/old inside a trigger, to/from the monthly rollup.
+    key = f"{ref}.company_id, substr({ref}.created_at, 1, 7), COALESCE({ref}.location, '')"
+    return [
+        f"""INSERT INTO ky_item_monthly(company_id, month, location, kind, label, n)
+        VALUES ({key}, 'records', '', {sign}1)
+        ON CONFLICT(company_id, kind, month, label, location) DO UPDATE SET n = n {sign} 1;""",
+        f"""INSERT INTO ky_item_monthly(company_id, month, location, kind, label, n)
+        SELECT {key}, kind, label, {sign}1 FROM check_items
+        WHERE (kind='hazards' AND {ref}.hazards_mask >> bit & 1)
+           OR (kind='avoid' AND {ref}.avoid_mask >> bit & 1)
+           OR (kind='finish' AND {ref}.finish_mask >> bit & 1)
+        ON CONFLICT(company_id, kind, month, label, location) DO UPDATE SET n = n {sign} 1;""",
+    ]
+
+def _migration_5(con):
+    # Check items move from JSON text to one bitmask column per kind, and a
+    # per (company, month, location) rollup is kept up to date by triggers.
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS check_items (
+      kind TEXT NOT NULL,
+      bit INTEGER NOT NULL,
+      label TEXT NOT NULL,
+      PRIMARY KEY (kind, bit)
+    )""")
+    _sync_check_items(con)
+
+    for kind in CHECK_CATALOGS:
+        con.execute(f"ALTER TABLE ky_records ADD COLUMN {kind}_mask INTEGER NOT NULL DEFAULT 0")
+    cur = con.execute("""SELECT rowid, hazards_json, hazards_other, avoid_json, avoid_other, finish_json, finish_other
+                         FROM ky_records""")
+    while True:
+        rows = cur.fetchmany(1000)
+        if not rows:
+            break
+        con.executemany(
+            "UPDATE ky_records SET hazards_mask=?, avoid_mask=?, finish_mask=? WHERE rowid=?",
+            [tuple(_items_mask(kind, json.loads(r[f"{kind}_json"] or "[]"), r[f"{kind}_other"]) for kind in CHECK_CATALOGS)
+             + (r["rowid"],) for r in rows],
+        )
+    for kind in CHECK_CATALOGS:
+        con.execute(f"ALTER TABLE ky_records DROP COLUMN {kind}_json")
 
-def _seed_if_needed():
-    if not os.path.exists(SEED_PATH):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS ky_item_monthly (
+      company_id TEXT NOT NULL,
+      month TEXT NOT NULL,
+      location TEXT NOT NULL,
+      kind TEXT NOT NULL,
+      label TEXT NOT NULL,
+      n INTEGER NOT NULL,
+      PRIMARY KEY (company_id, kind, month, label, location)
+    ) WITHOUT ROWID""")
+    con.execute("""
+    INSERT INTO ky_item_monthly(company_id, month, location, kind, label, n)
+    SELECT company_id, substr(created_at, 1, 7), COALESCE(location, ''), 'records', '', COUNT(*)
+    FROM ky_records GROUP BY 1, 2, 3""")
+    con.execute("""
+    INSERT INTO ky_item_monthly(company_id, month, location, kind, label, n)
+    SELECT r.company_id, substr(r.created_at, 1, 7), COALESCE(r.location, ''), c.kind, c.label, COUNT(*)
+    FROM ky_records r JOIN check_items c
+      ON (c.kind='hazards' AND r.hazards_mask >> c.bit & 1)
+      OR (c.kind='avoid' AND r.avoid_mask >> c.bit & 1)
+      OR (c.kind='finish' AND r.finish_mask >> c.bit & 1)
+    GROUP BY 1, 2, 3, 4, 5""")
+
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_item_monthly_ai AFTER INSERT ON ky_records BEGIN
+      {" ".join(_rollup_sql("+", "new"))}
+    END""")
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_item_monthly_ad AFTER DELETE ON ky_records BEGIN
+      {" ".join(_rollup_sql("-", "old"))}
+    END""")
+    con.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ky_item_monthly_au
+    AFTER UPDATE OF company_id, created_at, location, hazards_mask, avoid_mask, finish_mask ON ky_records BEGIN
+      {" ".join(_rollup_sql("-", "old") + _rollup_sql("+", "new"))}
+    END""")
+
+def _migration_6(con):
+    # Persistent login sessions (only a SHA-256 of the token is stored) and
+    # failed-login counters keyed by "company:<id>" / "ip:<addr>".
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+      token_hash BLOB PRIMARY KEY,
+      company_id TEXT NOT NULL,
+      created_at TEXT NOT NULL,
+      expires_at TEXT NOT NULL,
+      FOREIGN KEY (company_id) REFERENCES companies(company_id)
+    ) WITHOUT ROWID""")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sessions_company ON sessions(company_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS login_failures (
+      key TEXT PRIMARY KEY,
+      failures INTEGER NOT NULL,
+      first_at TEXT NOT NULL,
+      locked_until TEXT
+    ) WITHOUT ROWID""")
+
+def _migration_7(con):
+    # Usage counts for ranking the 入力者名 candidates
+    con.execute("ALTER TABLE name_candidates ADD COLUMN use_count INTEGER NOT NULL DEFAULT 0")
+    con.execute("ALTER TABLE name_candidates ADD COLUMN last_used_at TEXT")
+    con.execute("""
+    UPDATE name_candidates SET use_count = (
+      SELECT COUNT(*) FROM ky_records r
+      WHERE r.company_id = name_candidates.company_id AND r.inputter_name = name_candidates.name
+    )""")
+
+def _migration_8(con):
+    # Background export jobs; single .xlsx and bulk ZIP exports share the queue
+    con.execute("""
+    CREATE TABLE export_jobs (
+      id TEXT PRIMARY KEY,
+      company_id TEXT NOT NULL,
+      kind TEXT NOT NULL,               -- 'single' | 'bulk'
+      params TEXT NOT NULL,             -- JSON
+      status TEXT NOT NULL,             -- queued | running | done | failed
+      attempts INTEGER NOT NULL DEFAULT 0,
+      not_before TEXT NOT NULL,         -- retry backoff
+      created_at TEXT NOT NULL,
+      started_at TEXT,
+      finished_at TEXT,
+      progress INTEGER NOT NULL DEFAULT 0,
+      total INTEGER,
+      error TEXT,
+      result_name TEXT,
+      result_size INTEGER,
+      FOREIGN KEY (company_id) REFERENCES companies(company_id)
+    )""")
+    con.execute("CREATE INDEX idx_export_jobs_company_created ON export_jobs(company_id, created_at DESC)")
+    con.execute("CREATE INDEX idx_export_jobs_status_created ON export_jobs(status, created_at)")
+
+def _record_size_sql(ref: str) -> str:
+    # Stored text of one record in bytes plus 8 per mask: an estimate of
+    # its data size, not the on-disk page usage.
+    columns = ("id", "company_id", "created_at", "updated_at", "inputter_name", "work_title", "work_company",
+               "phone", "work_date", "start_time", "end_time", "location", "people_count", "work_content",
+               "hazards_other", "avoid_other", "focus_instructions", "finish_other", "notes")
+    return " + ".join(f"COALESCE(length(CAST({ref}.{c} AS BLOB)), 0)" for c in columns) + " + 24"
+
+def _usage_sql(sign: str, ref: str) -> str:
+    # Add ('+') or remove ('-') one record, referenced as new/old inside a
+    # trigger, to/from its company's usage row.
+    if sign == "+":
+        return f"""INSERT INTO company_usage(company_id, records, bytes, last_write_at)
+        VALUES ({ref}.company_id, 1, {_record_size_sql(ref)}, {ref}.updated_at)
+        ON CONFLICT(company_id) DO UPDATE SET records = records + 1, bytes = bytes + excluded.bytes,
+          last_write_at = max(COALESCE(last_write_at, ''), excluded.last_write_at);"""
+    return f"""UPDATE company_usage SET records = records - 1, bytes = bytes - ({_record_size_sql(ref)})
+        WHERE company_id = {ref}.company_id;"""
+
+def _migration_9(con):
+    # Per-company record count, data size and last write for the admin
+    # console, kept by triggers so listing hundreds of companies reads one row each.
+    con.execute("""
+    CREATE TABLE company_usage (
+      company_id TEXT PRIMARY KEY,
+      records INTEGER NOT NULL,
+      bytes INTEGER NOT NULL,
+      last_write_at TEXT
+    ) WITHOUT ROWID""")
+    con.execute(f"""
+    INSERT INTO company_usage(company_id, records, bytes, last_write_at)
+    SELECT company_id, COUNT(*), SUM({_record_size_sql("r")}), MAX(updated_at)
+    FROM ky_records r GROUP BY company_id""")
+    con.execute(f"CREATE TRIGGER company_usage_ai AFTER INSERT ON ky_records BEGIN {_usage_sql('+', 'new')} END")
+    con.execute(f"CREATE TRIGGER company_usage_ad AFTER DELETE ON ky_records BEGIN {_usage_sql('-', 'old')} END")
+    con.execute(f"CREATE TRIGGER company_usage_au AFTER UPDATE ON ky_records BEGIN "
+                f"{_usage_sql('-', 'old')} {_usage_sql('+', 'new')} END")
+    # admin console: non-admin companies by name
+    con.execute("CREATE INDEX idx_companies_admin_name ON companies(is_admin, company_name, company_id)")
+
+def _migration_10(con):
+    # 集計's location picker: the locations with records, in order, read from
+    # the small per-month 'records' rows of the rollup.
+    con.execute("CREATE INDEX idx_item_monthly_locations ON ky_item_monthly(company_id, location, n) "
+                "WHERE kind='records'")
+
+def _migration_11(con):
+    # Export jobs report liveness: a running job's worker refreshes
+    # heartbeat_at with every progress update, and only a job that stopped
+    # reporting is taken back from it.
+    con.execute("ALTER TABLE export_jobs ADD COLUMN heartbeat_at TEXT")
+    con.execute("UPDATE export_jobs SET heartbeat_at = started_at WHERE status='running'")
+
+# Numbered schema steps. Append new steps here; never edit a shipped one.
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+    (9, _migration_9),
+    (10, _migration_10),
+    (11, _migration_11),
+]
+
+def _schema_version(con) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def _migrate(con):
+    # Each step runs in its own IMMEDIATE transaction so that concurrent
+    # processes serialize on the write lock and re-check the version inside it.
+    if _schema_version(con) >= MIGRATIONS[-1][0]:
         return
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("SELECT COUNT(*) AS n FROM companies")
-    if cur.fetchone()["n"] > 0:
-        con.close()
+    for version, step in MIGRATIONS:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if _schema_version(con) >= version:
+                con.rollback()
+                continue
+            step(con)
+            con.execute(f"PRAGMA user_version = {int(version)}")
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+def _check_incremental_vacuum(con):
+    # Retention frees pages with incremental_vacuum, which needs
+    # auto_vacuum=INCREMENTAL. A new file is switched before its first table;
+    # an existing one needs a full VACUUM, which holds the write lock for
+    # minutes on a big file, so that is left to `ky_cli.py vacuum`.
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
         return
+    if con.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        return
+    log.warning("%s: auto_vacuum is not INCREMENTAL, so deleted records do not return space to the disk; "
+                "run `python ky_cli.py vacuum` with the app stopped", con.execute("PRAGMA database_list").fetchone()[2])
+
+def _vacuum(con):
+    """Rewrite the file with a full VACUUM, switching it to
+    auto_vacuum=INCREMENTAL. Holds the write lock until done: for
+    ``ky_cli.py vacuum`` with the app stopped."""
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("VACUUM")
+    # VACUUM may renumber rowids of tables without an INTEGER PRIMARY KEY,
+    # which the FTS index is keyed on.
+    _rebuild_search_index(con)
+
+def _search_index_ok(con) -> bool:
+    """Whether the FTS index still matches ky_records row for row (reads
+    the whole index: for ky_cli.py, not the request path)."""
+    try:
+        con.execute("INSERT INTO ky_records_fts(ky_records_fts, rank) VALUES ('integrity-check', 1)")
+    except sqlite3.DatabaseError:
+        return False
+    return True
+
+def _rebuild_search_index(con):
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name='ky_records_fts'").fetchone():
+        with con:
+            con.execute("INSERT INTO ky_records_fts(ky_records_fts) VALUES ('rebuild')")
+
+def _init_schema(con):
+    # Tenant files get the same schema as the central one; each only uses its part.
+    _check_incremental_vacuum(con)
+    _migrate(con)
+    with con:
+        _sync_check_items(con)
 
+def _init_db():
+    with _db() as con:
+        _init_schema(con)
+
+def _seed_if_needed():
+    if not os.path.exists(SEED_PATH):
+        return
+    with _db() as con:
+        # IMMEDIATE so two processes starting together cannot both seed
+        con.execute("BEGIN IMMEDIATE")
+        if con.execute("SELECT COUNT(*) AS n FROM companies").fetchone()["n"] > 0:
+            con.rollback()
+            return
+        candidates = _seed_from_file(con)
+        con.commit()
+    # name candidates live with the company's records
+    for cid, names in candidates.items():
+        with _tenant_db(cid) as con, con:
+            con.executemany("INSERT OR IGNORE INTO name_candidates(company_id, name) VALUES (?,?)",
+                            [(cid, nm) for nm in names])
+
+def _seed_from_file(con):
     with open(SEED_PATH, "r", encoding="utf-8") as f:
         seed = json.load(f)
 
     now = datetime.utcnow().isoformat()
     # credentials from seed.json (plaintext) are hashed here and never stored as plaintext in DB
     cred_map = {c["company_id"]: c["password"] for c in seed.get("initial_credentials", [])}
-
-    for c in seed["companies"]:
+    # A fresh DB (e.g. /tmp after a cold start) is seeded on the first page
+    # view; hash all passwords at once on the shared bcrypt pool, so
+    # KY_BCRYPT_WORKERS caps it like logins. Nobody can log in before the
+    # seed exists, so the queue bound of _bcrypt_call is not needed here.
+    passwords = [cred_map.get(c["company_id"], "ChangeMe123!") for c in seed["companies"]]
+    pool, _ = _bcrypt_pool()
+    with _get_metrics().excluded("bcrypt"):
+        hashes = list(pool.map(_hashpw, passwords))
+
+    for c, pw_hash in zip(seed["companies"], hashes):
         cid = c["company_id"]
         cname = c["company_name"]
         is_admin = 1 if c.get("is_admin") else 0
-        pw = cred_map.get(cid, "ChangeMe123!")
-        pw_hash = bcrypt.hashpw(pw.encode("utf-8"), bcrypt.gensalt())
-        cur.execute(
+        con.execute(
             "INSERT INTO companies(company_id, company_name, password_hash, is_admin, is_enabled, created_at) VALUES (?,?,?,?,?,?)",
             (cid, cname, pw_hash, is_admin, 1, now),
         )
 
-    for cid, names in seed.get("name_candidates", {}).items():
-        for nm in names:
-            cur.execute("INSERT INTO name_candidates(company_id, name) VALUES (?,?)", (cid, nm))
-
-    con.commit()
-    con.close()
-
-def _apply_retention():
-    # Delete records older than RETENTION_YEARS
-    cutoff = datetime.utcnow() - relativedelta(years=RETENTION_YEARS)
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("DELETE FROM ky_records WHERE created_at < ?", (cutoff.isoformat(),))
-    con.commit()
-    con.close()
-
-def _verify_login(company_id: str, password: str):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM companies WHERE company_id=?", (company_id,))
-    row = cur.fetchone()
-    con.close()
+    return seed.get("name_candidates", {})
+
+# ---- Hot queries (shared with the query-plan check below) ----
+SQL_GET_COMPANY = "SELECT * FROM companies WHERE company_id=?"
+SQL_GET_SESSION = """
+SELECT c.* FROM sessions s JOIN companies c ON c.company_id = s.company_id
+WHERE s.token_hash=? AND s.expires_at > ? AND c.is_enabled=1
+"""
+SQL_LIST_CANDIDATES = "SELECT name, use_count FROM name_candidates WHERE company_id=?"
+SQL_GET_RECORD = "SELECT * FROM ky_records WHERE company_id=? AND id=?"
+SQL_RECORD_VERSION = "SELECT updated_at FROM ky_records WHERE company_id=? AND id=?"
+SQL_EXPORT_PAGE = """
+SELECT * FROM ky_records
+WHERE {where}{after}
+ORDER BY created_at DESC, id DESC
+LIMIT ?
+"""
+# keyset cursor shared by export and history paging: rows strictly after (created_at, id)
+SQL_AFTER_CURSOR = " AND (created_at, id) < (?, ?)"
+SQL_SEARCH_PAGE = """
+SELECT id, created_at, updated_at, inputter_name, work_title, work_date, location
+FROM ky_records
+WHERE {where}{after}
+ORDER BY created_at DESC, id DESC
+LIMIT ?
+"""
+SQL_ITEM_TREND = """
+SELECT month, label, SUM(n) AS n FROM ky_item_monthly
+WHERE company_id=? AND month >= ? AND month <= ? AND kind=?{location}
+GROUP BY month, label
+HAVING SUM(n) > 0
+ORDER BY month, label
+"""
+SQL_FTS_FILTER = "rowid IN (SELECT rowid FROM ky_records_fts WHERE ky_records_fts MATCH ?)"
+SQL_SELECT_EXPIRED = "SELECT * FROM ky_records WHERE created_at < ? ORDER BY created_at LIMIT ?"
+SQL_DELETE_EXPIRED = """
+DELETE FROM ky_records WHERE rowid IN (
+  SELECT rowid FROM ky_records WHERE created_at < ? ORDER BY created_at LIMIT ?
+) RETURNING id"""
+# Oldest runnable job whose company is under its running limit. One
+# statement, so two workers (or processes) can never claim the same job.
+SQL_CLAIM_EXPORT_JOB = """
+UPDATE export_jobs SET status='running', attempts=attempts+1, started_at=?, heartbeat_at=?, error=NULL, progress=0
+WHERE id = (
+  SELECT j.id FROM export_jobs j
+  WHERE j.status='queued' AND j.not_before <= ?
+    AND (SELECT COUNT(*) FROM export_jobs r WHERE r.status='running' AND r.company_id=j.company_id) < ?
+  ORDER BY j.created_at LIMIT 1
+) RETURNING *"""
+SQL_RECENT_EXPORT_JOBS = """
+SELECT id, kind, params, status, attempts, created_at, finished_at, progress, total, error, result_name, result_size
+FROM export_jobs WHERE company_id=? ORDER BY created_at DESC LIMIT ?
+"""
+SQL_ROLLUP_LOCATIONS = """
+SELECT DISTINCT location FROM ky_item_monthly
+WHERE company_id=? AND kind='records' AND n > 0
+ORDER BY location
+"""
+SQL_ADMIN_COMPANIES = """
+SELECT c.company_id, c.company_name, c.is_enabled, c.created_at,
+       COALESCE(u.records, 0) AS records, COALESCE(u.bytes, 0) AS bytes, u.last_write_at
+FROM companies c LEFT JOIN company_usage u ON u.company_id = c.company_id
+WHERE c.is_admin=0{where}
+ORDER BY c.company_name, c.company_id
+LIMIT ? OFFSET ?
+"""
+SQL_TENANT_USAGE = "SELECT company_id, records, bytes, last_write_at FROM {db}.company_usage"
+
+# name -> (sql, sample params). Every query here must be served by an index.
+HOT_QUERIES = {
+    "verify_login": (SQL_GET_COMPANY, ("x",)),
+    "resume_session": (SQL_GET_SESSION, (b"x", "2026-01-01")),
+    "list_candidates": (SQL_LIST_CANDIDATES, ("x",)),
+    "get_record": (SQL_GET_RECORD, ("x", "x")),
+    "record_version": (SQL_RECORD_VERSION, ("x", "x")),
+    "export_page": (SQL_EXPORT_PAGE.format(where="company_id=? AND created_at >= ? AND created_at < ?", after=SQL_AFTER_CURSOR),
+                    ("x", "2026-01-01", "2026-02-01", "2026-01-15", "x", 200)),
+    "history_page": (SQL_SEARCH_PAGE.format(where="company_id=?", after=SQL_AFTER_CURSOR), ("x", "2026-01-15", "x", 31)),
+    "history_search": (SQL_SEARCH_PAGE.format(where="company_id=? AND created_at >= ? AND " + SQL_FTS_FILTER, after=SQL_AFTER_CURSOR),
+                       ("x", "2026-01-01", '"本館B1"', "2026-01-15", "x", 31)),
+    "rollup_locations": (SQL_ROLLUP_LOCATIONS, ("x",)),
+    "item_trend": (SQL_ITEM_TREND.format(location=" AND location=?"), ("x", "2026-01", "2026-12", "hazards", "本館")),
+    "retention_delete": (SQL_DELETE_EXPIRED, ("2000-01-01", 500)),
+    "archive_expired": (SQL_SELECT_EXPIRED, ("2000-01-01", 500)),
+    "claim_export_job": (SQL_CLAIM_EXPORT_JOB, ("2026-01-01", "2026-01-01", "2026-01-01", 1)),
+    "recent_export_jobs": (SQL_RECENT_EXPORT_JOBS, ("x", 10)),
+    "admin_companies": (SQL_ADMIN_COMPANIES.format(where=" AND c.is_enabled=?"), (1, 50, 0)),
+}
+
+def _explain_hot_queries(con) -> list[tuple[str, str]]:
+    """Return (query name, plan detail) for every hot query that scans a table
+    or sorts with a temp b-tree. An empty list means all plans use indexes."""
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+            detail = row[3]
+            # FTS lookups show up as "SCAN <fts> VIRTUAL TABLE INDEX n:M..."
+            full_scan = detail.startswith("SCAN ") and " USING " not in detail and "VIRTUAL TABLE INDEX" not in detail
+            if full_scan or "USE TEMP B-TREE" in detail:
+                problems.append((name, detail))
+    return problems
+
+@_instrumented
+def _apply_retention(batch_size: int = RETENTION_BATCH, pause: float = 0.05) -> int:
+    # Delete records older than RETENTION_YEARS in small transactions, so the
+    # write lock is only ever held for one chunk and saves can interleave.
+    # With sharding each tenant file is done in turn, holding only its own lock.
+    cutoff = (datetime.utcnow() - relativedelta(years=RETENTION_YEARS)).isoformat()
+    deleted = 0
+    for store in _record_stores():
+        n = _apply_retention_to(store, cutoff, batch_size, pause)
+        if n:
+            _incremental_vacuum(batch_size, pause, store)
+        if store is not _central_pool():
+            store.close_idle()
+        deleted += n
+    if RETENTION_MODE == "archive":
+        _purge_archive()
+    return deleted
+
+def _apply_retention_to(store: _ConnectionPool, cutoff: str, batch_size: int, pause: float) -> int:
+    deleted = 0
+    while True:
+        if RETENTION_MODE == "archive":
+            selected, ids = _archive_expired(store, cutoff, batch_size)
+        else:
+            with store.connection() as con, con:
+                ids = [r[0] for r in con.execute(SQL_DELETE_EXPIRED, (cutoff, batch_size)).fetchall()]
+            selected = len(ids)
+        _discard_xlsx(ids)
+        _discard_records(ids)
+        deleted += len(ids)
+        if selected < batch_size:
+            return deleted
+        time.sleep(pause)
+
+# ---- Cold archive (KY_RETENTION_MODE=archive) ----
+# Expired records are appended to archive/<company>/<YYYY-MM>.jsonl.gz (or
+# .xz), one compressed member per retention batch; gzip and xz readers both
+# read concatenated members as one stream. index.sqlite3 lists the files by
+# company and month (one row per file, so it stays tiny). Its record count
+# is the number of lines appended: rows archived again after a crash count
+# twice, so it is an upper bound, not the number of distinct records.
+ARCHIVE_SUFFIX = {"gzip": ".jsonl.gz", "lzma": ".jsonl.xz"}
+if ARCHIVE_COMPRESSION not in ARCHIVE_SUFFIX:
+    raise ValueError(f"KY_ARCHIVE_COMPRESSION must be one of {', '.join(ARCHIVE_SUFFIX)}: {ARCHIVE_COMPRESSION!r}")
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_parts (
+  part TEXT PRIMARY KEY,
+  company_id TEXT NOT NULL,
+  month TEXT NOT NULL,
+  records INTEGER NOT NULL DEFAULT 0,
+  bytes INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_archive_parts_company ON archive_parts(company_id, month);
+CREATE INDEX IF NOT EXISTS idx_archive_parts_month ON archive_parts(month);
+"""
+
+def _archive_dir() -> str:
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(DB_PATH) or ".", "archive")
+
+@st.cache_resource(show_spinner=False)
+def _archive_pool(path: str) -> _ConnectionPool:
+    pool = _ConnectionPool(path, 2)
+    with pool.connection() as con:
+        con.executescript(ARCHIVE_SCHEMA)
+    return pool
+
+def _archive_db():
+    return _archive_pool(os.path.join(_archive_dir(), "index.sqlite3")).connection()
+
+def _archive_open(path: str):
+    return (lzma.open if path.endswith(".xz") else gzip.open)(path, "rb")
+
+def _archive_expired(store: _ConnectionPool, cutoff: str, batch_size: int) -> tuple[int, list]:
+    """Move up to ``batch_size`` expired records of ``store`` into the archive.
+
+    Returns (records selected, ids removed from the DB). Files and index are
+    written and synced before the rows are deleted; a crash in between only
+    archives them twice (counted twice in the index), and readers keep the
+    newest copy of each id. A row edited meanwhile stays in the DB until
+    the next run.
+    """
+    with store.connection() as con:
+        rows = [_decode_record(r) for r in con.execute(SQL_SELECT_EXPIRED, (cutoff, batch_size))]
+    if not rows:
+        return 0, []
+    parts = {}
+    for rec in rows:
+        part = f"{_tenant_name(rec['company_id'])}/{rec['created_at'][:7]}{ARCHIVE_SUFFIX[ARCHIVE_COMPRESSION]}"
+        parts.setdefault(part, []).append(rec)
+    with _archive_db() as acon:
+        # the index write lock also keeps two processes from appending at once
+        acon.execute("BEGIN IMMEDIATE")
+        try:
+            for part, recs in parts.items():
+                path = os.path.join(_archive_dir(), part)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in recs).encode("utf-8")
+                data = lzma.compress(data) if path.endswith(".xz") else gzip.compress(data)
+                with open(path, "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                acon.execute("""
+                INSERT INTO archive_parts(part, company_id, month, records, bytes) VALUES (?,?,?,?,?)
+                ON CONFLICT(part) DO UPDATE SET records = records + excluded.records, bytes = excluded.bytes
+                """, (part, recs[0]["company_id"], recs[0]["created_at"][:7], len(recs), os.path.getsize(path)))
+            acon.commit()
+        except BaseException:
+            acon.rollback()
+            raise
+    ids = []
+    with store.connection() as con, con:
+        for r in rows:
+            if con.execute("DELETE FROM ky_records WHERE id=? AND updated_at=?", (r["id"], r["updated_at"])).rowcount:
+                ids.append(r["id"])
+    return len(rows), ids
+
+def _read_archive_part(part: str) -> list:
+    """Records of one archive file, newest first (latest copy of each id)."""
+    latest = {}
+    try:
+        with _archive_open(os.path.join(_archive_dir(), part)) as f:
+            for line in f:
+                rec = json.loads(line)
+                prev = latest.get(rec["id"])
+                if prev is None or rec["updated_at"] >= prev["updated_at"]:
+                    latest[rec["id"]] = rec
+    except FileNotFoundError:
+        return []
+    return sorted(latest.values(), key=lambda r: (r["created_at"], r["id"]), reverse=True)
+
+def _archive_text(rec: dict) -> str:
+    # the fields 自社履歴 search covers
+    return " ".join(rec.get(f) or "" for f in ("work_title", "location", "work_content", "inputter_name", "notes")).casefold()
+
+@_instrumented
+def _search_archive(company_id: str, text: str = "", date_from: date | None = None, date_to: date | None = None,
+                    after: tuple | None = None, limit: int = 30):
+    """Archived records matching every word of ``text``, newest first, as
+    (rows, next_cursor) like _search_records.
+
+    There is no text index: the company's monthly files inside the date
+    range are decompressed one by one until a page is full.
+    """
+    terms = [t.casefold() for t in text.split()]
+    lo = date_from.isoformat() if date_from else ""
+    hi = (date_to + timedelta(days=1)).isoformat() if date_to else "9999"
+    with _archive_db() as con:
+        parts = [r["part"] for r in con.execute(
+            "SELECT part FROM archive_parts WHERE company_id=? AND month BETWEEN ? AND ? ORDER BY month DESC, part",
+            (company_id, lo[:7], hi[:7]))]
+    rows = []
+    for part in parts:
+        for rec in _read_archive_part(part):
+            if after and (rec["created_at"], rec["id"]) >= tuple(after):
+                continue
+            if not lo <= rec["created_at"] < hi:
+                continue
+            if terms and not all(t in _archive_text(rec) for t in terms):
+                continue
+            rows.append(rec)
+            if len(rows) > limit:
+                return rows[:limit], (rows[limit - 1]["created_at"], rows[limit - 1]["id"])
+    return rows, None
+
+def _purge_archive() -> int:
+    """Remove archive months older than KY_ARCHIVE_YEARS; returns files removed."""
+    if ARCHIVE_YEARS <= 0 or not os.path.isdir(_archive_dir()):
+        return 0
+    month = (datetime.utcnow() - relativedelta(months=int(ARCHIVE_YEARS * 12))).strftime("%Y-%m")
+    with _archive_db() as con, con:
+        parts = [r[0] for r in con.execute("DELETE FROM archive_parts WHERE month < ? RETURNING part", (month,))]
+    for part in parts:
+        try:
+            os.remove(os.path.join(_archive_dir(), part))
+        except FileNotFoundError:
+            pass
+    return len(parts)
+
+def _incremental_vacuum(pages_per_step: int = 500, pause: float = 0.05, store: _ConnectionPool | None = None):
+    # Hand freed pages back to the filesystem in bounded steps. executescript
+    # is needed because Connection.execute only steps the pragma once (= 1 page).
+    store = store or _central_pool()
+    while True:
+        with store.connection() as con:
+            if con.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                return
+            con.executescript(f"PRAGMA incremental_vacuum({int(pages_per_step)});")
+        time.sleep(pause)
+
+@_instrumented
+def _claim_run(key: str, interval_hours: float) -> bool:
+    """True if no run of ``key`` (in any process) started within the interval.
+
+    The run is claimed by writing its start time first, so two workers that
+    wake up together do not both run it.
+    """
+    now = datetime.utcnow()
+    with _db() as con:
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute("SELECT value FROM app_meta WHERE key=?", (key,)).fetchone()
+        if row and now - datetime.fromisoformat(row["value"]) < timedelta(hours=interval_hours):
+            con.rollback()
+            return False
+        con.execute("INSERT OR REPLACE INTO app_meta(key, value) VALUES (?, ?)", (key, now.isoformat()))
+        con.commit()
+    return True
+
+def _run_retention_if_due(interval_hours: float = RETENTION_INTERVAL_HOURS):
+    """Run retention unless another run (any process) happened within the
+    interval. Returns the deleted count, or None when it was not due."""
+    if not _claim_run("retention_last_run", interval_hours):
+        return None
+    return _apply_retention()
+
+def _retention_loop(check_every: float):
+    while True:
+        try:
+            n = _run_retention_if_due()
+            if n:
+                log.info("retention: deleted %d expired records", n)
+            _purge_expired_auth()
+            _purge_export_jobs()
+        except Exception:
+            log.exception("retention run failed")
+        time.sleep(check_every)
+
+@st.cache_resource(show_spinner=False)
+def _start_retention_worker(db_path: str):
+    # One daemon thread per process; the app_meta timestamp keeps the
+    # effective rate at one run per interval across processes.
+    check_every = min(600.0, RETENTION_INTERVAL_HOURS * 3600)
+    t = threading.Thread(target=_retention_loop, args=(check_every,), name="ky-retention", daemon=True)
+    t.start()
+    return t
+
+# ---- Online backups ----
+# A snapshot is a directory backups/ky-<UTC time>/ holding main.sqlite3.gz,
+# tenants/<name>.sqlite3.gz when tenant files exist, and manifest.json. It is
+# built under a dot-name and renamed when complete, so a listed snapshot is
+# always whole.
+BACKUP_PREFIX = "ky-"
+
+def _backup_dir() -> str:
+    return BACKUP_DIR or os.path.join(os.path.dirname(DB_PATH) or ".", "backups")
+
+def _backup_sources() -> dict:
+    # snapshot-relative name -> live file
+    sources = {"main.sqlite3.gz": DB_PATH}
+    if os.path.isdir(_tenants_dir()):
+        for n in sorted(os.listdir(_tenants_dir())):
+            if n.endswith(".sqlite3"):
+                sources[f"tenants/{n}.gz"] = os.path.join(_tenants_dir(), n)
+    return sources
+
+def _backup_file(src_path: str, dest: str, pages: int, pause: float, on_copy=None) -> dict:
+    """Copy a live SQLite file into ``dest`` (gzip), checking the copy.
+    ``on_copy(con)`` may read the copy before it is compressed.
+
+    The source connection holds one read transaction for the whole copy. In
+    WAL mode that blocks no writer, and it pins the snapshot being copied:
+    without it every commit from another connection would restart the
+    backup, and a busy multi-GB DB would never finish. The WAL cannot be
+    checkpointed past that snapshot meanwhile, so it grows until the copy ends.
+    """
+    tmp = dest[:-len(".gz")]
+    src = sqlite3.connect(src_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+        src.rollback()
+        problems = [r[0] for r in dst.execute("PRAGMA integrity_check")]
+        if problems != ["ok"]:
+            raise RuntimeError(f"integrity_check failed on the copy of {src_path}: {problems[:5]}")
+        if on_copy:
+            on_copy(dst)
+        # a restored file should not need a -wal beside it
+        dst.execute("PRAGMA journal_mode=DELETE")
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        src.close()
+        dst.close()
+    digest = hashlib.sha256()
+    with open(tmp, "rb") as f, open(dest, "wb") as out:
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+                gz.write(chunk)
+        out.flush()
+        os.fsync(out.fileno())
+    size = os.path.getsize(tmp)
+    os.remove(tmp)
+    return {"pages": page_count, "bytes": size, "gz_bytes": os.path.getsize(dest), "sha256": digest.hexdigest()}
+
+def _backup_archive_parts(parts: dict, dest_dir: str) -> dict:
+    """Copy the archive files listed in an index copy into ``dest_dir``.
+
+    Files are append-only and the index records each one's size at its last
+    commit, so copying that many bytes gives exactly what the copied index
+    describes, without locking out a retention run. A file purged since is
+    skipped (readers treat a listed but missing file as empty).
+    """
+    out = {}
+    for part, size in sorted(parts.items()):
+        dest = os.path.join(dest_dir, part)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        digest = hashlib.sha256()
+        try:
+            with open(os.path.join(_archive_dir(), part), "rb") as f, open(dest, "wb") as o:
+                left = size
+                while left:
+                    chunk = f.read(min(left, 1 << 20))
+                    if not chunk:
+                        raise RuntimeError(f"archive/{part} is shorter than its index entry ({size} bytes)")
+                    digest.update(chunk)
+                    o.write(chunk)
+                    left -= len(chunk)
+                o.flush()
+                os.fsync(o.fileno())
+        except FileNotFoundError:
+            continue
+        out[f"archive/{part}"] = {"bytes": size, "sha256": digest.hexdigest()}
+    return out
+
+@_instrumented
+def _backup_now(pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE_MS / 1000, keep: int = BACKUP_KEEP) -> str:
+    """Take a snapshot now; returns its directory. Older ones beyond ``keep`` are removed."""
+    started = datetime.utcnow()
+    name = BACKUP_PREFIX + started.strftime("%Y%m%dT%H%M%SZ")
+    final = os.path.join(_backup_dir(), name)
+    work = os.path.join(_backup_dir(), "." + name)
+    os.makedirs(work, exist_ok=True)
+    try:
+        files = {}
+        for rel, src_path in _backup_sources().items():
+            os.makedirs(os.path.dirname(os.path.join(work, rel)), exist_ok=True)
+            files[rel] = _backup_file(src_path, os.path.join(work, rel), pages, pause)
+        # KY_RETENTION_MODE=archive: the index, then the files it lists
+        archive, index = {}, os.path.join(_archive_dir(), "index.sqlite3")
+        if os.path.exists(index):
+            os.makedirs(os.path.join(work, "archive"), exist_ok=True)
+            parts = {}
+            files["archive/index.sqlite3.gz"] = _backup_file(
+                index, os.path.join(work, "archive", "index.sqlite3.gz"), pages, pause,
+                on_copy=lambda con: parts.update(con.execute("SELECT part, bytes FROM archive_parts")))
+            archive = _backup_archive_parts(parts, os.path.join(work, "archive"))
+        with open(os.path.join(work, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"created_at": started.isoformat(), "finished_at": datetime.utcnow().isoformat(),
+                       "integrity_check": "ok", "files": files, "archive_parts": archive},
+                      f, ensure_ascii=False, indent=1)
+        os.rename(work, final)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    for old in _list_backups()[keep:]:
+        shutil.rmtree(os.path.join(_backup_dir(), old), ignore_errors=True)
+    return final
+
+def _list_backups() -> list:
+    """Complete snapshots, newest first."""
+    if not os.path.isdir(_backup_dir()):
+        return []
+    return sorted((n for n in os.listdir(_backup_dir()) if n.startswith(BACKUP_PREFIX)), reverse=True)
+
+def _restore_backup(snapshot: str, db_path: str) -> list:
+    """Replace the DB (and tenant files, and the archive) at ``db_path``
+    with ``snapshot``.
+
+    Only for a stopped app: each file is unpacked next to its target,
+    checked, and then moved over it, with the old -wal/-shm removed.
+    Tenant files the snapshot does not have would mix generations, so the
+    restore is refused while any exists. When the snapshot has an archive,
+    archive files it does not list are removed: they were archived after the
+    snapshot, from records the restored DB holds again.
+    Returns the restored paths.
+    """
+    with open(os.path.join(snapshot, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    base = os.path.dirname(db_path) or "."
+    archive_dir = ARCHIVE_DIR or os.path.join(base, "archive")
+
+    def target_of(rel):
+        if rel == "main.sqlite3.gz":
+            return db_path
+        if rel.startswith("archive/"):
+            return os.path.join(archive_dir, rel[len("archive/"):-len(".gz")])
+        return os.path.join(base, rel[:-len(".gz")])
+    targets = {rel: target_of(rel) for rel in manifest["files"]}
+    copies = {rel: os.path.join(archive_dir, rel[len("archive/"):]) for rel in manifest.get("archive_parts", {})}
+
+    tenants = os.path.join(base, "tenants")
+    extra = sorted(os.path.join(tenants, n) for n in (os.listdir(tenants) if os.path.isdir(tenants) else ())
+                   if n.endswith(".sqlite3") and os.path.join(tenants, n) not in targets.values())
+    if extra:
+        raise RuntimeError(f"not in the snapshot, move away first: {', '.join(extra)}")
+    stale = []
+    if "archive/index.sqlite3.gz" in manifest["files"] and os.path.isdir(archive_dir):
+        keep = set(copies.values()) | {os.path.join(archive_dir, "index.sqlite3")}
+        stale = [os.path.join(root, n) for root, _, names in os.walk(archive_dir) for n in names
+                 if n.endswith(tuple(ARCHIVE_SUFFIX.values())) and os.path.join(root, n) not in keep]
+
+    staged = []
+    try:
+        for rel, target in copies.items():
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = target + ".restore"
+            staged.append(tmp)
+            shutil.copyfile(os.path.join(snapshot, rel), tmp)
+            with open(tmp, "rb") as f:
+                if hashlib.file_digest(f, "sha256").hexdigest() != manifest["archive_parts"][rel]["sha256"]:
+                    raise RuntimeError(f"{rel}: checksum does not match the manifest")
+        for rel, target in targets.items():
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            tmp = target + ".restore"
+            staged.append(tmp)
+            digest = hashlib.sha256()
+            with gzip.open(os.path.join(snapshot, rel), "rb") as gz, open(tmp, "wb") as out:
+                for chunk in iter(lambda: gz.read(1 << 20), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+            if digest.hexdigest() != manifest["files"][rel]["sha256"]:
+                raise RuntimeError(f"{rel}: checksum does not match the manifest")
+            con = sqlite3.connect(tmp)
+            try:
+                problems = [r[0] for r in con.execute("PRAGMA integrity_check")]
+            finally:
+                con.close()
+            if problems != ["ok"]:
+                raise RuntimeError(f"{rel}: integrity_check failed: {problems[:5]}")
+    except BaseException:
+        for tmp in staged:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    for target in targets.values():
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        os.replace(target + ".restore", target)
+    for target in copies.values():
+        os.replace(target + ".restore", target)
+    for path in stale:
+        os.remove(path)
+    return list(targets.values()) + list(copies.values())
+
+def _backup_loop(check_every: float):
+    while True:
+        try:
+            if _claim_run("backup_last_run", BACKUP_INTERVAL_HOURS):
+                log.info("backup: wrote %s", _backup_now())
+        except Exception:
+            log.exception("backup failed")
+        time.sleep(check_every)
+
+@st.cache_resource(show_spinner=False)
+def _start_backup_worker(db_path: str):
+    if BACKUP_INTERVAL_HOURS <= 0:
+        return None
+    check_every = min(600.0, BACKUP_INTERVAL_HOURS * 3600)
+    t = threading.Thread(target=_backup_loop, args=(check_every,), name="ky-backup", daemon=True)
+    t.start()
+    return t
+
+@st.cache_resource(show_spinner=False)
+def _bootstrap(db_path: str):
+    # Streamlit re-executes this script on every interaction; cache_resource
+    # makes the schema/seed work run once per process and DB path, and its
+    # per-key lock keeps concurrent sessions from racing through it.
+    _init_db()
+    _seed_if_needed()
+    return True
+
+def _warm_up(db_path: str):
+    try:
+        _bootstrap(db_path)
+        _start_retention_worker(db_path)
+        _start_export_workers(db_path)
+        _start_backup_worker(db_path)
+        # what the first login and the first export would otherwise pay for
+        import bcrypt  # noqa: F401
+        _excel_template(TEMPLATE_PATH)
+    except Exception:
+        # a page that needs the DB retries _bootstrap itself and shows the
+        # error; the next page view starts the warm-up again
+        log.exception("warm-up failed")
+        _start_warm_up.clear()
+
+@st.cache_resource(show_spinner=False)
+def _start_warm_up(db_path: str):
+    """Bootstrap the DB, start the workers and parse the Excel template in
+    the background, once per process, so the first page after a cold start
+    renders the login form without waiting for any of it. Anything that
+    needs the DB calls _bootstrap first, which waits for this to finish."""
+    t = threading.Thread(target=_warm_up, args=(db_path,), name="ky-warm-up", daemon=True)
+    t.start()
+    return t
+
+# ---- Authentication: bcrypt pool, sessions, throttling ----
+@st.cache_resource(show_spinner=False)
+def _bcrypt_pool():
+    # bcrypt releases the GIL, so a small pool caps how many cores hashing
+    # can take no matter how many sessions log in at once.
+    # The semaphore bounds the queue in front of it (checks running + waiting).
+    pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="ky-bcrypt")
+    return pool, threading.BoundedSemaphore(BCRYPT_WORKERS * 8)
+
+class BcryptBusy(RuntimeError):
+    """Too many password checks are already queued."""
+
+def _bcrypt_call(fn, *args):
+    pool, pending = _bcrypt_pool()
+    if not pending.acquire(blocking=False):
+        raise BcryptBusy()
+    try:
+        with _get_metrics().excluded("bcrypt"):
+            return pool.submit(fn, *args).result()
+    finally:
+        pending.release()
+
+def _hashpw(password: str) -> bytes:
+    import bcrypt
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+
+def _hash_password(password: str) -> bytes:
+    return _bcrypt_call(_hashpw, password)
+
+def _check_password(password: str, pw_hash: bytes) -> bool:
+    import bcrypt
+    return _bcrypt_call(bcrypt.checkpw, password.encode("utf-8"), pw_hash)
+
+def _token_hash(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+@_instrumented
+def _create_session(company_id: str) -> str:
+    token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    with _db() as con, con:
+        con.execute("INSERT INTO sessions(token_hash, company_id, created_at, expires_at) VALUES (?,?,?,?)",
+                    (_token_hash(token), company_id, now.isoformat(), (now + timedelta(hours=SESSION_HOURS)).isoformat()))
+    return token
+
+@_instrumented
+def _resume_session(token: str):
+    """Resume from a URL token; returns (company row, replacement token) or
+    (None, None). The token is single-use: a copy left in history or a
+    shared link stops working once the tab it came from has reloaded.
+    Disabled companies and expired tokens do not resume."""
+    now = datetime.utcnow()
+    new = secrets.token_urlsafe(32)
+    with _db() as con, con:
+        row = con.execute(SQL_GET_SESSION, (_token_hash(token), now.isoformat())).fetchone()
+        if row is None:
+            return None, None
+        # the DELETE decides the race between two tabs reloading the same URL
+        if not con.execute("DELETE FROM sessions WHERE token_hash=?", (_token_hash(token),)).rowcount:
+            return None, None
+        con.execute("INSERT INTO sessions(token_hash, company_id, created_at, expires_at) VALUES (?,?,?,?)",
+                    (_token_hash(new), row["company_id"], now.isoformat(),
+                     (now + timedelta(hours=SESSION_HOURS)).isoformat()))
+    return dict(row), new
+
+@_instrumented
+def _end_session(token: str):
+    with _db() as con, con:
+        con.execute("DELETE FROM sessions WHERE token_hash=?", (_token_hash(token),))
+
+def _end_company_sessions(con, company_ids: list):
+    con.execute("DELETE FROM sessions WHERE company_id IN (SELECT value FROM json_each(?))", (json.dumps(company_ids),))
+
+@_instrumented
+def _purge_expired_auth():
+    now = datetime.utcnow()
+    stale = (now - timedelta(minutes=max(LOGIN_WINDOW_MINUTES, LOGIN_LOCKOUT_MINUTES))).isoformat()
+    with _db() as con, con:
+        con.execute("DELETE FROM sessions WHERE expires_at <= ?", (now.isoformat(),))
+        con.execute("DELETE FROM login_failures WHERE first_at < ? AND (locked_until IS NULL OR locked_until < ?)",
+                    (stale, now.isoformat()))
+
+def _throttle_keys(company_id: str, client_ip: str | None):
+    """(lockout keys, delay key). Failures from one address lock that
+    address out, for this company and overall; failures on a company from
+    anywhere only add a delay (_login_delay)."""
+    lock = [f"ip:{client_ip}", f"company-ip:{company_id}|{client_ip}"] if client_ip else []
+    return lock, f"company:{company_id}"
+
+@_instrumented
+def _login_locked(keys) -> bool:
+    if not keys:
+        return False
+    now = datetime.utcnow().isoformat()
+    with _db() as con:
+        q = f"SELECT 1 FROM login_failures WHERE key IN ({','.join('?' * len(keys))}) AND locked_until > ?"
+        return con.execute(q, (*keys, now)).fetchone() is not None
+
+@_instrumented
+def _login_delay(key: str) -> float:
+    # 1s at KY_LOGIN_MAX_FAILURES failures within the window, doubling per failure
+    window_start = (datetime.utcnow() - timedelta(minutes=LOGIN_WINDOW_MINUTES)).isoformat()
+    with _db() as con:
+        row = con.execute("SELECT failures FROM login_failures WHERE key=? AND first_at >= ?",
+                          (key, window_start)).fetchone()
+    if row is None or row[0] < LOGIN_MAX_FAILURES:
+        return 0.0
+    return min(LOGIN_DELAY_MAX_SEC, 2.0 ** min(row[0] - LOGIN_MAX_FAILURES, 16))
+
+@_instrumented
+def _record_login_failure(lock_keys, delay_key: str):
+    now = datetime.utcnow()
+    window_start = (now - timedelta(minutes=LOGIN_WINDOW_MINUTES)).isoformat()
+    locked_until = (now + timedelta(minutes=LOGIN_LOCKOUT_MINUTES)).isoformat()
+    with _db() as con, con:
+        for key in [*lock_keys, delay_key]:
+            # a failure outside the window starts a new count
+            con.execute("""
+            INSERT INTO login_failures(key, failures, first_at) VALUES (?, 1, ?)
+            ON CONFLICT(key) DO UPDATE SET
+              failures = CASE WHEN first_at < ? THEN 1 ELSE failures + 1 END,
+              first_at = CASE WHEN first_at < ? THEN excluded.first_at ELSE first_at END
+            """, (key, now.isoformat(), window_start, window_start))
+            if key != delay_key:
+                con.execute("UPDATE login_failures SET locked_until=? WHERE key=? AND failures >= ?",
+                            (locked_until, key, LOGIN_MAX_FAILURES))
+
+@_instrumented
+def _clear_login_failures(keys):
+    with _db() as con, con:
+        con.executemany("DELETE FROM login_failures WHERE key=?", [(k,) for k in keys])
+
+def _client_ip():
+    # Behind Render's proxy the last X-Forwarded-For hop is the address the
+    # proxy saw; earlier entries can be set by the client.
+    try:
+        xff = st.context.headers.get("X-Forwarded-For", "")
+    except Exception:
+        return None
+    hops = [h.strip() for h in xff.split(",") if h.strip()]
+    return hops[-1] if hops else None
+
+@_instrumented
+def _verify_login(company_id: str, password: str, client_ip: str | None = None):
+    lock_keys, delay_key = _throttle_keys(company_id, client_ip)
+    if _login_locked(lock_keys):
+        return None, "ログインの失敗が続いたため一時的にロックしています。しばらく待ってから再度お試しください。"
+    delay = _login_delay(delay_key)
+    if delay:
+        with _get_metrics().excluded("login_delay"):
+            time.sleep(delay)
+    with _db() as con:
+        row = con.execute(SQL_GET_COMPANY, (company_id,)).fetchone()
     if not row:
+        _record_login_failure(lock_keys, delay_key)
         return None, "IDが見つかりません。"
     if row["is_enabled"] != 1:
         return None, "このアカウントは停止されています。管理者に連絡してください。"
-    if not bcrypt.checkpw(password.encode("utf-8"), row["password_hash"]):
+    try:
+        ok = _check_password(password, row["password_hash"])
+    except BcryptBusy:
+        return None, "ただいま混み合っています。少し待ってから再度お試しください。"
+    if not ok:
+        _record_login_failure(lock_keys, delay_key)
         return None, "パスワードが違います。"
+    _clear_login_failures([*lock_keys, delay_key])
     return dict(row), None
 
+class _CandidateCache:
+    """Per-company 入力者名 candidates with use counts, shared by all sessions.
+
+    Writes made by this process update the cache directly; entries are
+    reloaded after CANDIDATE_CACHE_TTL seconds so names added by another
+    process show up too.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # company_id -> [loaded_at, {name: use_count}, ranked names or None]
+
+    def _entry(self, company_id: str):
+        with self._lock:
+            e = self._entries.get(company_id)
+            if e and time.monotonic() - e[0] < self.ttl:
+                return e
+        with _tenant_db(company_id) as con:
+            counts = {r["name"]: r["use_count"] for r in con.execute(SQL_LIST_CANDIDATES, (company_id,))}
+        with self._lock:
+            e = self._entries[company_id] = [time.monotonic(), counts, None]
+            return e
+
+    def ranked(self, company_id: str) -> list:
+        e = self._entry(company_id)
+        with self._lock:
+            if e[2] is None:
+                e[2] = sorted(e[1], key=lambda n: (-e[1][n], n))
+            return e[2]
+
+    def known(self, company_id: str, name: str) -> bool:
+        return name in self._entry(company_id)[1]
+
+    def added(self, company_id: str, name: str):
+        with self._lock:
+            e = self._entries.get(company_id)
+            if e is not None and name not in e[1]:
+                e[1][name] = 0
+                e[2] = None
+
+    def used(self, company_id: str, name: str):
+        with self._lock:
+            e = self._entries.get(company_id)
+            if e is not None and name in e[1]:
+                e[1][name] += 1
+                e[2] = None
+
+    def invalidate(self, company_id: str | None = None):
+        with self._lock:
+            if company_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(company_id, None)
+
+@st.cache_resource(show_spinner=False)
+def _candidate_cache(db_path: str):
+    return _CandidateCache(CANDIDATE_CACHE_TTL)
+
+@_instrumented
 def _list_candidates(company_id: str):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("SELECT name FROM name_candidates WHERE company_id=? ORDER BY name", (company_id,))
-    rows = [r["name"] for r in cur.fetchall()]
-    con.close()
-    return rows
+    # most used first, then by name
+    return _candidate_cache(DB_PATH).ranked(company_id)
 
-def _add_candidate(company_id: str, name: str):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("INSERT OR IGNORE INTO name_candidates(company_id, name) VALUES (?,?)", (company_id, name))
-    con.commit()
-    con.close()
+def _search_candidates(company_id: str, prefix: str = "", limit: int | None = None):
+    """Ranked candidates starting with ``prefix`` (spaces ignored)."""
+    key = prefix.replace(" ", "").replace("　", "")
+    names = _list_candidates(company_id)
+    if key:
+        names = [n for n in names if n.replace(" ", "").replace("　", "").startswith(key)]
+    return names[:limit] if limit else names
 
 def _new_id():
     # simple unique id
     import secrets
     return secrets.token_hex(12)
 
-def _save_record(data: dict, record_id: str | None = None):
+def _record_columns(data: dict) -> tuple:
+    # work_title … notes, in ky_records column order
+    return (
+        data.get("work_title",""), data.get("work_company",""), data.get("phone",""),
+        data.get("work_date",""), data.get("start_time",""), data.get("end_time",""),
+        data.get("location",""), data.get("people_count",""), data.get("work_content",""),
+        _items_mask("hazards", data.get("hazards"), data.get("hazards_other")),
+        data.get("hazards_other",""),
+        _items_mask("avoid", data.get("avoid"), data.get("avoid_other")),
+        data.get("avoid_other",""),
+        data.get("focus_instructions",""),
+        _items_mask("finish", data.get("finish"), data.get("finish_other")),
+        data.get("finish_other",""),
+        data.get("notes",""),
+    )
+
+class _RecordCache:
+    """Decoded records by (company_id, id, updated_at), shared by all sessions.
+
+    A given version of a record never changes, so a lookup that names the
+    version is answered from memory whenever it is here. A lookup for the
+    latest version trusts the entry for ``ttl`` seconds after it was last
+    written or checked, then compares updated_at with the DB (one index
+    lookup) before reloading the row. Saves in this process replace the entry
+    directly, so other sessions see them at once; the TTL bounds how long an
+    edit made by another process can go unnoticed.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id -> [company_id, updated_at, checked_at, record]
+
+    def get(self, company_id: str, record_id: str, updated_at: str | None = None) -> dict | None:
+        with self._lock:
+            e = self._entries.get(record_id)
+            if e is None or e[0] != company_id:
+                return None
+            if updated_at is not None and e[1] != updated_at:
+                return None
+            if updated_at is None and time.monotonic() - e[2] >= self.ttl:
+                return None
+            self._entries.move_to_end(record_id)
+            return e[3]
+
+    def stale(self, company_id: str, record_id: str) -> str | None:
+        """updated_at of an entry whose TTL ran out, for revalidation."""
+        with self._lock:
+            e = self._entries.get(record_id)
+            return e[1] if e is not None and e[0] == company_id else None
+
+    def confirm(self, record_id: str, updated_at: str):
+        with self._lock:
+            e = self._entries.get(record_id)
+            if e is not None and e[1] == updated_at:
+                e[2] = time.monotonic()
+
+    def put(self, record: dict):
+        with self._lock:
+            e = self._entries.get(record["id"])
+            # never let a slow reader put back an older version than a writer did
+            if e is not None and e[1] > record["updated_at"]:
+                return
+            self._entries[record["id"]] = [record["company_id"], record["updated_at"], time.monotonic(), record]
+            self._entries.move_to_end(record["id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, record_ids):
+        with self._lock:
+            for record_id in record_ids:
+                self._entries.pop(record_id, None)
+
+@st.cache_resource(show_spinner=False)
+def _record_cache(db_path: str):
+    return _RecordCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+
+def _get_record_cache() -> _RecordCache | None:
+    key = ("record_cache", DB_PATH)
+    if key not in _resolved:
+        _resolved[key] = _record_cache(DB_PATH) if RECORD_CACHE_SIZE > 0 else None
+    return _resolved[key]
+
+def _discard_records(record_ids):
+    cache = _get_record_cache()
+    if cache is not None and record_ids:
+        cache.discard(record_ids)
+
+# ---- Group-commit writer ----
+class WriteQueueFull(RuntimeError):
+    """The writer's queue stayed full for KY_WRITE_QUEUE_WAIT_MS, or the
+    write was not started within KY_WRITE_TIMEOUT_MS (and never will be)."""
+
+class WriteStillRunning(RuntimeError):
+    """The write was started but its group had not committed after another
+    KY_WRITE_TIMEOUT_MS; it may still be saved."""
+
+class _GroupWriter:
+    """One thread that runs the write intents of all sessions, committing
+    everything queued for the same DB file as one transaction.
+
+    An intent is ``fn(con) -> result``. submit() blocks until the intent's
+    group has committed and returns the result, or raises what ``fn`` raised.
+    Each intent runs in its own SAVEPOINT, so one that fails is rolled back
+    alone and the rest of its group still commits.
+
+    Durability: a result is returned only after COMMIT, so it is visible to
+    every reader and survives an app crash. If the process dies first, the
+    whole group is lost and none of its callers was told it was saved.
+    Under synchronous=NORMAL a power cut can still lose the last groups;
+    with KY_WRITE_SYNC=FULL the WAL is fsynced once per group.
+
+    Backpressure: at most KY_WRITE_QUEUE_MAX intents wait. submit() waits up
+    to KY_WRITE_QUEUE_WAIT_MS for room, then raises WriteQueueFull. An
+    intent not started within ``timeout`` is cancelled and raises it too, so
+    a retry cannot write twice; one already started is waited for once more,
+    then WriteStillRunning is raised (the caller cannot know the outcome).
+    """
+
+    def __init__(self, max_queue: int, group_ms: float, group_max: int, sync: str, timeout: float):
+        self._queue = queue.Queue(max_queue)
+        self.group_s = group_ms / 1000
+        self.group_max = group_max
+        self.sync = sync
+        self.timeout = timeout
+        self._cons = {}  # DB path -> the writer's own connection
+        self.groups = self.intents = 0  # committed; intents / groups is the mean group size
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._thread is not None:
+                log.error("writer thread had stopped; restarting it")
+            self._thread = threading.Thread(target=self._run, name="ky-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, path: str, fn, wait: float):
+        self._ensure_thread()
+        future = Future()
+        try:
+            self._queue.put((path, fn, future, time.perf_counter()), timeout=wait)
+        except queue.Full:
+            raise WriteQueueFull() from None
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise WriteQueueFull() from None
+        # its group is being committed; that normally ends within busy_timeout
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise WriteStillRunning() from None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _take_group(self) -> list:
+        group = [self._queue.get()]
+        deadline = time.perf_counter() + self.group_s
+        while len(group) < self.group_max:
+            try:
+                group.append(self._queue.get(timeout=max(0.0, deadline - time.perf_counter())))
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        while True:
+            by_path = {}
+            for item in self._take_group():
+                by_path.setdefault(item[0], []).append(item)
+            for path, items in by_path.items():
+                try:
+                    self._commit(path, items)
+                except BaseException as e:
+                    # never leave a caller waiting, whatever went wrong
+                    for _, _, future, _ in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    if not isinstance(e, Exception):
+                        raise  # the next submit() starts a new thread
+
+    def _connection(self, path: str):
+        con = self._cons.get(path)
+        if con is None:
+            con = self._cons[path] = _connect(path)
+            con.execute(f"PRAGMA synchronous={self.sync}")
+        return con
+
+    def _commit(self, path: str, items: list):
+        # callers that gave up (cancelled) are skipped; the rest can no longer cancel
+        items = [item for item in items if item[2].set_running_or_notify_cancel()]
+        if not items:
+            return
+        metrics = _get_metrics()
+        started = time.perf_counter()
+        for *_, queued_at in items:
+            metrics.observe("write_wait", started - queued_at)
+        con = self._connection(path)
+        outcomes = []
+        try:
+            t0 = time.perf_counter()
+            con.execute("BEGIN IMMEDIATE")
+            if time.perf_counter() - t0 > 0.001:
+                # another connection (retention, an export job, another process) held the write lock
+                metrics.observe("write_lock_wait", time.perf_counter() - t0)
+            for _, fn, future, _ in items:
+                con.execute("SAVEPOINT intent")
+                try:
+                    outcomes.append((future, fn(con), None))
+                    con.execute("RELEASE intent")
+                except Exception as e:
+                    con.execute("ROLLBACK TO intent")
+                    con.execute("RELEASE intent")
+                    outcomes.append((future, None, e))
+            con.commit()
+        except BaseException:
+            # BEGIN or COMMIT failed (e.g. another process held the lock past
+            # busy_timeout), or the thread is going down: nothing of this
+            # group was written, and the connection is left clean for the next
+            if con.in_transaction:
+                con.rollback()
+            raise
+        metrics.observe("write_group", time.perf_counter() - started)
+        self.groups += 1
+        self.intents += len(items)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+@st.cache_resource(show_spinner=False)
+def _group_writer(db_path: str) -> _GroupWriter:
+    return _GroupWriter(WRITE_QUEUE_MAX, WRITE_GROUP_MS, WRITE_GROUP_MAX, WRITE_SYNC, WRITE_TIMEOUT_MS / 1000)
+
+def _write(company_id: str, fn):
+    """Run ``fn(con)`` in a write transaction on the company's DB file and
+    return its result, through the group writer unless it is turned off."""
+    store = _tenant_store(company_id)
+    if WRITE_QUEUE_MAX <= 0:
+        with store.connection() as con, con:
+            return fn(con)
+    writer = _resolved.get(("writer", DB_PATH))
+    if writer is None:
+        writer = _resolved[("writer", DB_PATH)] = _group_writer(DB_PATH)
+    return writer.submit(store.path, fn, WRITE_QUEUE_WAIT_MS / 1000)
+
+@_instrumented
+def _save_record(data: dict, record_id: str | None = None) -> dict | None:
+    """Insert or update a record and return it as stored (decoded), or None
+    when the record to update no longer exists. A new inputter name is added
+    to the candidates in the same transaction. Raises WriteQueueFull when
+    the writer is saturated, WriteStillRunning when the commit outlasted
+    the wait."""
     now = datetime.utcnow().isoformat()
-    con = _connect()
-    cur = con.cursor()
-    if record_id is None:
+    company_id, name = data["company_id"], data["inputter_name"]
+    candidates = _candidate_cache(DB_PATH)
+    new_name = not candidates.known(company_id, name)
+    insert = record_id is None
+    if insert:
         record_id = _new_id()
-        cur.execute("""
-        INSERT INTO ky_records(
-          id, company_id, created_at, updated_at, inputter_name,
-          work_title, work_company, phone, work_date, start_time, end_time, location, people_count, work_content,
-          hazards_json, hazards_other, avoid_json, avoid_other, focus_instructions,
-          finish_json, finish_other, notes
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (
-            record_id, data["company_id"], now, now, data["inputter_name"],
-            data.get("work_title",""), data.get("work_company",""), data.get("phone",""),
-            data.get("work_date",""), data.get("start_time",""), data.get("end_time",""),
-            data.get("location",""), data.get("people_count",""), data.get("work_content",""),
-            json.dumps(data.get("hazards",[]), ensure_ascii=False),
-            data.get("hazards_other",""),
-            json.dumps(data.get("avoid",[]), ensure_ascii=False),
-            data.get("avoid_other",""),
-            data.get("focus_instructions",""),
-            json.dumps(data.get("finish",[]), ensure_ascii=False),
-            data.get("finish_other",""),
-            data.get("notes",""),
-        ))
-    else:
-        cur.execute("""
-        UPDATE ky_records SET
-          updated_at=?, inputter_name=?,
-          work_title=?, work_company=?, phone=?, work_date=?, start_time=?, end_time=?, location=?, people_count=?, work_content=?,
-          hazards_json=?, hazards_other=?, avoid_json=?, avoid_other=?, focus_instructions=?,
-          finish_json=?, finish_other=?, notes=?
-        WHERE id=? AND company_id=?
-        """, (
-            now, data["inputter_name"],
-            data.get("work_title",""), data.get("work_company",""), data.get("phone",""),
-            data.get("work_date",""), data.get("start_time",""), data.get("end_time",""),
-            data.get("location",""), data.get("people_count",""), data.get("work_content",""),
-            json.dumps(data.get("hazards",[]), ensure_ascii=False),
-            data.get("hazards_other",""),
-            json.dumps(data.get("avoid",[]), ensure_ascii=False),
-            data.get("avoid_other",""),
-            data.get("focus_instructions",""),
-            json.dumps(data.get("finish",[]), ensure_ascii=False),
-            data.get("finish_other",""),
-            data.get("notes",""),
-            record_id, data["company_id"]
-        ))
-    con.commit()
-    con.close()
-    return record_id
-
-def _load_records(company_id: str, limit: int = 50):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("""
-    SELECT id, created_at, updated_at, inputter_name, work_title, work_date, location
-    FROM ky_records
-    WHERE company_id=?
-    ORDER BY created_at DESC
-    LIMIT ?
-    """, (company_id, limit))
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-    return rows
 
-def _load_record(company_id: str, record_id: str):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM ky_records WHERE company_id=? AND id=?", (company_id, record_id))
-    row = cur.fetchone()
-    con.close()
+    def write(con):
+        if new_name:
+            con.execute("INSERT OR IGNORE INTO name_candidates(company_id, name) VALUES (?,?)", (company_id, name))
+        if insert:
+            row = con.execute("""
+            INSERT INTO ky_records(
+              id, company_id, created_at, updated_at, inputter_name,
+              work_title, work_company, phone, work_date, start_time, end_time, location, people_count, work_content,
+              hazards_mask, hazards_other, avoid_mask, avoid_other, focus_instructions,
+              finish_mask, finish_other, notes
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            RETURNING *
+            """, (record_id, company_id, now, now, name) + _record_columns(data)).fetchone()
+        else:
+            row = con.execute("""
+            UPDATE ky_records SET
+              updated_at=?, inputter_name=?,
+              work_title=?, work_company=?, phone=?, work_date=?, start_time=?, end_time=?, location=?, people_count=?, work_content=?,
+              hazards_mask=?, hazards_other=?, avoid_mask=?, avoid_other=?, focus_instructions=?,
+              finish_mask=?, finish_other=?, notes=?
+            WHERE id=? AND company_id=?
+            RETURNING *
+            """, (now, name) + _record_columns(data) + (record_id, company_id)).fetchone()
+        # usage count for candidate ranking rides on the same commit
+        con.execute("UPDATE name_candidates SET use_count = use_count + 1, last_used_at=? WHERE company_id=? AND name=?",
+                    (now, company_id, name))
+        return row
+
+    row = _write(company_id, write)
+    if not insert:
+        _discard_xlsx([record_id])
+    if new_name:
+        candidates.added(company_id, name)
+    candidates.used(company_id, name)
+    if row is None:
+        _discard_records([record_id])
+        return None
+    record = _decode_record(row)
+    cache = _get_record_cache()
+    if cache is not None:
+        cache.put(record)
+    return dict(record)
+
+@_instrumented
+def _load_record(company_id: str, record_id: str, updated_at: str | None = None):
+    """The decoded record, or None. ``updated_at`` names the version the
+    caller expects (e.g. from a history row), which the cache can answer
+    without touching the DB; if that version is gone, the current one is read."""
+    cache = _get_record_cache()
+    if cache is None:
+        return _read_record(company_id, record_id)
+    record = cache.get(company_id, record_id, updated_at)
+    if record is not None:
+        return dict(record)
+    known = cache.stale(company_id, record_id)
+    if known is not None and updated_at in (None, known):
+        with _tenant_db(company_id) as con:
+            row = con.execute(SQL_RECORD_VERSION, (company_id, record_id)).fetchone()
+        if row is None:
+            cache.discard([record_id])
+            return None
+        if row["updated_at"] == known:
+            cache.confirm(record_id, known)
+            record = cache.get(company_id, record_id, known)
+            if record is not None:
+                return dict(record)
+    record = _read_record(company_id, record_id)
+    if record is None:
+        cache.discard([record_id])
+        return None
+    cache.put(record)
+    return dict(record)
+
+def _read_record(company_id: str, record_id: str):
+    with _tenant_db(company_id) as con:
+        row = con.execute(SQL_GET_RECORD, (company_id, record_id)).fetchone()
     if not row:
         return None
+    return _decode_record(row)
+
+# ---- Bulk import ----
+IMPORT_BATCH = 2000
+SQL_IMPORT_RECORD = """
+INSERT INTO ky_records(
+  id, company_id, created_at, updated_at, inputter_name,
+  work_title, work_company, phone, work_date, start_time, end_time, location, people_count, work_content,
+  hazards_mask, hazards_other, avoid_mask, avoid_other, focus_instructions,
+  finish_mask, finish_other, notes
+) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+SQL_IMPORT_CANDIDATE = """
+INSERT INTO name_candidates(company_id, name, use_count, last_used_at) VALUES (?,?,?,?)
+ON CONFLICT(company_id, name) DO UPDATE SET
+  use_count = use_count + excluded.use_count,
+  last_used_at = max(coalesce(last_used_at, ''), excluded.last_used_at)
+"""
+_WORK_DATE_RE = re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})")
+
+def _import_timestamp(text: str | None, label: str) -> str | None:
+    text = (text or "").strip()
+    if not text:
+        return None
+    try:
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"{label}が日時として読めません: {text}") from None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat()
+
+def _import_params(company_id: str, rec: dict, now: str, cutoff: str) -> tuple:
+    """SQL_IMPORT_RECORD parameters for one imported record, or ValueError
+    saying why it cannot be imported."""
+    if rec.get("company_id") and rec["company_id"] != company_id:
+        raise ValueError(f"会社IDが異なります（{rec['company_id']}）")
+    inputter = (rec.get("inputter_name") or "").strip()
+    if not inputter:
+        raise ValueError("入力者名がありません")
+    for kind, items in CHECK_CATALOGS.items():
+        unknown = set(rec.get(kind) or []) - set(items)
+        if unknown:
+            raise ValueError(f"不明なチェック項目（{kind}）: {'、'.join(sorted(unknown))}")
+    # Historical sheets keep their own date: created_at as given, else the
+    # work date, so history order and retention follow the original.
+    created = _import_timestamp(rec.get("created_at"), "created_at")
+    if created is None:
+        m = _WORK_DATE_RE.search(rec.get("work_date") or "")
+        try:
+            created = datetime(*map(int, m.groups())).isoformat() if m else now
+        except ValueError:
+            raise ValueError(f"作業予定日が日付として読めません: {rec.get('work_date')}") from None
+    if created < cutoff:
+        raise ValueError(f"保存期間（{RETENTION_YEARS}年）を過ぎています")
+    updated = _import_timestamp(rec.get("updated_at"), "updated_at") or created
+    columns = _record_columns(rec)
+    record_id = rec.get("id") or hashlib.sha256(json.dumps(
+        [company_id, inputter, rec.get("created_at") or "", *columns], ensure_ascii=False
+    ).encode("utf-8")).hexdigest()[:24]
+    return (record_id, company_id, created, updated, inputter) + columns
+
+def _import_batch(con, company_id: str, batch: list, report: dict, names: dict, insert: bool = True):
+    # batch holds (source, params); ids are the table's key across every
+    # company sharing the file, so another company's id is an error here
+    ids = json.dumps([p[0] for _, p in batch])
+    existing = dict(con.execute(
+        "SELECT id, company_id FROM ky_records WHERE id IN (SELECT value FROM json_each(?))", (ids,)))
+    new = []
+    for source, p in batch:
+        if p[0] not in existing:
+            new.append(p)
+        elif existing[p[0]] == company_id:
+            report["duplicates"] += 1
+        else:
+            report["errors"].append((source, f"記録ID {p[0]} は他社の記録で使われています"))
+    if insert:
+        con.executemany(SQL_IMPORT_RECORD, new)
+    report["inserted"] += len(new)
+    for p in new:
+        entry = names.setdefault(p[4], [0, p[2]])
+        entry[0] += 1
+        entry[1] = max(entry[1], p[2])
+
+def _import_rows(source, name: str | None = None):
+    # reader for a path or uploaded file, using this template's cell mapping
+    return ky_import.read_path(source, name, CELL, CHECK_CATALOGS, _ExcelTemplate.read_cells)
+
+@_instrumented
+def _import_records(company_id: str, rows, dry_run: bool = False, batch_size: int = IMPORT_BATCH) -> dict:
+    """Insert one company's imported records in a single transaction.
+
+    ``rows`` are (source, record) pairs from ky_import; a record may be a
+    ValueError from the reader. Invalid rows, and ids already used by another
+    company, are listed in the report and skipped. Records without an id get one derived from their content, so
+    rows already in the DB or repeated in the input count as duplicates and
+    importing the same file twice adds nothing. Inputter names become name
+    candidates, ranked by how many records they brought in.
+    """
+    now = datetime.utcnow().isoformat()
+    cutoff = (datetime.utcnow() - relativedelta(years=RETENTION_YEARS)).isoformat()
+    report = {"read": 0, "inserted": 0, "duplicates": 0, "errors": []}
+    seen = set()
+    names = {}  # inputter_name -> [records, latest created_at]
+    with _db() as con:
+        if con.execute("SELECT 1 FROM companies WHERE company_id=?", (company_id,)).fetchone() is None:
+            raise ValueError(f"会社IDが見つかりません: {company_id}")
+    # Read and validate everything first: parsing workbooks can take
+    # minutes, and the write lock would block every save meanwhile.
+    batches, batch = [], []
+    for source, rec in rows:
+        report["read"] += 1
+        try:
+            if isinstance(rec, Exception):
+                raise rec
+            params = _import_params(company_id, rec, now, cutoff)
+        except ValueError as e:
+            report["errors"].append((source, str(e)))
+            continue
+        if params[0] in seen:
+            report["duplicates"] += 1
+            continue
+        seen.add(params[0])
+        batch.append((source, params))
+        if len(batch) >= batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    with _tenant_db(company_id) as con:
+        if dry_run:
+            # only look up existing ids; no write lock
+            for batch in batches:
+                _import_batch(con, company_id, batch, report, names, insert=False)
+            return report
+        # per-statement tracing would cost more than the inserts themselves
+        con.set_trace_callback(None)
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for batch in batches:
+                _import_batch(con, company_id, batch, report, names)
+            con.executemany(SQL_IMPORT_CANDIDATE,
+                            [(company_id, name, n, last) for name, (n, last) in names.items()])
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            con.set_trace_callback(_get_metrics().trace)
+        con.commit()
+    _candidate_cache(DB_PATH).invalidate(company_id)
+    return report
+
+def _decode_record(row) -> dict:
     d = dict(row)
-    d["hazards"] = json.loads(d.get("hazards_json") or "[]")
-    d["avoid"] = json.loads(d.get("avoid_json") or "[]")
-    d["finish"] = json.loads(d.get("finish_json") or "[]")
+    for kind in CHECK_CATALOGS:
+        d[kind] = _mask_items(kind, d.get(f"{kind}_mask") or 0)
     return d
 
-def _admin_list_companies():
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("SELECT company_id, company_name, is_enabled, is_admin, created_at FROM companies ORDER BY is_admin DESC, company_name")
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-    return rows
-
-def _admin_set_enabled(company_id: str, enabled: bool):
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("UPDATE companies SET is_enabled=? WHERE company_id=? AND is_admin=0", (1 if enabled else 0, company_id))
-    con.commit()
-    con.close()
-
-def _admin_reset_password(company_id: str):
-    import secrets, string
+def _like_pattern(text: str) -> str:
+    # substring pattern for LIKE ... ESCAPE '\'
+    return "%" + re.sub(r"([%_\\])", r"\\\1", text) + "%"
+
+def _export_filter_sql(company_id: str, date_from: date | None, date_to: date | None, location: str | None):
+    where = ["company_id=?"]
+    params = [company_id]
+    if date_from:
+        where.append("created_at >= ?")
+        params.append(date_from.isoformat())
+    if date_to:
+        where.append("created_at < ?")
+        params.append((date_to + timedelta(days=1)).isoformat())
+    if location:
+        where.append("location LIKE ? ESCAPE '\\'")
+        params.append(_like_pattern(location))
+    return " AND ".join(where), params
+
+@_instrumented
+def _count_export_records(company_id: str, date_from=None, date_to=None, location=None) -> int:
+    where, params = _export_filter_sql(company_id, date_from, date_to, location)
+    with _tenant_db(company_id) as con:
+        return con.execute(f"SELECT COUNT(*) FROM ky_records WHERE {where}", params).fetchone()[0]
+
+def _iter_export_records(company_id: str, date_from=None, date_to=None, location=None, page_size: int = 200,
+                         decode: bool = True):
+    """Yield decoded records (newest first) matching the filter.
+
+    Pages by keyset on (created_at, id) and releases the connection between
+    pages, so a long export neither holds a read snapshot nor loads everything.
+    ``decode=False`` yields the raw rows (check items still as *_mask).
+    """
+    where, params = _export_filter_sql(company_id, date_from, date_to, location)
+    last = None
+    while True:
+        if last:
+            sql = SQL_EXPORT_PAGE.format(where=where, after=SQL_AFTER_CURSOR)
+            page_params = params + [last[0], last[1], page_size]
+        else:
+            sql = SQL_EXPORT_PAGE.format(where=where, after="")
+            page_params = params + [page_size]
+        with _tenant_db(company_id) as con:
+            rows = con.execute(sql, page_params).fetchall()
+        for row in rows:
+            yield _decode_record(row) if decode else row
+        if len(rows) < page_size:
+            return
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+
+# Ledger (一覧表) export: one row per record. Text columns first, then one
+# column per check item (○ when ticked) followed by that group's その他 text.
+LEDGER_TEXT = (
+    ("id", "ID"), ("created_at", "作成日時"), ("updated_at", "更新日時"), ("inputter_name", "入力者"),
+    ("work_title", "作業件名"), ("work_company", "作業会社名"), ("phone", "電話番号"),
+    ("work_date", "作業予定日"), ("start_time", "開始時刻"), ("end_time", "終了時刻"),
+    ("location", "作業場所"), ("people_count", "作業人数"), ("work_content", "作業内容"),
+    ("focus_instructions", "重点指示事項"), ("notes", "連絡事項"),
+)
+LEDGER_KINDS = {"hazards": "危険", "avoid": "回避", "finish": "終了確認"}
+
+def _ledger_header() -> list:
+    header = [title for _, title in LEDGER_TEXT]
+    for kind, short in LEDGER_KINDS.items():
+        header += [f"{short}:{label}" for label in CHECK_CATALOGS[kind] if not label.startswith("その他")]
+        header.append(f"{short}:その他")
+    return header
+
+def _ledger_rows(company_id: str, date_from=None, date_to=None, location=None):
+    """Yield ledger rows (matching _ledger_header) newest first, straight from
+    the raw rows: check items are read off the bitmasks, not decoded to lists."""
+    bits = {kind: [1 << bit for bit, label in enumerate(CHECK_CATALOGS[kind]) if not label.startswith("その他")]
+            for kind in LEDGER_KINDS}
+    for rec in _iter_export_records(company_id, date_from, date_to, location, page_size=500, decode=False):
+        # None, not "": a write-only sheet skips empty cells entirely
+        row = [rec[key] or None for key, _ in LEDGER_TEXT]
+        row[1], row[2] = row[1][:19].replace("T", " "), row[2][:19].replace("T", " ")
+        for kind in LEDGER_KINDS:
+            mask = rec[f"{kind}_mask"] or 0
+            row += ["○" if mask & b else None for b in bits[kind]]
+            row.append(rec[f"{kind}_other"] or None)
+        yield row
+
+def _fts_query(text: str):
+    """Split free text into (FTS5 MATCH expression, short terms).
+
+    The trigram index only matches terms of 3+ characters; shorter ones
+    (e.g. 「本館」) are returned separately and filtered with LIKE.
+    """
+    phrases, short = [], []
+    for term in text.split():
+        if len(term) >= 3:
+            phrases.append('"' + term.replace('"', '""') + '"')
+        else:
+            short.append(term)
+    return " AND ".join(phrases), short
+
+@_instrumented
+def _search_records(company_id: str, text: str = "", date_from: date | None = None, date_to: date | None = None,
+                    after: tuple | None = None, limit: int = 30):
+    """One page of a company's history, newest first.
+
+    ``after`` is the (created_at, id) cursor of the previous page's last row.
+    Returns (rows, next cursor or None).
+    """
+    where, params = _export_filter_sql(company_id, date_from, date_to, None)
+    match, short = _fts_query(text or "")
+    if match:
+        where += " AND " + SQL_FTS_FILTER
+        params.append(match)
+    for term in short:
+        like = _like_pattern(term)
+        where += " AND (" + " OR ".join(f"{c} LIKE ? ESCAPE '\\'" for c in FTS_COLUMNS) + ")"
+        params += [like] * len(FTS_COLUMNS)
+    if after:
+        sql = SQL_SEARCH_PAGE.format(where=where, after=SQL_AFTER_CURSOR)
+        params += list(after)
+    else:
+        sql = SQL_SEARCH_PAGE.format(where=where, after="")
+    with _tenant_db(company_id) as con:
+        rows = [dict(r) for r in con.execute(sql, params + [limit + 1]).fetchall()]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]["created_at"], rows[-1]["id"])
+    return rows, None
+
+@_instrumented
+def _item_trend(company_id: str, kind: str, month_from: str, month_to: str, location: str | None = None):
+    """Monthly counts per check item (kind 'records' = KY count) from the rollup.
+    Returns [{"month": "YYYY-MM", "label": ..., "n": ...}]."""
+    params = [company_id, month_from, month_to, kind]
+    if location is not None:
+        params.append(location)
+    sql = SQL_ITEM_TREND.format(location=" AND location=?" if location is not None else "")
+    with _tenant_db(company_id) as con:
+        return [dict(r) for r in con.execute(sql, params).fetchall()]
+
+@_instrumented
+def _rollup_locations(company_id: str):
+    with _tenant_db(company_id) as con:
+        cur = con.execute(SQL_ROLLUP_LOCATIONS, (company_id,))
+        return [r["location"] for r in cur.fetchall()]
+
+# ---- Splitting the central DB into tenant files ----
+def _shard_split(finish: bool = False, batch_size: int = RETENTION_BATCH, pause: float = 0.05, progress=None) -> dict:
+    """Copy each company's records and name candidates from the central DB
+    into its tenant file; returns {company_id: (copied, removed)}.
+
+    The copy runs while the app keeps serving from the central DB: rows move
+    in short batches, and a re-run only copies rows updated since the
+    previous run started. ``finish`` is the cutover step and needs the app
+    stopped (see README), right before restarting with KY_SHARDING=1: it
+    copies everything not yet copied, checks that every central row is
+    present in its tenant file, then deletes only the rows whose tenant copy
+    is at least as new.
+    """
+    started = datetime.utcnow().isoformat()
+    with _db() as con:
+        row = con.execute("SELECT value FROM app_meta WHERE key='shard_split_last_run'").fetchone()
+        since = None if finish or row is None else row["value"]
+        companies = [r[0] for r in con.execute("SELECT company_id FROM companies ORDER BY company_id")]
+        columns = [r[1] for r in con.execute("PRAGMA table_info(ky_records)")]
+    result = {}
+    for cid in companies:
+        store = _tenant_pool(_tenant_path(cid))
+        copied = _copy_tenant_records(cid, store, columns, since, batch_size, pause)
+        _copy_tenant_candidates(cid, store)
+        removed = _remove_moved_records(cid, store, batch_size, pause) if finish else 0
+        store.close_idle()
+        result[cid] = (copied, removed)
+        if progress:
+            progress(cid, copied, removed)
+    with _db() as con, con:
+        con.execute("INSERT OR REPLACE INTO app_meta(key, value) VALUES ('shard_split_last_run', ?)", (started,))
+    if finish:
+        _incremental_vacuum(batch_size, pause)
+    return result
+
+def _copy_tenant_records(company_id: str, store: _ConnectionPool, columns: list, since: str | None,
+                         batch_size: int, pause: float) -> int:
+    # Upsert keeps the newer version, and fires the tenant's FTS/rollup/usage triggers.
+    upsert = (f"INSERT INTO ky_records({', '.join(columns)}) VALUES ({','.join('?' * len(columns))}) "
+              f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in columns if c != 'id')} "
+              "WHERE excluded.updated_at > ky_records.updated_at")
+    where, params = "company_id=?", [company_id]
+    if since:
+        where += " AND updated_at >= ?"
+        params.append(since)
+    copied, last = 0, None
+    while True:
+        after = SQL_AFTER_CURSOR if last else ""
+        with _db() as con:
+            rows = con.execute(SQL_EXPORT_PAGE.format(where=where, after=after),
+                               params + (list(last) if last else []) + [batch_size]).fetchall()
+        if not rows:
+            return copied
+        with store.connection() as con, con:
+            con.executemany(upsert, [tuple(r) for r in rows])
+        copied += len(rows)
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+        if len(rows) < batch_size:
+            return copied
+        time.sleep(pause)
+
+def _copy_tenant_candidates(company_id: str, store: _ConnectionPool):
+    with _db() as con:
+        rows = [tuple(r) for r in con.execute(
+            "SELECT company_id, name, use_count, last_used_at FROM name_candidates WHERE company_id=?", (company_id,))]
+    with store.connection() as con, con:
+        con.executemany("""
+        INSERT INTO name_candidates(company_id, name, use_count, last_used_at) VALUES (?,?,?,?)
+        ON CONFLICT(company_id, name) DO UPDATE SET use_count = max(use_count, excluded.use_count),
+          last_used_at = NULLIF(max(COALESCE(last_used_at, ''), COALESCE(excluded.last_used_at, '')), '')
+        """, rows)
+
+def _remove_moved_records(company_id: str, store: _ConnectionPool, batch_size: int, pause: float) -> int:
+    with _db() as con:
+        con.execute("ATTACH DATABASE ? AS tenant", (store.path,))
+        try:
+            missing = con.execute("""
+            SELECT COUNT(*) FROM ky_records c WHERE c.company_id=? AND NOT EXISTS (
+              SELECT 1 FROM tenant.ky_records t WHERE t.id = c.id AND t.updated_at >= c.updated_at)
+            """, (company_id,)).fetchone()[0]
+        finally:
+            con.execute("DETACH DATABASE tenant")
+    if missing:
+        raise RuntimeError(f"{company_id}: {missing} records are not in {store.path}; not removing them")
+    # Only rows whose copy is at least as new are deleted, checked in the
+    # DELETE itself: a row saved centrally after the check above stays put.
+    removed = 0
+    with _db() as con:
+        con.execute("ATTACH DATABASE ? AS tenant", (store.path,))
+        try:
+            while True:
+                with con:
+                    n = con.execute("""
+                    DELETE FROM ky_records WHERE rowid IN (
+                      SELECT c.rowid FROM ky_records c WHERE c.company_id=? AND EXISTS (
+                        SELECT 1 FROM tenant.ky_records t WHERE t.id = c.id AND t.updated_at >= c.updated_at)
+                      LIMIT ?)
+                    """, (company_id, batch_size)).rowcount
+                removed += n
+                if n < batch_size:
+                    break
+                time.sleep(pause)
+        finally:
+            con.execute("DETACH DATABASE tenant")
+        left = con.execute("SELECT COUNT(*) FROM ky_records WHERE company_id=?", (company_id,)).fetchone()[0]
+    if left:
+        raise RuntimeError(f"{company_id}: {left} records changed during --finish and were kept centrally; "
+                           "stop the app and run --finish again")
+    with _db() as con, con:
+        con.execute("DELETE FROM name_candidates WHERE company_id=?", (company_id,))
+    return removed
+
+@_instrumented
+def _admin_company_page(text: str = "", enabled: bool | None = None, offset: int = 0, limit: int = 50):
+    """One page of non-admin companies with their usage, and the total
+    number matching the filter (substring of ID or name, enabled state)."""
+    where, params = "", []
+    if text.strip():
+        where += " AND (c.company_id LIKE ? ESCAPE '\\' OR c.company_name LIKE ? ESCAPE '\\')"
+        params += [_like_pattern(text.strip())] * 2
+    if enabled is not None:
+        where += " AND c.is_enabled=?"
+        params.append(1 if enabled else 0)
+    with _db() as con:
+        rows = [dict(r) for r in con.execute(SQL_ADMIN_COMPANIES.format(where=where), params + [limit, offset])]
+        total = con.execute(f"SELECT COUNT(*) FROM companies c WHERE c.is_admin=0{where}", params).fetchone()[0]
+    if SHARDING:
+        # the central figures only cover rows not yet moved by shard-split
+        usage = {u["company_id"]: u for u in _fanout([r["company_id"] for r in rows], SQL_TENANT_USAGE)}
+        for r in rows:
+            u = usage.get(r["company_id"])
+            if u:
+                r["records"] += u["records"]
+                r["bytes"] += u["bytes"]
+                r["last_write_at"] = max(r["last_write_at"] or "", u["last_write_at"] or "") or None
+    return rows, total
+
+@_instrumented
+def _admin_set_enabled(company_ids: list, enabled: bool) -> int:
+    # One transaction for the whole selection; disabling also ends sessions.
+    with _db() as con, con:
+        n = con.execute("UPDATE companies SET is_enabled=? WHERE is_admin=0 AND company_id IN (SELECT value FROM json_each(?))",
+                        (1 if enabled else 0, json.dumps(company_ids))).rowcount
+        if not enabled:
+            _end_company_sessions(con, company_ids)
+    return n
+
+@_instrumented
+def _admin_reset_passwords(company_ids: list) -> dict:
+    """New random password per company (admin accounts excluded), stored in
+    one transaction; existing sessions end. Returns company_id -> password."""
+    import string
+    with _db() as con:
+        targets = [r[0] for r in con.execute(
+            "SELECT company_id FROM companies WHERE is_admin=0 AND company_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(company_ids),))]
+    if not targets:
+        return {}
     alphabet = string.ascii_letters + string.digits
-    new_pw = ''.join(secrets.choice(alphabet) for _ in range(18))
-    pw_hash = bcrypt.hashpw(new_pw.encode("utf-8"), bcrypt.gensalt())
-    con = _connect()
-    cur = con.cursor()
-    cur.execute("UPDATE companies SET password_hash=? WHERE company_id=? AND is_admin=0", (pw_hash, company_id))
-    con.commit()
-    con.close()
+    new_pw = {cid: "".join(secrets.choice(alphabet) for _ in range(18)) for cid in targets}
+    # bcrypt releases the GIL, so the batch hashes in parallel; it gets its
+    # own pool so logins are not queued behind it on the shared one, capped
+    # at KY_BCRYPT_WORKERS like that one. Hashing is not DB time.
+    with ThreadPoolExecutor(max_workers=min(len(new_pw), BCRYPT_WORKERS), thread_name_prefix="ky-bcrypt-batch") as pool, \
+            _get_metrics().excluded("bcrypt"):
+        hashes = list(pool.map(_hashpw, new_pw.values()))
+    with _db() as con, con:
+        con.executemany("UPDATE companies SET password_hash=? WHERE company_id=? AND is_admin=0", zip(hashes, new_pw))
+        _end_company_sessions(con, targets)
     return new_pw
 
 def _prefix_check(text: str, checked: bool):
@@ -324,86 +2592,571 @@ def _inject_other(base_text: str, detail: str):
         return f"{pre}（{detail}）{post}"
     return base_text + f"（{detail}）"
 
-def _render_excel(record: dict) -> bytes:
-    wb = load_workbook(TEMPLATE_PATH)
-    ws = wb["安全指示ＫＹ記録書"]
+SHEET_NAME = "安全指示ＫＹ記録書"
+
+def _excel_values(record: dict, template_value) -> dict:
+    """Cell -> value for one record. ``template_value(cell)`` returns the
+    template's own text, which check-item cells are built from."""
+    values = {}
 
     # Fill basics
-    ws[CELL["work_title"]] = record.get("work_title","")
-    ws[CELL["work_company"]] = record.get("work_company","")
-    ws[CELL["phone"]] = record.get("phone","")
-    ws[CELL["work_date"]] = record.get("work_date","")
-    ws[CELL["start_time"]] = record.get("start_time","")
-    ws[CELL["end_time"]] = record.get("end_time","")
-    ws[CELL["location"]] = record.get("location","")
-    ws[CELL["people_count"]] = record.get("people_count","")
+    values[CELL["work_title"]] = record.get("work_title","")
+    values[CELL["work_company"]] = record.get("work_company","")
+    values[CELL["phone"]] = record.get("phone","")
+    values[CELL["work_date"]] = record.get("work_date","")
+    values[CELL["start_time"]] = record.get("start_time","")
+    values[CELL["end_time"]] = record.get("end_time","")
+    values[CELL["location"]] = record.get("location","")
+    values[CELL["people_count"]] = record.get("people_count","")
 
     # Work content split into two lines (template has two merged rows)
     content = (record.get("work_content") or "").strip()
     lines = content.splitlines()
     if len(lines) == 0:
-        ws[CELL["work_content_1"]] = ""
-        ws[CELL["work_content_2"]] = ""
+        values[CELL["work_content_1"]] = ""
+        values[CELL["work_content_2"]] = ""
     elif len(lines) == 1:
-        ws[CELL["work_content_1"]] = lines[0]
-        ws[CELL["work_content_2"]] = ""
+        values[CELL["work_content_1"]] = lines[0]
+        values[CELL["work_content_2"]] = ""
     else:
-        ws[CELL["work_content_1"]] = lines[0]
-        ws[CELL["work_content_2"]] = "\n".join(lines[1:])
+        values[CELL["work_content_1"]] = lines[0]
+        values[CELL["work_content_2"]] = "\n".join(lines[1:])
 
     # Focus instructions
-    focus = record.get("focus_instructions","").strip()
+    focus = (record.get("focus_instructions") or "").strip()
     # always include inputter name for audit
-    inputter = record.get("inputter_name","").strip()
+    inputter = (record.get("inputter_name") or "").strip()
     if inputter:
         focus = (focus + "\n" if focus else "") + f"【入力者】{inputter}"
-    ws[CELL["focus_instructions"]] = focus
+    values[CELL["focus_instructions"]] = focus
 
     # Notes
-    ws[CELL["notes"]] = (record.get("notes") or "").strip()
+    values[CELL["notes"]] = (record.get("notes") or "").strip()
 
     # Apply check items by prefixing ✓
-    hazards_selected = set(record.get("hazards") or [])
-    hazards_other = (record.get("hazards_other") or "").strip()
-
-    for label, cell in HAZARD_ITEMS.items():
-        base = ws[cell].value or ""
-        if label.startswith("その他"):
-            if hazards_other:
-                ws[cell] = _prefix_check(_inject_other(base, hazards_other), True)
-            else:
-                ws[cell] = _prefix_check(base, False)
-        else:
-            ws[cell] = _prefix_check(base, label in hazards_selected)
-
-    avoid_selected = set(record.get("avoid") or [])
-    avoid_other = (record.get("avoid_other") or "").strip()
-    for label, cell in AVOID_ITEMS.items():
-        base = ws[cell].value or ""
-        if label.startswith("その他"):
-            if avoid_other:
-                ws[cell] = _prefix_check(_inject_other(base, avoid_other), True)
-            else:
-                ws[cell] = _prefix_check(base, False)
-        else:
-            ws[cell] = _prefix_check(base, label in avoid_selected)
-
-    finish_selected = set(record.get("finish") or [])
-    finish_other = (record.get("finish_other") or "").strip()
-    for label, cell in FINISH_ITEMS.items():
-        base = ws[cell].value or ""
-        if label.startswith("その他"):
-            if finish_other:
-                ws[cell] = _prefix_check(_inject_other(base, finish_other), True)
+    for items, key in ((HAZARD_ITEMS, "hazards"), (AVOID_ITEMS, "avoid"), (FINISH_ITEMS, "finish")):
+        selected = set(record.get(key) or [])
+        other = (record.get(f"{key}_other") or "").strip()
+        for label, cell in items.items():
+            base = template_value(cell) or ""
+            if label.startswith("その他"):
+                if other:
+                    values[cell] = _prefix_check(_inject_other(base, other), True)
+                else:
+                    values[cell] = _prefix_check(base, False)
             else:
-                ws[cell] = _prefix_check(base, False)
-        else:
-            ws[cell] = _prefix_check(base, label in finish_selected)
+                values[cell] = _prefix_check(base, label in selected)
 
+    return values
+
+@_instrumented
+def _render_excel(record: dict) -> bytes:
+    # Reference renderer: full openpyxl load/save. Exports use
+    # _render_excel_fast, which must produce the same cell values.
+    from openpyxl import load_workbook
+    wb = load_workbook(TEMPLATE_PATH)
+    ws = wb[SHEET_NAME]
+    for cell, value in _excel_values(record, lambda c: ws[c].value).items():
+        ws[cell] = value
     buf = io.BytesIO()
     wb.save(buf)
     return buf.getvalue()
 
+# ---- Fast-path renderer: patch the sheet XML of the template zip ----
+_XML_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+class _ExcelTemplate:
+    """The template workbook, pre-split around the cells we write.
+
+    Unchanged zip members are kept as one prebuilt archive; rendering appends
+    the patched sheet to a copy of it, so their compressed bytes are reused
+    as-is instead of being re-parsed and re-serialized.
+    """
+
+    def __init__(self, path: str):
+        with zipfile.ZipFile(path) as z:
+            members = [(info, z.read(info)) for info in z.infolist()]
+        data = {info.filename: raw for info, raw in members}
+        self.sheet_path = self._sheet_path(data, SHEET_NAME)
+        strings = self._shared_strings(data)
+        xml = data[self.sheet_path].decode("utf-8")
+
+        cells = list(CELL.values()) + list(HAZARD_ITEMS.values()) + list(AVOID_ITEMS.values()) + list(FINISH_ITEMS.values())
+        spans = []
+        self.template_values = {}
+        for ref in cells:
+            m = re.search(f'<c r="{ref}"(?P<attrs>[^>]*?)(?:/>|>(?P<body>.*?)</c>)', xml)
+            if m is None:
+                raise KeyError(f"cell {ref} is not present in {self.sheet_path}")
+            attrs = re.sub(r'\s+t="[^"]*"', "", m.group("attrs"))
+            spans.append((m.start(), m.end(), ref, attrs))
+            self.template_values[ref] = self._cell_text(m.group("attrs"), m.group("body") or "", strings)
+        spans.sort()
+        self._chunks, self._slots = [], []
+        pos = 0
+        for start, end, ref, attrs in spans:
+            self._chunks.append(xml[pos:start])
+            self._slots.append((ref, attrs))
+            pos = end
+        self._chunks.append(xml[pos:])
+
+        # openpyxl saves with fullCalcOnLoad; do the same so the report
+        # section's formulas pick up the new values when the file is opened.
+        wb_xml = data["xl/workbook.xml"].decode("utf-8")
+        wb_xml = re.sub(r'\s+fullCalcOnLoad="[^"]*"', "", wb_xml)
+        wb_xml = re.sub(r"<calcPr\b", '<calcPr fullCalcOnLoad="1"', wb_xml, count=1)
+        data["xl/workbook.xml"] = wb_xml.encode("utf-8")
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as out:
+            for info, _ in members:
+                if info.filename != self.sheet_path:
+                    out.writestr(info, data[info.filename], compress_type=zipfile.ZIP_DEFLATED)
+        self._base = buf.getvalue()
+        self._sheet_date = next(info.date_time for info, _ in members if info.filename == self.sheet_path)
+
+    @staticmethod
+    def _sheet_path(data: dict, name: str) -> str:
+        wb = ET.fromstring(data["xl/workbook.xml"])
+        rels = ET.fromstring(data["xl/_rels/workbook.xml.rels"])
+        targets = {r.get("Id"): r.get("Target") for r in rels}
+        for sh in wb.iter(f"{_NS_MAIN}sheet"):
+            if sh.get("name") == name:
+                target = targets[sh.get(f"{_NS_REL}id")]
+                return target.lstrip("/") if target.startswith("/") else "xl/" + target
+        raise KeyError(f"sheet {name!r} not found in template")
+
+    @staticmethod
+    def _shared_strings(data: dict) -> list:
+        raw = data.get("xl/sharedStrings.xml")
+        if raw is None:
+            return []
+        # plain <t> or rich-text runs <r><t>; phonetic guides (<rPh>) are not part of the value
+        return [
+            "".join(t.text or "" for t in si.findall(f"{_NS_MAIN}t") + si.findall(f"{_NS_MAIN}r/{_NS_MAIN}t"))
+            for si in ET.fromstring(raw).iter(f"{_NS_MAIN}si")
+        ]
+
+    @staticmethod
+    def _cell_text(attrs: str, body: str, strings: list):
+        t = re.search(r'\bt="([^"]*)"', attrs)
+        t = t.group(1) if t else "n"
+        if t == "inlineStr":
+            return "".join(html.unescape(x) for x in re.findall(r"<t[^>]*>(.*?)</t>", body, re.S))
+        v = re.search(r"<v>(.*?)</v>", body, re.S)
+        if v is None:
+            return None
+        if t == "s":
+            return strings[int(v.group(1))]
+        return html.unescape(v.group(1))
+
+    @classmethod
+    def read_cells(cls, raw: bytes, refs) -> dict:
+        """Cell -> text for ``refs`` in a filled-in copy of the template
+        (bulk import); empty cells are left out."""
+        with zipfile.ZipFile(io.BytesIO(raw)) as z:
+            names = set(z.namelist())
+            data = {n: z.read(n) for n in ("xl/workbook.xml", "xl/_rels/workbook.xml.rels", "xl/sharedStrings.xml")
+                    if n in names}
+            xml = z.read(cls._sheet_path(data, SHEET_NAME)).decode("utf-8")
+        strings = cls._shared_strings(data)
+        values = {}
+        for m in re.finditer(r'<c r="(?P<ref>[A-Z]+[0-9]+)"(?P<attrs>[^>]*?)(?:/>|>(?P<body>.*?)</c>)', xml, re.S):
+            if m.group("ref") in refs:
+                text = cls._cell_text(m.group("attrs"), m.group("body") or "", strings)
+                if text:
+                    values[m.group("ref")] = text
+        return values
+
+    @staticmethod
+    def _cell_xml(ref: str, attrs: str, value) -> str:
+        if value is None or value == "":
+            return f'<c r="{ref}"{attrs}/>'
+        text = xml_escape(_XML_ILLEGAL_RE.sub("", str(value)))
+        return f'<c r="{ref}"{attrs} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+    def render(self, values: dict) -> bytes:
+        parts = [self._chunks[0]]
+        for (ref, attrs), chunk in zip(self._slots, self._chunks[1:]):
+            parts.append(self._cell_xml(ref, attrs, values.get(ref, self.template_values[ref])))
+            parts.append(chunk)
+        # ZipInfo is filled in by writestr, so each render needs its own
+        info = zipfile.ZipInfo(self.sheet_path, date_time=self._sheet_date)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        buf = io.BytesIO(self._base)
+        with zipfile.ZipFile(buf, "a") as out:
+            out.writestr(info, "".join(parts).encode("utf-8"))
+        return buf.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def _excel_template(path: str):
+    try:
+        return _ExcelTemplate(path)
+    except (KeyError, ValueError, ET.ParseError, zipfile.BadZipFile) as e:
+        log.warning("fast Excel renderer disabled for %s: %s", path, e)
+        return None
+
+@_instrumented
+def _render_excel_fast(record: dict) -> bytes:
+    tpl = _excel_template(TEMPLATE_PATH)
+    if tpl is None:
+        return _render_excel(record)
+    return tpl.render(_excel_values(record, tpl.template_values.get))
+
+# ---- Rendered .xlsx cache ----
+class _XlsxCache:
+    """Rendered .xlsx files on disk, least recently used evicted first.
+
+    A file is named by its record id plus a digest of the record's
+    updated_at and the template's hash, so an edited record or a new
+    template can never be served a stale file; discard() only frees the
+    space early. A hit refreshes the file's mtime, which is the LRU order.
+    """
+
+    def __init__(self, root: str, max_bytes: int, template_path: str):
+        self.root = root
+        self.max_bytes = max_bytes
+        with open(template_path, "rb") as f:
+            self.template_hash = hashlib.sha256(f.read()).hexdigest()
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def _record_key(record_id: str) -> str:
+        # ids may come from imports, so never use them as path components
+        return hashlib.sha256(record_id.encode("utf-8")).hexdigest()[:24]
+
+    def _path(self, record_id: str, updated_at: str) -> str:
+        key = self._record_key(record_id)
+        digest = hashlib.sha256(f"{updated_at}\0{self.template_hash}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.root, key[:2], f"{key}-{digest}.xlsx")
+
+    def _entries(self):
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for e in os.scandir(shard.path):
+                if e.name.endswith(".xlsx"):
+                    try:
+                        info = e.stat()
+                    except FileNotFoundError:  # evicted by another process meanwhile
+                        continue
+                    yield e.path, info.st_mtime, info.st_size
+
+    def get(self, record_id: str, updated_at: str) -> bytes | None:
+        path = self._path(record_id, updated_at)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, record_id: str, updated_at: str, data: bytes):
+        path = self._path(record_id, updated_at)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        # Rescan rather than trust the running total: other processes share the directory.
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[1])
+            total = sum(size for _, _, size in entries)
+            target = self.max_bytes * 0.9
+            for path, _, size in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def discard(self, record_ids):
+        by_shard = {}
+        for rid in record_ids:
+            key = self._record_key(rid)
+            by_shard.setdefault(key[:2], set()).add(key)
+        freed = 0
+        for shard, keys in by_shard.items():
+            try:
+                entries = list(os.scandir(os.path.join(self.root, shard)))
+            except FileNotFoundError:
+                continue
+            for e in entries:
+                if e.name.split("-", 1)[0] in keys:
+                    try:
+                        freed += e.stat().st_size
+                        os.remove(e.path)
+                    except FileNotFoundError:
+                        pass
+        with self._lock:
+            self._size -= freed
+
+@st.cache_resource(show_spinner=False)
+def _xlsx_cache(root: str, max_bytes: int, template_path: str):
+    if max_bytes <= 0:
+        return None
+    try:
+        return _XlsxCache(root, max_bytes, template_path)
+    except OSError as e:
+        log.warning("xlsx cache disabled (%s): %s", root, e)
+        return None
+
+def _get_xlsx_cache() -> _XlsxCache | None:
+    root = XLSX_CACHE_DIR or os.path.join(os.path.dirname(DB_PATH) or ".", "xlsx_cache")
+    key = ("xlsx_cache", root)
+    if key not in _resolved:
+        _resolved[key] = _xlsx_cache(root, int(XLSX_CACHE_MB * 1024 * 1024), TEMPLATE_PATH)
+    return _resolved[key]
+
+def _discard_xlsx(record_ids):
+    cache = _get_xlsx_cache()
+    if cache is not None and record_ids:
+        cache.discard(record_ids)
+
+@_instrumented
+def _record_xlsx(company_id: str, record_id: str, updated_at: str, record: dict | None = None) -> bytes | None:
+    """The record's .xlsx, from the cache when this version was rendered
+    before. ``record`` saves a reload when the caller already has it."""
+    cache = _get_xlsx_cache()
+    if cache is not None:
+        data = cache.get(record_id, updated_at)
+        if data is not None:
+            return data
+    if record is None:
+        record = _load_record(company_id, record_id, updated_at)
+        if record is None:
+            return None
+    data = _render_excel_fast(record)
+    if cache is not None:
+        try:
+            cache.put(record_id, record["updated_at"], data)
+        except OSError as e:
+            log.warning("xlsx cache write failed: %s", e)
+    return data
+
+# ---- Background export jobs ----
+class ExportQueueFull(Exception):
+    """The company already has EXPORT_QUEUE_PER_COMPANY jobs waiting or running."""
+
+def _export_dir() -> str:
+    return EXPORT_DIR or os.path.join(os.path.dirname(DB_PATH) or ".", "exports")
+
+def _export_result_path(job_id: str) -> str:
+    return os.path.join(_export_dir(), job_id)
+
+@_instrumented
+def _enqueue_export(company_id: str, kind: str, params: dict) -> str:
+    """Queue a 'single' ({"record_id"}), 'bulk' ({"date_from", "date_to",
+    "location"}) or 'ledger' (as bulk, plus "format": xlsx|csv) export and
+    return the job id."""
+    now = datetime.utcnow().isoformat()
+    job_id = _new_id()
+    with _db() as con:
+        con.execute("BEGIN IMMEDIATE")
+        pending = con.execute(
+            "SELECT COUNT(*) FROM export_jobs WHERE company_id=? AND status IN ('queued','running')", (company_id,)
+        ).fetchone()[0]
+        if pending >= EXPORT_QUEUE_PER_COMPANY:
+            con.rollback()
+            raise ExportQueueFull(company_id)
+        con.execute("""
+        INSERT INTO export_jobs(id, company_id, kind, params, status, not_before, created_at)
+        VALUES (?,?,?,?, 'queued', ?, ?)
+        """, (job_id, company_id, kind, json.dumps(params, ensure_ascii=False), now, now))
+        con.commit()
+    _export_wakeup().set()
+    return job_id
+
+@_instrumented
+def _export_job(company_id: str, job_id: str):
+    with _db() as con:
+        row = con.execute("SELECT * FROM export_jobs WHERE id=? AND company_id=?", (job_id, company_id)).fetchone()
+    return dict(row) if row else None
+
+@_instrumented
+def _recent_export_jobs(company_id: str, limit: int = 10) -> list:
+    with _db() as con:
+        return [dict(r) for r in con.execute(SQL_RECENT_EXPORT_JOBS, (company_id, limit)).fetchall()]
+
+def _export_job_data(job: dict) -> bytes | None:
+    try:
+        with open(_export_result_path(job["id"]), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _wait_export_job(company_id: str, job_id: str, timeout: float):
+    # Single exports usually finish in milliseconds; wait briefly so the
+    # download can be offered right away instead of after the next poll.
+    deadline = time.monotonic() + timeout
+    while True:
+        job = _export_job(company_id, job_id)
+        if job is None or job["status"] in ("done", "failed") or time.monotonic() >= deadline:
+            return job
+        time.sleep(0.05)
+
+@_instrumented
+def _set_export_progress(job_id: str, done: int):
+    with _db() as con, con:
+        con.execute("UPDATE export_jobs SET progress=?, heartbeat_at=? WHERE id=?",
+                    (done, datetime.utcnow().isoformat(), job_id))
+
+@_instrumented
+def _run_export_job(job: dict) -> tuple[str, int]:
+    """Render the job's output into its result file; return (download name, record count)."""
+    params = json.loads(job["params"])
+    company_id = job["company_id"]
+    path = _export_result_path(job["id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    if job["kind"] == "single":
+        record = _load_record(company_id, params["record_id"], params.get("updated_at"))
+        if record is None:
+            raise LookupError("記録が見つかりません（削除された可能性があります）")
+        data = _record_xlsx(company_id, record["id"], record["updated_at"], record)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        name, count = ky_export.member_name(record), 1
+    elif job["kind"] in ("bulk", "ledger"):
+        date_from = date.fromisoformat(params["date_from"]) if params.get("date_from") else None
+        date_to = date.fromisoformat(params["date_to"]) if params.get("date_to") else None
+        location = params.get("location")
+        with _db() as con, con:
+            con.execute("UPDATE export_jobs SET total=? WHERE id=?",
+                        (_count_export_records(company_id, date_from, date_to, location), job["id"]))
+        every = 50 if job["kind"] == "bulk" else 1000
+        def progress(n):
+            if n % every == 0:
+                _set_export_progress(job["id"], n)
+        span = "-".join(d.strftime("%Y%m%d") if d else "" for d in (date_from, date_to)) if date_from or date_to else "all"
+        with open(tmp, "wb") as f:
+            if job["kind"] == "bulk":
+                count = ky_export.write_zip(_iter_export_records(company_id, date_from, date_to, location),
+                                            f, _render_excel_fast, workers=EXPORT_WORKERS, progress=progress)
+                name = f"KY_{company_id}_{span}.zip"
+            else:
+                fmt = params.get("format", "xlsx")
+                write = ky_export.write_ledger_csv if fmt == "csv" else ky_export.write_ledger_xlsx
+                count = write(_ledger_header(), _ledger_rows(company_id, date_from, date_to, location), f,
+                              progress=progress)
+                name = f"KY台帳_{company_id}_{span}.{'csv' if fmt == 'csv' else 'xlsx'}"
+    else:
+        raise ValueError(f"unknown export kind {job['kind']!r}")
+    os.replace(tmp, path)
+    return name, count
+
+def _process_export_job(job: dict):
+    now = datetime.utcnow()
+    try:
+        name, count = _run_export_job(job)
+    except Exception as e:
+        log.exception("export job %s failed (attempt %d)", job["id"], job["attempts"])
+        try:
+            os.remove(_export_result_path(job["id"]) + ".tmp")
+        except FileNotFoundError:
+            pass
+        retry = job["attempts"] < EXPORT_JOB_ATTEMPTS and not isinstance(e, LookupError)
+        with _db() as con, con:
+            if retry:
+                # exponential backoff: 2s, 4s, ...
+                not_before = (now + timedelta(seconds=2 ** job["attempts"])).isoformat()
+                con.execute("UPDATE export_jobs SET status='queued', not_before=?, error=? WHERE id=?",
+                            (not_before, str(e), job["id"]))
+            else:
+                con.execute("UPDATE export_jobs SET status='failed', finished_at=?, error=? WHERE id=?",
+                            (datetime.utcnow().isoformat(), str(e), job["id"]))
+        return
+    size = os.path.getsize(_export_result_path(job["id"]))
+    with _db() as con, con:
+        con.execute("""
+        UPDATE export_jobs SET status='done', finished_at=?, progress=?, total=?, result_name=?, result_size=?
+        WHERE id=?""", (datetime.utcnow().isoformat(), count, count, name, size, job["id"]))
+
+@_instrumented
+def _claim_export_job():
+    now = datetime.utcnow().isoformat()
+    with _db() as con, con:
+        row = con.execute(SQL_CLAIM_EXPORT_JOB, (now, now, now, EXPORT_JOBS_PER_COMPANY)).fetchone()
+    return dict(row) if row else None
+
+@_instrumented
+def _requeue_stale_export_jobs(stale_minutes: float = 15):
+    # A running job whose worker has not reported progress for this long
+    # belonged to a process that died (a live one reports every few seconds,
+    # however long the export); the attempt counts towards EXPORT_JOB_ATTEMPTS.
+    cutoff = (datetime.utcnow() - timedelta(minutes=stale_minutes)).isoformat()
+    with _db() as con, con:
+        con.execute("""
+        UPDATE export_jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END,
+          error='処理が中断されました'
+        WHERE status='running' AND heartbeat_at < ?""", (EXPORT_JOB_ATTEMPTS, cutoff))
+
+@_instrumented
+def _purge_export_jobs():
+    cutoff = (datetime.utcnow() - timedelta(hours=EXPORT_KEEP_HOURS)).isoformat()
+    with _db() as con, con:
+        ids = [r[0] for r in con.execute(
+            "DELETE FROM export_jobs WHERE status IN ('done','failed') AND created_at < ? RETURNING id", (cutoff,)
+        ).fetchall()]
+    for job_id in ids:
+        try:
+            os.remove(_export_result_path(job_id))
+        except FileNotFoundError:
+            pass
+
+def _export_worker_loop(wake: threading.Event):
+    last_sweep = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_sweep > 60:
+                last_sweep = time.monotonic()
+                _requeue_stale_export_jobs()
+            job = _claim_export_job()
+            if job is not None:
+                _process_export_job(job)
+                continue
+        except Exception:
+            log.exception("export worker error")
+        # poll as well: jobs may be queued by another process or wait on backoff
+        wake.wait(1.0)
+        wake.clear()
+
+@st.cache_resource(show_spinner=False)
+def _export_wakeup():
+    return threading.Event()
+
+@st.cache_resource(show_spinner=False)
+def _start_export_workers(db_path: str):
+    wake = _export_wakeup()
+    threads = [threading.Thread(target=_export_worker_loop, args=(wake,), name=f"ky-export-{i}", daemon=True)
+               for i in range(EXPORT_JOB_WORKERS)]
+    for t in threads:
+        t.start()
+    return threads
+
+def _rerun_fragment():
+    # Rerun just the calling view. scope="fragment" is only allowed while the
+    # fragment itself is rerunning, not when it runs as part of a full run.
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
 def _login_view():
     st.subheader("ログイン")
     with st.form("login"):
@@ -411,140 +3164,619 @@ def _login_view():
         password = st.text_input("パスワード", type="password", autocomplete="current-password")
         ok = st.form_submit_button("ログイン")
     if ok:
-        user, err = _verify_login(company_id.strip(), password)
+        _bootstrap(DB_PATH)
+        user, err = _verify_login(company_id.strip(), password, _client_ip())
         if err:
             st.error(err)
             return
         st.session_state["auth"] = user
+        # The token in the URL lets a reload resume without another bcrypt
+        # check. It is a bearer token in plain sight (see SESSION_HOURS), so
+        # it is replaced on each resume and expires after KY_SESSION_HOURS.
+        st.query_params["sid"] = _create_session(user["company_id"])
         st.success("ログインしました。")
         st.rerun()
 
 def _logout_button():
     if st.button("ログアウト"):
-        st.session_state.pop("auth", None)
+        for key in ("auth", "editing_id", "draft", "draft_of"):
+            st.session_state.pop(key, None)
+        token = st.query_params.get("sid")
+        if token:
+            _end_session(token)
+            del st.query_params["sid"]
         st.rerun()
 
+ADMIN_PAGE_SIZE = 50
+
+def _fmt_bytes(n: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}"
+        n /= 1024
+    return f"{n:.1f}GB"
+
+@st.fragment
 def _admin_panel():
-    st.divider()
     st.subheader("管理者メニュー")
-    st.caption("会社アカウントの停止/再開、パスワード再発行ができます。")
+    st.caption("会社アカウントの停止/再開、パスワード再発行ができます。表で選択した会社にまとめて実行します。")
 
-    companies = _admin_list_companies()
-    for c in companies:
-        if c["is_admin"] == 1:
-            continue
-        col1, col2, col3, col4 = st.columns([3,2,2,3])
-        with col1:
-            st.write(f"**{c['company_name']}**  (`{c['company_id']}`)")
-            st.caption("有効" if c["is_enabled"]==1 else "停止中")
-        with col2:
-            if c["is_enabled"]==1:
-                if st.button("停止", key=f"disable_{c['company_id']}"):
-                    _admin_set_enabled(c["company_id"], False)
-                    st.rerun()
-            else:
-                if st.button("再開", key=f"enable_{c['company_id']}"):
-                    _admin_set_enabled(c["company_id"], True)
-                    st.rerun()
-        with col3:
-            if st.button("PW再発行", key=f"reset_{c['company_id']}"):
-                new_pw = _admin_reset_password(c["company_id"])
-                st.session_state[f"newpw_{c['company_id']}"] = new_pw
-        with col4:
-            new_pw = st.session_state.get(f"newpw_{c['company_id']}")
-            if new_pw:
-                st.warning(f"新PW（1回表示）: `{new_pw}`")
-                st.caption("必ず控えてから画面更新してください。")
-    st.divider()
+    c1, c2 = st.columns([3, 1])
+    with c1:
+        text = st.text_input("会社ID・会社名で絞り込み", key="admin_q")
+    with c2:
+        state = st.selectbox("状態", ["すべて", "有効", "停止中"], key="admin_state")
+    enabled = {"すべて": None, "有効": True, "停止中": False}[state]
+    filt = (text.strip(), state)
+    if st.session_state.get("admin_filter") != filt:
+        st.session_state["admin_filter"] = filt
+        st.session_state["admin_offset"] = 0
+    offset = st.session_state["admin_offset"]
+
+    rows, total = _admin_company_page(text, enabled, offset, ADMIN_PAGE_SIZE)
+    table = [{"選択": False, "会社ID": r["company_id"], "会社名": r["company_name"],
+              "状態": "有効" if r["is_enabled"] == 1 else "停止中", "KY件数": r["records"],
+              "最終更新": (r["last_write_at"] or "")[:16].replace("T", " "), "データ量": _fmt_bytes(r["bytes"])}
+             for r in rows]
+    edited = st.data_editor(table, hide_index=True, use_container_width=True,
+                            disabled=["会社ID", "会社名", "状態", "KY件数", "最終更新", "データ量"],
+                            key=f"admin_table_{offset}_{filt}")
+    selected = [r["会社ID"] for r in edited if r["選択"]]
+
+    nav1, nav2, nav3 = st.columns([1, 2, 1])
+    with nav1:
+        if offset > 0 and st.button("← 前へ", key="admin_prev"):
+            st.session_state["admin_offset"] = max(0, offset - ADMIN_PAGE_SIZE)
+            _rerun_fragment()
+    with nav2:
+        st.caption(f"{total}社中 {offset + 1 if total else 0}〜{min(offset + ADMIN_PAGE_SIZE, total)}社")
+    with nav3:
+        if offset + ADMIN_PAGE_SIZE < total and st.button("次へ →", key="admin_next"):
+            st.session_state["admin_offset"] = offset + ADMIN_PAGE_SIZE
+            _rerun_fragment()
+
+    b1, b2, b3 = st.columns(3)
+    with b1:
+        if st.button(f"停止（{len(selected)}社）", key="admin_disable", disabled=not selected):
+            _admin_set_enabled(selected, False)
+            _rerun_fragment()
+    with b2:
+        if st.button(f"再開（{len(selected)}社）", key="admin_enable", disabled=not selected):
+            _admin_set_enabled(selected, True)
+            _rerun_fragment()
+    with b3:
+        if st.button(f"PW再発行（{len(selected)}社）", key="admin_reset", disabled=not selected):
+            with st.spinner("パスワードを再発行しています…"):
+                st.session_state["admin_new_pw"] = _admin_reset_passwords(selected)
+
+    new_pw = st.session_state.get("admin_new_pw")
+    if new_pw:
+        st.warning("新しいパスワード（この画面でのみ表示）。必ず控えてから閉じてください。")
+        st.dataframe([{"会社ID": cid, "新PW": pw} for cid, pw in new_pw.items()], hide_index=True, use_container_width=True)
+        d1, d2 = st.columns(2)
+        with d1:
+            csv_text = "company_id,password\n" + "".join(f"{cid},{pw}\n" for cid, pw in new_pw.items())
+            st.download_button("CSVでダウンロード", data=csv_text, file_name="ky_new_passwords.csv",
+                               mime="text/csv", key="admin_pw_csv")
+        with d2:
+            if st.button("閉じる", key="admin_pw_close"):
+                st.session_state.pop("admin_new_pw", None)
+                _rerun_fragment()
+
+    _import_panel()
+    _metrics_panel()
+
+def _company_select(label: str, key: str, first: dict | None = None):
+    """Selectbox over one page of companies matching a search box, so the
+    admin screens never load every company. ``first`` (e.g. the admin's own
+    company) is always offered at the top."""
+    text = st.text_input("会社ID・会社名で検索", key=f"{key}_q")
+    rows, total = _admin_company_page(text, limit=ADMIN_PAGE_SIZE)
+    names = {c["company_id"]: f"{c['company_name']} ({c['company_id']})" for c in [first] * bool(first) + rows}
+    if total > len(rows):
+        st.caption(f"該当{total}社のうち{len(rows)}社を表示しています。見つからない場合は絞り込んでください。")
+    if not names:
+        st.caption("該当する会社がありません。")
+        return None
+    # keep the choice while it is still among the matches
+    if st.session_state.get(key) in names:
+        st.session_state[key] = st.session_state[key]
+    else:
+        st.session_state.pop(key, None)
+    return st.selectbox(label, options=list(names), format_func=names.get, key=key)
+
+def _import_panel():
+    with st.expander("KYデータ一括取込"):
+        st.caption("CSV・JSONL・記入済みのKY記録書（.xlsx、またはそのZIP）から過去のKYを取り込みます。"
+                   "同じ内容の記録は重複として読み飛ばすため、同じファイルを再度取り込んでも増えません。")
+        company_id = _company_select("取込先の会社", "import_company")
+        if company_id is None:
+            return
+        files = st.file_uploader("ファイル", type=["csv", "jsonl", "xlsx", "zip"], accept_multiple_files=True,
+                                 key="import_files")
+        dry_run = st.checkbox("確認のみ（取り込まない）", value=True, key="import_dry_run")
+        if st.button("取込", key="import_run", disabled=not files):
+            rows = (row for f in files for row in _import_rows(f, f.name))
+            with st.spinner("取り込んでいます…"):
+                try:
+                    report = _import_records(company_id, rows, dry_run=dry_run)
+                except sqlite3.OperationalError:
+                    log.exception("import failed")
+                    st.error("データベースが混み合っています。しばらくしてから再度お試しください。")
+                    return
+            verb = "取込可能" if dry_run else "取込"
+            st.success(f"読込 {report['read']}件 / {verb} {report['inserted']}件 / 重複 {report['duplicates']}件 / エラー {len(report['errors'])}件")
+            if report["errors"]:
+                st.dataframe([{"場所": src, "内容": msg} for src, msg in report["errors"][:200]],
+                             hide_index=True, use_container_width=True)
+
+def _metrics_panel():
+    with st.expander("処理時間・遅いクエリ"):
+        m = _get_metrics()
+        rows = m.snapshot()
+        if not rows:
+            st.caption("まだ計測データがありません。")
+            return
+        st.caption(f"プロセス起動以降の処理ごとの件数と、直近の処理時間（ms）です。{SLOW_OP_MS:g}ms以上を遅い処理として記録します。")
+        st.dataframe([{"処理": r["op"], "件数": r["count"], "p50": round(r["p50_ms"], 1),
+                       "p95": round(r["p95_ms"], 1), "p99": round(r["p99_ms"], 1), "最大": round(r["max_ms"], 1)}
+                      for r in rows], hide_index=True, use_container_width=True)
+        st.download_button("Prometheus形式でダウンロード", data=m.prometheus(), file_name="ky_metrics.prom",
+                           mime="text/plain", key="metrics_download")
+        slow = sorted(m.slow, key=lambda e: e["ms"], reverse=True)[:10]
+        if not slow:
+            st.caption("遅い処理はまだ記録されていません。")
+        for e in slow:
+            st.markdown(f"**{e['op']}** — {e['ms']:.0f}ms（{e['at']} UTC）")
+            for sql in e["sql"][:5]:
+                st.code(sql, language="sql")
+                plan = _explain_sql(sql)
+                if plan:
+                    st.caption("PLAN: " + " / ".join(plan))
+
+BULK_FORMATS = {"zip": "1件1ファイル（ZIP）", "xlsx": "台帳（Excel 1シート）", "csv": "台帳（CSV）"}
+
+def _bulk_export_panel(company_id: str):
+    with st.expander("一括出力（ZIP・台帳）"):
+        st.caption("期間・作業場所で絞り込み、該当するKYをまとめて出力します（作成日基準）。"
+                   "台帳は1件1行・チェック項目ごとに1列の一覧表で、件数の上限はありません。")
+        fmt = st.radio("出力形式", options=list(BULK_FORMATS), format_func=BULK_FORMATS.get,
+                       horizontal=True, key="bulk_format")
+        c1, c2 = st.columns(2)
+        with c1:
+            date_from = st.date_input("開始日", value=date.today().replace(day=1), key="bulk_from")
+        with c2:
+            date_to = st.date_input("終了日", value=date.today(), key="bulk_to")
+        location = st.text_input("作業場所（部分一致・任意）", key="bulk_location").strip() or None
+        if st.button("作成", key="bulk_build"):
+            n = _count_export_records(company_id, date_from, date_to, location)
+            if n == 0:
+                st.info("該当するKYがありません。")
+                return
+            # the ledger streams rows, so only the per-record ZIP is capped
+            if fmt == "zip" and n > BULK_EXPORT_UI_MAX:
+                st.error(f"該当が{n}件あります。ZIPは画面から{BULK_EXPORT_UI_MAX}件まで出力できます。期間を絞るか、台帳形式を選ぶか、管理者にCLIでの出力を依頼してください。")
+                return
+            params = {"date_from": date_from.isoformat() if date_from else None,
+                      "date_to": date_to.isoformat() if date_to else None,
+                      "location": location}
+            try:
+                if fmt == "zip":
+                    _enqueue_export(company_id, "bulk", params)
+                else:
+                    _enqueue_export(company_id, "ledger", {**params, "format": fmt})
+            except ExportQueueFull:
+                st.error(f"出力待ちが{EXPORT_QUEUE_PER_COMPANY}件あります。完了してから再度お試しください。")
+                return
+            st.success(f"{n}件の{BULK_FORMATS[fmt]}作成を受け付けました。下の「最近の出力」からダウンロードできます。")
+
+EXPORT_STATUS = {"queued": "待機中", "running": "作成中", "done": "完了", "failed": "失敗"}
+EXPORT_KINDS = {"single": "Excel", "bulk": "一括ZIP", "ledger": "台帳"}
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_MIMES = {".zip": "application/zip", ".xlsx": XLSX_MIME, ".csv": "text/csv"}
+
+def _export_jobs_view(company_id: str):
+    st.markdown("#### 最近の出力")
+    jobs = _recent_export_jobs(company_id)
+    if not jobs:
+        st.caption("まだ出力はありません。")
+        return
+    # Only the unfinished jobs poll (every 2s, until they are done); the
+    # finished ones are listed once and read from disk only when asked for.
+    if any(j["status"] in ("queued", "running") for j in jobs):
+        st.fragment(_export_jobs_pending, run_every=2)(company_id)
+    for j in jobs:
+        if j["status"] in ("done", "failed"):
+            _export_job_row(j)
+
+def _export_jobs_pending(company_id: str):
+    jobs = [j for j in _recent_export_jobs(company_id) if j["status"] in ("queued", "running")]
+    if not jobs:
+        st.rerun()  # full rerun lists them as finished and drops the polling
+    for j in jobs:
+        _export_job_row(j)
+
+def _export_job_row(j: dict):
+    created = j["created_at"][:16].replace("T", " ")
+    what = EXPORT_KINDS.get(j["kind"], j["kind"])
+    c1, c2 = st.columns([4, 1])
+    with c1:
+        status = EXPORT_STATUS.get(j["status"], j["status"])
+        if j["status"] == "running" and j["total"]:
+            status += f"（{j['progress']}/{j['total']}件）"
+        elif j["status"] == "queued" and j["attempts"]:
+            status += f"（再試行 {j['attempts']}回目）"
+        st.write(f"{created}｜{what}｜{status}")
+        if j["status"] == "failed" and j["error"]:
+            st.caption(f"エラー: {j['error']}")
+    with c2:
+        if j["status"] != "done":
+            return
+        # a ledger can be tens of MB: load only the file the user picked
+        data = _export_job_data(j) if st.session_state.get("job_dl") == j["id"] else None
+        if data is not None:
+            st.download_button("DL", data=data, file_name=j["result_name"], key=f"job_{j['id']}",
+                               mime=EXPORT_MIMES.get(os.path.splitext(j["result_name"])[1], XLSX_MIME))
+        elif st.button("準備", key=f"job_prep_{j['id']}", help="ダウンロードを準備します"):
+            st.session_state["job_dl"] = j["id"]
+            _rerun_fragment()
+
+STATS_KINDS = {"hazards": "想定される危険ポイント", "avoid": "危険回避のポイント", "finish": "作業終了確認"}
+
+def _stats_view(company_id: str):
+    st.subheader("集計（月別）")
+    st.caption("チェック項目ごとのKY件数を月別に表示します（作成日基準・保存期間内の記録）。")
+    c1, c2, c3 = st.columns([2,1,2])
+    with c1:
+        kind = st.radio("項目", options=list(STATS_KINDS), format_func=STATS_KINDS.get, key="stats_kind")
+    with c2:
+        months = st.selectbox("期間", options=[6, 12, 24, 36], format_func=lambda m: f"直近{m}か月", key="stats_months")
+    with c3:
+        locations = _rollup_locations(company_id)
+        location = st.selectbox("作業場所", options=[None] + locations,
+                                format_func=lambda x: "（全体）" if x is None else (x or "（未入力）"), key="stats_location")
+
+    month_to = date.today().strftime("%Y-%m")
+    month_from = (date.today() - relativedelta(months=months - 1)).strftime("%Y-%m")
+    totals = {r["month"]: r["n"] for r in _item_trend(company_id, "records", month_from, month_to, location)}
+    if not totals:
+        st.info("この期間の記録はありません。")
+        return
 
-def _record_form(default: dict | None, company_id: str):
+    table = {m: {"月": m, "KY件数": n} for m, n in sorted(totals.items())}
+    labels = []
+    for r in _item_trend(company_id, kind, month_from, month_to, location):
+        if r["label"] not in labels:
+            labels.append(r["label"])
+        table.setdefault(r["month"], {"月": r["month"], "KY件数": 0})[r["label"]] = r["n"]
+    rows = [{**{lbl: 0 for lbl in labels}, **row} for _, row in sorted(table.items())]
+    if labels:
+        st.bar_chart(rows, x="月", y=labels, stack=True)
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+
+HISTORY_PAGE_SIZE = 30
+
+def _history_list(company_id: str):
+    text = st.text_input("検索（件名・作業場所・作業内容・入力者・連絡事項）", key="hist_q", placeholder="例）本館 受変電")
+    c1, c2 = st.columns(2)
+    with c1:
+        date_from = st.date_input("作成日（から）", value=None, key="hist_from")
+    with c2:
+        date_to = st.date_input("作成日（まで）", value=None, key="hist_to")
+
+    # A page is identified by the (created_at, id) cursor it starts after;
+    # the stack lets 「前へ」 go back. A new filter starts from page 1.
+    filt = (text.strip(), date_from, date_to)
+    if st.session_state.get("hist_filter") != filt:
+        st.session_state["hist_filter"] = filt
+        st.session_state["hist_cursors"] = [None]
+    cursors = st.session_state["hist_cursors"]
+
+    records, next_cursor = _search_records(company_id, text, date_from, date_to,
+                                           after=cursors[-1], limit=HISTORY_PAGE_SIZE)
+    if not records:
+        st.info("該当する履歴がありません。" if any(filt) else "まだ履歴がありません。")
+    for r in records:
+        title = r.get("work_title") or "(無題)"
+        created = r["created_at"][:19].replace("T"," ")
+        label = f"{created}｜{title}｜{r.get('location','')}"
+        col_pick, col_dl = st.columns([5, 1])
+        with col_pick:
+            if st.button(label, key=f"pick_{r['id']}"):
+                st.session_state["editing_id"] = r["id"]
+                st.session_state["view_next"] = "form"
+                st.rerun()
+        with col_dl:
+            # rendered only for the row asked for: a page of download buttons
+            # would send every row's .xlsx to the browser on each rerun
+            xbytes = None
+            if st.session_state.get("hist_xlsx") == r["id"]:
+                xbytes = _record_xlsx(company_id, r["id"], r["updated_at"])
+            if xbytes:
+                st.download_button("DL", data=xbytes, file_name=ky_export.member_name(r), key=f"dl_{r['id']}",
+                                   mime=XLSX_MIME)
+            elif st.button("Excel", key=f"xlsx_{r['id']}"):
+                st.session_state["hist_xlsx"] = r["id"]
+                _rerun_fragment()
+
+    nav1, nav2, nav3 = st.columns([1,2,1])
+    with nav1:
+        if len(cursors) > 1 and st.button("← 前へ", key="hist_prev"):
+            cursors.pop()
+            _rerun_fragment()
+    with nav2:
+        st.caption(f"{len(cursors)}ページ目")
+    with nav3:
+        if next_cursor and st.button("次へ →", key="hist_next"):
+            cursors.append(next_cursor)
+            _rerun_fragment()
+
+def _archive_list(company_id: str):
+    # Searching the archive decompresses files, so it only runs when asked.
+    st.divider()
+    if not st.toggle("保存期間を過ぎた記録（アーカイブ）も検索する", key="arc_on"):
+        return
+    filt = st.session_state.get("hist_filter", ("", None, None))
+    if st.session_state.get("arc_filter") != filt:
+        st.session_state["arc_filter"] = filt
+        st.session_state["arc_cursors"] = [None]
+    cursors = st.session_state["arc_cursors"]
+
+    with st.spinner("アーカイブを検索しています…"):
+        records, next_cursor = _search_archive(company_id, *filt, after=cursors[-1], limit=HISTORY_PAGE_SIZE)
+    if not records:
+        st.info("該当するアーカイブはありません。")
+    st.caption("アーカイブの記録は閲覧専用です。Excelは押したときに作成します。")
+    for r in records:
+        title = r.get("work_title") or "(無題)"
+        created = r["created_at"][:19].replace("T"," ")
+        c1, c2 = st.columns([5, 1])
+        with c1:
+            st.write(f"{created}｜{title}｜{r.get('location','')}")
+        with c2:
+            if st.session_state.get("arc_xlsx") == r["id"]:
+                st.download_button("DL", data=_record_xlsx(company_id, r["id"], r["updated_at"], r),
+                                   file_name=ky_export.member_name(r), key=f"arc_dl_{r['id']}", mime=XLSX_MIME)
+            elif st.button("Excel", key=f"arc_{r['id']}"):
+                st.session_state["arc_xlsx"] = r["id"]
+                _rerun_fragment()
+
+    nav1, nav2, nav3 = st.columns([1,2,1])
+    with nav1:
+        if len(cursors) > 1 and st.button("← 前へ", key="arc_prev"):
+            cursors.pop()
+            _rerun_fragment()
+    with nav2:
+        st.caption(f"アーカイブ {len(cursors)}ページ目")
+    with nav3:
+        if next_cursor and st.button("次へ →", key="arc_next"):
+            cursors.append(next_cursor)
+            _rerun_fragment()
+
+# selectbox size; larger companies get a prefix filter in front of it
+CANDIDATE_SHOW = 50
+# form fields besides 入力者名; widget keys are "ky_<field>"
+DRAFT_FIELDS = tuple(f for f in ky_import.TEXT_FIELDS if f != "inputter_name") + ky_import.LIST_FIELDS
+
+def _seed_draft(record: dict | None, source: str | None):
+    """Make ``record`` (None: a blank sheet) the form's draft.
+
+    The draft lives in session state, so the form is filled from memory on
+    every rerun and the DB is only read when another record is opened.
+    Widget state is dropped while the form is not shown; it is put back
+    from the draft when the form is rendered again.
+    """
+    record = record or {}
+    st.session_state["draft"] = {"inputter_name": record.get("inputter_name", ""),
+                                 **{f: record.get(f, [] if f in ky_import.LIST_FIELDS else "") for f in DRAFT_FIELDS}}
+    st.session_state["draft_of"] = source
+    for key in [k for k in st.session_state if str(k).startswith("ky_")]:
+        del st.session_state[key]
+
+def _restore_draft_widgets(candidates: list):
+    draft = st.session_state["draft"]
+    name = draft["inputter_name"]
+    st.session_state.setdefault("ky_inputter_pick", name if name in candidates else "")
+    st.session_state.setdefault("ky_inputter_custom", "" if name in candidates else name)
+    for f in DRAFT_FIELDS:
+        st.session_state.setdefault(f"ky_{f}", draft[f])
+
+def _draft_from_widgets() -> dict:
+    ss = st.session_state
+    draft = {"inputter_name": (ss["ky_inputter_custom"].strip() or ss["ky_inputter_pick"] or "").strip()}
+    for f in DRAFT_FIELDS:
+        draft[f] = ss[f"ky_{f}"]
+    ss["draft"] = draft
+    return draft
+
+def _record_form(company_id: str) -> str | None:
+    """Render the entry form; returns the submit button pressed, if any.
+
+    Inside st.form nothing is sent to the server until a button is pressed,
+    so typing costs no reruns at all.
+    """
     candidates = _list_candidates(company_id)
+    if len(candidates) > CANDIDATE_SHOW:
+        # outside the form so that it filters as you type (candidates are cached in memory)
+        prefix = st.text_input("入力者名を絞り込み（先頭一致）", key="inputter_prefix", placeholder="例）井月")
+        candidates = _search_candidates(company_id, prefix, limit=CANDIDATE_SHOW)
+    _restore_draft_widgets(candidates)
+    # Saving re-ranks the candidates; new options make a new widget, which
+    # would start blank. Re-assigning the key carries the pick over.
+    st.session_state["ky_inputter_pick"] = st.session_state["ky_inputter_pick"]
+    options = [""] + candidates
+    if st.session_state["ky_inputter_pick"] not in options:
+        options.insert(1, st.session_state["ky_inputter_pick"])
 
     st.subheader("KY入力（保存→Excel出力）")
-    st.caption("※入力者名は必須です（会社共通ID運用のため）。")
+    st.caption("※入力者名は必須です（会社共通ID運用のため）。入力内容は下のボタンを押したときに送信されます。")
 
-    inputter = st.selectbox("入力者名（必須）", options=([""] + candidates + ["（手入力）"]), index=0)
-    inputter_custom = ""
-    if inputter == "（手入力）":
-        inputter_custom = st.text_input("入力者名を入力", value=(default.get("inputter_name","") if default else ""))
-        inputter_name = inputter_custom.strip()
+    with st.form("ky_form", enter_to_submit=False):
+        st.selectbox("入力者名（必須）", options=options, key="ky_inputter_pick")
+        st.text_input("入力者名（候補にない場合はこちらに入力）", key="ky_inputter_custom")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.text_input("作業件名", key="ky_work_title")
+            st.text_input("作業会社名", key="ky_work_company")
+            st.text_input("電話番号", key="ky_phone")
+            st.text_input("作業予定日（例：2026/02/19）", key="ky_work_date")
+        with col2:
+            st.text_input("開始（例：01:00）", key="ky_start_time")
+            st.text_input("終了（例：07:00）", key="ky_end_time")
+            st.text_input("作業場所", key="ky_location")
+            st.text_input("作業人数", key="ky_people_count")
+
+        st.text_area("作業内容（改行OK）", height=120, key="ky_work_content")
+
+        st.markdown("### 想定される危険ポイント")
+        st.multiselect("該当するものにチェック", options=_mask_items("hazards", -1), key="ky_hazards")
+        st.text_input("その他（危険ポイント）", key="ky_hazards_other", placeholder="例：挟まれ、切創 など")
+
+        st.markdown("### 危険回避のポイント")
+        st.multiselect("該当するものにチェック", options=_mask_items("avoid", -1), key="ky_avoid")
+        st.text_input("その他（危険回避）", key="ky_avoid_other", placeholder="例：立入禁止・誘導員配置 など")
+
+        st.text_area("施設管理担当者からの重点指示事項（必要なら）", height=80, key="ky_focus_instructions")
+
+        st.markdown("### 作業終了確認")
+        st.multiselect("該当するものにチェック", options=_mask_items("finish", -1), key="ky_finish")
+        st.text_input("その他（終了確認）", key="ky_finish_other")
+
+        st.text_area("連絡事項（任意）", height=80, key="ky_notes")
+
+        b1, b2, b3 = st.columns(3)
+        with b1:
+            save = st.form_submit_button("保存")
+        with b2:
+            export = st.form_submit_button("保存してExcel出力")
+        with b3:
+            keep = st.form_submit_button("下書きを保持")
+    if save:
+        return "save"
+    if export:
+        return "export"
+    if keep:
+        return "keep"
+    return None
+
+@st.fragment
+def _editor_view(company_id: str):
+    edit_id = st.session_state.get("editing_id")
+    if st.session_state.get("draft_of", "") != edit_id or "draft" not in st.session_state:
+        record = _load_record(company_id, edit_id) if edit_id else None
+        if edit_id and not record:
+            st.warning("選択した履歴が見つかりませんでした。")
+            st.session_state.pop("editing_id", None)
+            edit_id = None
+        _seed_draft(record, edit_id)
+
+    flash = st.session_state.pop("editor_flash", None)
+    if flash:
+        st.success(flash)
+
+    if edit_id:
+        st.subheader("編集 / 再出力")
+        cols = st.columns([1,1,2])
+        with cols[0]:
+            if st.button("新規作成に戻る"):
+                st.session_state.pop("editing_id", None)
+                _rerun_fragment()
+        with cols[1]:
+            if st.button("この内容を複製して新規"):
+                # the draft already holds the contents; it just stops being this record
+                st.session_state.pop("editing_id", None)
+                st.session_state["draft_of"] = None
+                st.session_state["editor_flash"] = "複製元の内容を読み込みました。必要箇所だけ修正して保存してください。"
+                _rerun_fragment()
+
+    action = _record_form(company_id)
+    if action is None:
+        return
+    draft = _draft_from_widgets()
+    if action == "keep":
+        st.success("下書きを保持しました（ログアウトするまで有効）。")
+        return
+    if not draft["inputter_name"]:
+        st.error("入力者名が未入力です。")
+        return
+    payload = {"company_id": company_id, **draft}
+    # a custom name is added to the candidates for next time, in the same commit
+    try:
+        saved = _save_record(payload, record_id=edit_id)
+    except WriteQueueFull:
+        st.error("保存が混み合っています。入力内容はそのまま残っていますので、数秒後にもう一度保存してください。")
+        return
+    except WriteStillRunning:
+        st.warning("保存処理に時間がかかっており、まだ完了していません。二重登録を避けるため、"
+                   "しばらくしてから「自社履歴」で保存されたか確認し、無ければもう一度保存してください。")
+        return
+    if saved is None:
+        st.error("保存できませんでした。記録が削除された可能性があります。")
+        return
+    st.session_state["editing_id"] = st.session_state["draft_of"] = saved["id"]
+    if action == "save":
+        st.session_state["editor_flash"] = "保存しました。"
+        _rerun_fragment()
+
+    try:
+        job_id = _enqueue_export(company_id, "single", {"record_id": saved["id"], "updated_at": saved["updated_at"]})
+    except ExportQueueFull:
+        st.warning("保存しました。出力待ちが多いため、Excelは履歴からダウンロードしてください。")
+        return
+    job = _wait_export_job(company_id, job_id, timeout=3.0)
+    xbytes = _export_job_data(job) if job and job["status"] == "done" else None
+    if xbytes is not None:
+        filename = f"KY_{company_id}_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+        st.download_button("Excelをダウンロード", data=xbytes, file_name=filename, mime=XLSX_MIME)
+        st.success("保存＆Excel生成しました（上のボタンからDL）。")
+    elif job and job["status"] == "failed":
+        st.error(f"保存しましたが、Excel生成に失敗しました：{job['error']}")
     else:
-        inputter_name = inputter.strip() if inputter else (default.get("inputter_name","").strip() if default else "")
-
-    col1, col2 = st.columns(2)
-    with col1:
-        work_title = st.text_input("作業件名", value=(default.get("work_title","") if default else ""))
-        work_company = st.text_input("作業会社名", value=(default.get("work_company","") if default else ""))
-        phone = st.text_input("電話番号", value=(default.get("phone","") if default else ""))
-        work_date = st.text_input("作業予定日（例：2026/02/19）", value=(default.get("work_date","") if default else ""))
-    with col2:
-        start_time = st.text_input("開始（例：01:00）", value=(default.get("start_time","") if default else ""))
-        end_time = st.text_input("終了（例：07:00）", value=(default.get("end_time","") if default else ""))
-        location = st.text_input("作業場所", value=(default.get("location","") if default else ""))
-        people_count = st.text_input("作業人数", value=(default.get("people_count","") if default else ""))
-
-    work_content = st.text_area("作業内容（改行OK）", height=120, value=(default.get("work_content","") if default else ""))
-
-    st.markdown("### 想定される危険ポイント")
-    hazards = st.multiselect("該当するものにチェック", options=[
-        "感電・漏電事故","火災","停電事故","漏電事故","墜落・落下事故","酸欠事故","騒音、振動、異臭、埃等のクレーム"
-    ], default=(default.get("hazards",[]) if default else []))
-    hazards_other = st.text_input("その他（危険ポイント）", value=(default.get("hazards_other","") if default else ""), placeholder="例：挟まれ、切創 など")
-
-    st.markdown("### 危険回避のポイント")
-    avoid = st.multiselect("該当するものにチェック", options=[
-        "活線作業の禁止","不良工具の使用禁止","保護具使用","ヘルメット着用","安全帯着用","安全柵取付","消火器設置","作業時間帯調整"
-    ], default=(default.get("avoid",[]) if default else []))
-    avoid_other = st.text_input("その他（危険回避）", value=(default.get("avoid_other","") if default else ""), placeholder="例：立入禁止・誘導員配置 など")
-
-    focus_instructions = st.text_area("施設管理担当者からの重点指示事項（必要なら）", height=80, value=(default.get("focus_instructions","") if default else ""))
-
-    st.markdown("### 作業終了確認")
-    finish = st.multiselect("該当するものにチェック", options=[
-        "電源・スイッチ・バルブ等の復旧","火気・危険物作業実施後の安全確認","不要品の搬出及び清掃","借用品の返却","部屋の施錠"
-    ], default=(default.get("finish",[]) if default else []))
-    finish_other = st.text_input("その他（終了確認）", value=(default.get("finish_other","") if default else ""))
-
-    notes = st.text_area("連絡事項（任意）", height=80, value=(default.get("notes","") if default else ""))
-
-    payload = {
-        "company_id": company_id,
-        "inputter_name": inputter_name,
-        "work_title": work_title,
-        "work_company": work_company,
-        "phone": phone,
-        "work_date": work_date,
-        "start_time": start_time,
-        "end_time": end_time,
-        "location": location,
-        "people_count": people_count,
-        "work_content": work_content,
-        "hazards": hazards,
-        "hazards_other": hazards_other,
-        "avoid": avoid,
-        "avoid_other": avoid_other,
-        "focus_instructions": focus_instructions,
-        "finish": finish,
-        "finish_other": finish_other,
-        "notes": notes,
-    }
-
-    return payload
+        st.info("保存しました。Excelは作成中です。「自社履歴」の「最近の出力」からダウンロードできます。")
+
+@st.fragment
+def _history_view(company_id: str):
+    st.subheader("自社履歴")
+    st.caption("自社で作成したKYだけ表示されます。クリックで複製・再編集できます。")
+    _bulk_export_panel(company_id)
+    _export_jobs_view(company_id)
+    _history_list(company_id)
+    if RETENTION_MODE == "archive":
+        _archive_list(company_id)
+
+@st.fragment
+def _stats_tab(auth: dict):
+    stats_company = auth["company_id"]
+    if auth.get("is_admin") == 1:
+        stats_company = _company_select("会社", "stats_company", first=auth)
+    _stats_view(stats_company)
+
+VIEWS = {"form": "新規作成 / 編集", "history": "自社履歴（複製）", "stats": "集計", "admin": "管理者メニュー"}
 
 def main():
     st.set_page_config(page_title=APP_TITLE, layout="centered")
     st.title(APP_TITLE)
     st.caption("会社別ログイン／自社履歴閲覧可／保存3年／Excel書式固定出力")
 
-    _init_db()
-    _seed_if_needed()
-    _apply_retention()
+    _start_warm_up(DB_PATH)
+    if METRICS_FILE:
+        _start_metrics_exporter(METRICS_FILE)
 
     auth = st.session_state.get("auth")
+    if not auth and st.query_params.get("sid"):
+        _bootstrap(DB_PATH)
+        auth, token = _resume_session(st.query_params["sid"])
+        if auth:
+            st.session_state["auth"] = auth
+            st.query_params["sid"] = token
+        else:
+            del st.query_params["sid"]
     if not auth:
         _login_view()
         st.info("※会社ID/初期パスワードは管理者から共有されます。")
         return
+    _bootstrap(DB_PATH)
 
     # header
     c1, c2 = st.columns([4,1])
@@ -556,94 +3788,21 @@ def main():
     if auth.get("is_admin") == 1:
         st.success("管理者モードです（全社管理が可能）。")
 
-    # Tabs
-    tab1, tab2 = st.tabs(["新規作成 / 編集", "自社履歴（複製）"])
-
-    # Self records
-    with tab2:
-        st.subheader("自社履歴")
-        st.caption("自社で作成したKYだけ表示されます。クリックで複製・再編集できます。")
-        records = _load_records(auth["company_id"], limit=80)
-        if not records:
-            st.info("まだ履歴がありません。")
-        else:
-            # simple list
-            for r in records:
-                title = r.get("work_title") or "(無題)"
-                created = r["created_at"][:19].replace("T"," ")
-                label = f"{created}｜{title}｜{r.get('location','')}"
-                if st.button(label, key=f"pick_{r['id']}"):
-                    st.session_state["editing_id"] = r["id"]
-                    st.rerun()
-
-    # Create/edit
-    with tab1:
-        edit_id = st.session_state.get("editing_id")
-        default = None
-        if edit_id:
-            default = _load_record(auth["company_id"], edit_id)
-            if not default:
-                st.warning("選択した履歴が見つかりませんでした。")
-                st.session_state.pop("editing_id", None)
-                st.rerun()
-
-        if edit_id:
-            st.subheader("編集 / 再出力")
-            cols = st.columns([1,1,2])
-            with cols[0]:
-                if st.button("新規作成に戻る"):
-                    st.session_state.pop("editing_id", None)
-                    st.rerun()
-            with cols[1]:
-                if st.button("この内容を複製して新規"):
-                    st.session_state["clone_from"] = edit_id
-                    st.session_state.pop("editing_id", None)
-                    st.rerun()
-
-        clone_from = st.session_state.get("clone_from")
-        if clone_from and not edit_id:
-            base = _load_record(auth["company_id"], clone_from)
-            default = base
-            st.session_state.pop("clone_from", None)
-            st.info("複製元の内容を読み込みました。必要箇所だけ修正して保存してください。")
-
-        payload = _record_form(default, auth["company_id"])
-
-        # Validate inputter
-        if not payload["inputter_name"]:
-            st.warning("入力者名は必須です。")
-
-        btn_col1, btn_col2 = st.columns([1,1])
-        with btn_col1:
-            if st.button("保存"):
-                if not payload["inputter_name"]:
-                    st.error("入力者名が未入力です。")
-                else:
-                    # if custom input and not in candidates, add it for next time
-                    _add_candidate(auth["company_id"], payload["inputter_name"])
-                    saved_id = _save_record(payload, record_id=edit_id if edit_id else None)
-                    st.session_state["editing_id"] = saved_id
-                    st.success("保存しました。")
-                    st.rerun()
-
-        with btn_col2:
-            if st.button("保存してExcel出力"):
-                if not payload["inputter_name"]:
-                    st.error("入力者名が未入力です。")
-                else:
-                    _add_candidate(auth["company_id"], payload["inputter_name"])
-                    saved_id = _save_record(payload, record_id=edit_id if edit_id else None)
-                    rec = _load_record(auth["company_id"], saved_id)
-                    xbytes = _render_excel(rec)
-                    filename = f"KY_{auth['company_id']}_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-                    st.download_button("Excelをダウンロード", data=xbytes, file_name=filename,
-                                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                    st.session_state["editing_id"] = saved_id
-                    st.success("保存＆Excel生成しました（上のボタンからDL）。")
-
-    # Admin
-    if auth.get("is_admin") == 1:
+    # Only the open view runs; each is a fragment, so its own widgets rerun
+    # just that view. (st.tabs would run all of them on every rerun.)
+    views = [v for v in VIEWS if v != "admin" or auth.get("is_admin") == 1]
+    if "view_next" in st.session_state:
+        st.session_state["view"] = st.session_state.pop("view_next")
+    view = st.radio("表示", options=views, format_func=VIEWS.get, horizontal=True,
+                    label_visibility="collapsed", key="view")
+    if view == "history":
+        _history_view(auth["company_id"])
+    elif view == "stats":
+        _stats_tab(auth)
+    elif view == "admin":
         _admin_panel()
+    else:
+        _editor_view(auth["company_id"])
 
 if __name__ == "__main__":
     main()
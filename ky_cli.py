@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""Command line tools for the KY app.
+
+Run from the app directory with the same environment variables as the web
+app (KY_DB_PATH etc.), e.g.::
+
+    python ky_cli.py check-plans
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+import app
+import ky_export
+
+
+def _use_db(path: str | None):
+    if path:
+        app.DB_PATH = path
+    app._bootstrap(app.DB_PATH)
+
+
+def cmd_check_plans(args):
+    # Default: a throwaway DB built purely from MIGRATIONS, so the check
+    # guards the schema itself and can run in CI without data.
+    if args.db:
+        _use_db(args.db)
+    else:
+        _use_db(os.path.join(tempfile.mkdtemp(prefix="ky_plans_"), "plans.sqlite3"))
+    with app._db() as con:
+        problems = app._explain_hot_queries(con)
+    for name, detail in problems:
+        print(f"NG  {name}: {detail}")
+    if problems:
+        return 1
+    print(f"OK  {len(app.HOT_QUERIES)} hot queries use indexes")
+    return 0
+
+
+def _db_files():
+    # the central DB and every tenant file
+    paths = [app.DB_PATH]
+    if os.path.isdir(app._tenants_dir()):
+        paths += [os.path.join(app._tenants_dir(), n) for n in sorted(os.listdir(app._tenants_dir()))
+                  if n.endswith(".sqlite3")]
+    return paths
+
+
+def cmd_vacuum(args):
+    _use_db(args.db)
+    for path in _db_files():
+        t = time.perf_counter()
+        before = os.path.getsize(path)
+        con = app._connect(path)
+        try:
+            app._vacuum(con)
+        finally:
+            con.close()
+        print(f"vacuum: {path} {before / 1024 / 1024:.1f} MB -> {os.path.getsize(path) / 1024 / 1024:.1f} MB "
+              f"({time.perf_counter() - t:.1f}s)")
+    return 0
+
+
+def cmd_search_index(args):
+    _use_db(args.db)
+    broken = 0
+    for path in _db_files():
+        con = app._connect(path)
+        try:
+            if app._search_index_ok(con):
+                print(f"OK  {path}")
+                continue
+            if args.check:
+                print(f"NG  {path}: search index does not match the records")
+                broken += 1
+                continue
+            app._rebuild_search_index(con)
+            ok = app._search_index_ok(con)
+            print(f"{'OK ' if ok else 'NG '} {path}: rebuilt")
+            broken += not ok
+        finally:
+            con.close()
+    return 1 if broken else 0
+
+
+def cmd_retention(args):
+    _use_db(args.db)
+    n = app._run_retention_if_due() if args.if_due else app._apply_retention()
+    if n is None:
+        print("retention: not due yet")
+    else:
+        done = "archived" if app.RETENTION_MODE == "archive" else "deleted"
+        print(f"retention: {done} {n} records older than {app.RETENTION_YEARS} years")
+    return 0
+
+
+def cmd_backup(args):
+    _use_db(args.db)
+    if args.list:
+        for name in app._list_backups():
+            with open(os.path.join(app._backup_dir(), name, "manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+            files, parts = manifest["files"], manifest.get("archive_parts", {})
+            size = sum(f["gz_bytes"] for f in files.values()) + sum(p["bytes"] for p in parts.values())
+            print(f"{name}\t{len(files) + len(parts)} files\t{size / 1024 / 1024:.1f} MB")
+        return 0
+    t = time.perf_counter()
+    path = app._backup_now(pages=args.pages, pause=args.pause_ms / 1000, keep=args.keep)
+    print(f"backup: {path} ({time.perf_counter() - t:.1f}s, integrity_check ok)")
+    return 0
+
+
+def cmd_restore(args):
+    # no _use_db: the DB being replaced must not be opened (or migrated) first
+    db_path = args.db or app.DB_PATH
+    snapshot = args.snapshot
+    if not os.path.isdir(snapshot):
+        if args.db:
+            app.DB_PATH = args.db
+        snapshot = os.path.join(app._backup_dir(), snapshot)
+    if not args.yes:
+        print(f"restore: this replaces {db_path} (and its tenant files) with {snapshot}.\n"
+              "Stop the app first, then re-run with --yes.", file=sys.stderr)
+        return 2
+    try:
+        restored = app._restore_backup(snapshot, db_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"restore: {e}", file=sys.stderr)
+        return 1
+    for path in restored:
+        print(f"restore: {path}")
+    return 0
+
+
+def cmd_bulk_export(args):
+    _use_db(args.db)
+    records = app._iter_export_records(args.company, args.date_from, args.date_to, args.location)
+    if args.output == "-":
+        n = ky_export.write_zip(records, sys.stdout.buffer, app._render_excel_fast, workers=args.workers)
+    else:
+        with open(args.output, "wb") as f:
+            n = ky_export.write_zip(records, f, app._render_excel_fast, workers=args.workers)
+    print(f"bulk-export: {n} records -> {args.output}", file=sys.stderr)
+    return 0
+
+
+def cmd_ledger(args):
+    _use_db(args.db)
+    fmt = args.format or ("csv" if args.output.lower().endswith(".csv") else "xlsx")
+    write = ky_export.write_ledger_csv if fmt == "csv" else ky_export.write_ledger_xlsx
+    rows = app._ledger_rows(args.company, args.date_from, args.date_to, args.location)
+    if args.output == "-":
+        n = write(app._ledger_header(), rows, sys.stdout.buffer)
+    else:
+        with open(args.output, "wb") as f:
+            n = write(app._ledger_header(), rows, f)
+    print(f"ledger: {n} records -> {args.output}", file=sys.stderr)
+    return 0
+
+
+def _archived(args):
+    after = None
+    while True:
+        rows, after = app._search_archive(args.company, args.q, args.date_from, args.date_to, after=after, limit=500)
+        yield from rows
+        if after is None:
+            return
+
+
+def cmd_archive_search(args):
+    _use_db(args.db)
+    if args.output:
+        with open(args.output, "wb") as f:
+            n = ky_export.write_zip(_archived(args), f, app._render_excel_fast, workers=0)
+        print(f"archive-search: {n} records -> {args.output}", file=sys.stderr)
+        return 0
+    n = 0
+    for r in _archived(args):
+        print("\t".join((r["created_at"][:19], r["id"], r.get("work_title") or "", r.get("location") or "")))
+        n += 1
+    print(f"archive-search: {n} records", file=sys.stderr)
+    return 0
+
+
+def cmd_import(args):
+    _use_db(args.db)
+    rows = (row for path in args.files for row in app._import_rows(path))
+    t0 = time.perf_counter()
+    try:
+        report = app._import_records(args.company, rows, dry_run=args.dry_run)
+    except ValueError as e:
+        print(f"import: {e}", file=sys.stderr)
+        return 2
+    for source, message in report["errors"]:
+        print(f"NG  {source}: {message}", file=sys.stderr)
+    verb = "would insert" if args.dry_run else "inserted"
+    print(f"import: read {report['read']}, {verb} {report['inserted']}, duplicates {report['duplicates']}, "
+          f"errors {len(report['errors'])} ({time.perf_counter() - t0:.1f}s)")
+    return 1 if report["errors"] else 0
+
+
+def cmd_shard_split(args):
+    _use_db(args.db)
+
+    def report(company_id, copied, removed):
+        print(f"{company_id}: copied {copied}" + (f", removed {removed} from central" if args.finish else ""))
+    try:
+        app._shard_split(finish=args.finish, batch_size=args.batch, pause=args.pause, progress=report)
+    except RuntimeError as e:
+        print(f"shard-split: {e}", file=sys.stderr)
+        return 1
+    if args.finish:
+        print("shard-split: done; start the app with KY_SHARDING=1")
+    else:
+        print("shard-split: copied; re-run to catch up, then --finish at cutover")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ky_cli", description="安全指示KY 管理用コマンド")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("check-plans", help="EXPLAIN QUERY PLAN every hot query; fail on full scans")
+    p.add_argument("--db", help="check this DB instead of a fresh schema-only one")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser("vacuum", help="rewrite the DB files so freed space is returned to the disk (stop the app first)")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.set_defaults(func=cmd_vacuum)
+
+    p = sub.add_parser("search-index", help="check the 自社履歴 search index against the records and rebuild it if needed")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--check", action="store_true", help="only check (exit 1 when out of sync)")
+    p.set_defaults(func=cmd_search_index)
+
+    p = sub.add_parser("retention", help="delete expired records now (batched) and reclaim space")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--if-due", action="store_true", help="skip when the last run is within KY_RETENTION_INTERVAL_HOURS")
+    p.set_defaults(func=cmd_retention)
+
+    p = sub.add_parser("backup", help="take an online, compressed snapshot of the DB (safe while the app runs)")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--list", action="store_true", help="list the snapshots instead")
+    p.add_argument("--pages", type=int, default=app.BACKUP_PAGES, help="pages copied per step")
+    p.add_argument("--pause-ms", type=float, default=app.BACKUP_PAUSE_MS, help="sleep between steps")
+    p.add_argument("--keep", type=int, default=app.BACKUP_KEEP, help="snapshots to keep")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("restore", help="replace the DB with a snapshot (stop the app first)")
+    p.add_argument("snapshot", help="snapshot name from backup --list, or its directory")
+    p.add_argument("--db", help="DB path to restore to (default: KY_DB_PATH)")
+    p.add_argument("--yes", action="store_true", help="really replace the current DB")
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser("bulk-export", help="export a company's KY records as a ZIP of .xlsx files")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--company", required=True, help="company_id")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="created on/after (YYYY-MM-DD)")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="created on/before (YYYY-MM-DD)")
+    p.add_argument("--location", help="substring of 作業場所")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render processes (0 = in-process)")
+    p.add_argument("-o", "--output", required=True, help="output .zip path, or - for stdout")
+    p.set_defaults(func=cmd_bulk_export)
+
+    p = sub.add_parser("ledger", help="export a company's KY records as one table (.xlsx or CSV), a row per record")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--company", required=True, help="company_id")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="created on/after (YYYY-MM-DD)")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="created on/before (YYYY-MM-DD)")
+    p.add_argument("--location", help="substring of 作業場所")
+    p.add_argument("--format", choices=("xlsx", "csv"), help="default: from the -o extension, else xlsx")
+    p.add_argument("-o", "--output", required=True, help="output .xlsx / .csv path, or - for stdout")
+    p.set_defaults(func=cmd_ledger)
+
+    p = sub.add_parser("archive-search", help="search a company's archived records (KY_RETENTION_MODE=archive)")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--company", required=True, help="company_id")
+    p.add_argument("-q", default="", help="words that must all appear (件名・作業場所・作業内容・入力者・連絡事項)")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="created on/after (YYYY-MM-DD)")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="created on/before (YYYY-MM-DD)")
+    p.add_argument("-o", "--output", help="write the matches as a ZIP of .xlsx instead of listing them")
+    p.set_defaults(func=cmd_archive_search)
+
+    p = sub.add_parser("import", help="import KY records from CSV, JSONL, .xlsx or a ZIP of .xlsx in one transaction")
+    p.add_argument("--db", help="DB path (default: KY_DB_PATH)")
+    p.add_argument("--company", required=True, help="company_id to import into")
+    p.add_argument("--dry-run", action="store_true", help="validate and count, then roll back")
+    p.add_argument("files", nargs="+", help=".csv / .jsonl / .xlsx / .zip files")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("shard-split", help="move each company's records into its own tenant file (online, repeatable)")
+    p.add_argument("--db", help="central DB path (default: KY_DB_PATH)")
+    p.add_argument("--finish", action="store_true",
+                   help="cutover, with the app stopped: copy the rest, verify, delete moved rows from the central DB")
+    p.add_argument("--batch", type=int, default=app.RETENTION_BATCH, help="rows per transaction")
+    p.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    p.set_defaults(func=cmd_shard_split)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Bulk export of KY records: a ZIP of per-record .xlsx files, or a ledger.
+
+Records are rendered with the given function (app._render_excel_fast),
+either inline or across a spawn-based process pool shared by all jobs.
+Only a small window of rendered files is in flight at any time and each
+one goes straight into the ZIP stream, so memory use does not grow with
+the number of records.
+
+The ledger is one table of all records (one row each, one column per
+check item), written row by row as .xlsx (openpyxl write-only mode) or CSV.
+"""
+import csv
+import importlib
+import io
+import multiprocessing
+import re
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# rendered files kept in flight per worker
+WINDOW_PER_WORKER = 4
+
+# one pool per worker count, shared by every job: spawning workers (each
+# imports app and openpyxl) costs more than rendering a small export
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            ctx = multiprocessing.get_context("spawn")  # forking a threaded server is unsafe
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return pool
+
+
+def _drop_pool(workers: int, pool: ProcessPoolExecutor):
+    # a worker died; the next job starts a fresh pool
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_ref(render) -> tuple:
+    # Workers import ``render`` by name. Under Streamlit the app script runs
+    # as __main__, which a worker cannot import, so it is looked up in app.
+    module = render.__module__
+    return ("app" if module == "__main__" else module), render.__qualname__
+
+
+def _render_in_worker(ref: tuple, record: dict) -> bytes:
+    module, name = ref
+    return getattr(importlib.import_module(module), name)(record)
+
+
+def render_stream(records, render, workers: int = 0):
+    """Yield (record, xlsx bytes) in input order.
+
+    ``render`` is called in-process when ``workers`` is 0; otherwise in a
+    shared pool of ``workers`` spawned processes, so it must be a module-level
+    function.
+    """
+    if workers <= 0:
+        for rec in records:
+            yield rec, render(rec)
+        return
+
+    pool, ref = _pool(workers), _render_ref(render)
+    window = deque()
+    try:
+        for rec in records:
+            window.append((rec, pool.submit(_render_in_worker, ref, rec)))
+            if len(window) >= workers * WINDOW_PER_WORKER:
+                done, fut = window.popleft()
+                yield done, fut.result()
+        while window:
+            done, fut = window.popleft()
+            yield done, fut.result()
+    except BrokenProcessPool:
+        _drop_pool(workers, pool)
+        raise
+    finally:
+        # an abandoned stream leaves nothing queued in the shared pool
+        for _, fut in window:
+            fut.cancel()
+
+
+def _safe_name(text: str, limit: int = 40) -> str:
+    text = re.sub(r'[\\/:*?"<>|\r\n\t]+', "_", (text or "").strip())
+    return text[:limit] or "無題"
+
+
+def member_name(record: dict) -> str:
+    created = (record.get("created_at") or "")[:19].replace("-", "").replace(":", "").replace("T", "_")
+    return f"KY_{created}_{_safe_name(record.get('work_title'))}_{record['id'][:8]}.xlsx"
+
+
+def write_zip(records, fileobj, render, workers: int = 0, progress=None) -> int:
+    """Write one .xlsx per record into a ZIP on ``fileobj``; return the count.
+
+    ``fileobj`` may be unseekable (e.g. stdout). The .xlsx members are
+    already deflated, so they are stored without recompression.
+    """
+    n = 0
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED) as zf:
+        for rec, data in render_stream(records, render, workers):
+            zf.writestr(member_name(rec), data)
+            n += 1
+            if progress:
+                progress(n)
+    return n
+
+
+# Text that Excel would run as a formula when the CSV is opened
+_CSV_FORMULA_START = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(_CSV_FORMULA_START):
+        return "'" + value
+    return value
+
+
+def write_ledger_csv(header: list, rows, fileobj, progress=None) -> int:
+    """Write the ledger as CSV (UTF-8 with BOM, so Excel reads Japanese) to a
+    binary ``fileobj``; return the row count."""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        w = csv.writer(text)
+        w.writerow(header)
+        n = 0
+        for row in rows:
+            w.writerow([_csv_cell(v) for v in row])
+            n += 1
+            if progress:
+                progress(n)
+        text.flush()
+    finally:
+        text.detach()
+    return n
+
+
+def write_ledger_xlsx(header: list, rows, fileobj, progress=None, title: str = "KY台帳") -> int:
+    """Write the ledger as .xlsx to ``fileobj``; return the row count.
+
+    A write-only workbook streams each row out to a temporary file as it is
+    appended, so memory stays flat however many rows there are.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.freeze_panes = "A2"
+    ws.append(header)
+    n = 0
+    for row in rows:
+        cells = []
+        for v in row:
+            if isinstance(v, str):
+                v = ILLEGAL_CHARACTERS_RE.sub("", v)
+                if v.startswith("="):
+                    # keep it text: openpyxl stores strings starting with = as formulas
+                    v = WriteOnlyCell(ws, v)
+                    v.data_type = "s"
+            cells.append(v)
+        ws.append(cells)
+        n += 1
+        if progress:
+            progress(n)
+    wb.save(fileobj)
+    return n
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Readers for bulk import of KY records.
+
+Each reader yields ``(source, record)`` pairs, where ``record`` is a dict in
+the same shape as the entry form's payload (check items as label lists) and
+``source`` says where it came from ("file.csv:12", "file.zip/KY_x.xlsx"), for
+the error report. A record that cannot be read at all is yielded as a
+``ValueError`` in place of the dict, so one bad file does not stop the rest.
+
+Validation, de-duplication and the insert itself live in app._import_records.
+"""
+import csv
+import io
+import json
+import os
+import re
+import zipfile
+from datetime import date, timedelta
+from xml.etree.ElementTree import ParseError
+
+# Plain text fields of a record, as stored in ky_records.
+TEXT_FIELDS = (
+    "inputter_name", "work_title", "work_company", "phone", "work_date", "start_time", "end_time",
+    "location", "people_count", "work_content", "hazards_other", "avoid_other", "focus_instructions",
+    "finish_other", "notes",
+)
+LIST_FIELDS = ("hazards", "avoid", "finish")
+# Optional: kept when given, otherwise derived by the importer.
+META_FIELDS = ("id", "created_at", "updated_at", "company_id")
+
+# Check items in a CSV cell: "火災|停電事故"
+LIST_SEPARATOR = "|"
+
+_INPUTTER_RE = re.compile(r"\n?【入力者】(?P<name>[^\n]*)\s*$")
+_EXCEL_SERIAL_RE = re.compile(r"^\d{5}(\.\d+)?$")
+
+
+def _split_list(value) -> list:
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value or "").split(LIST_SEPARATOR) if v.strip()]
+
+
+def _normalize(raw: dict) -> dict:
+    rec = {}
+    for key in META_FIELDS + TEXT_FIELDS:
+        value = raw.get(key)
+        if value is not None:
+            rec[key] = str(value)
+    for key in LIST_FIELDS:
+        rec[key] = _split_list(raw.get(key))
+    return rec
+
+
+def read_csv(fileobj, name: str = "<csv>"):
+    """Text file with a header row of field names (see TEXT_FIELDS); check
+    items joined by "|"."""
+    for lineno, row in enumerate(csv.DictReader(fileobj), start=2):
+        yield f"{name}:{lineno}", _normalize({k: v for k, v in row.items() if k})
+
+
+def read_jsonl(fileobj, name: str = "<jsonl>"):
+    """One JSON object per line; check items as arrays (or "|"-joined strings)."""
+    for lineno, line in enumerate(fileobj, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8-sig")
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+            if not isinstance(raw, dict):
+                raise ValueError("JSONオブジェクトではありません")
+        except ValueError as e:
+            yield f"{name}:{lineno}", ValueError(f"JSONを読めません: {e}")
+            continue
+        yield f"{name}:{lineno}", _normalize(raw)
+
+
+def read_xlsx(data: bytes, cells: dict, catalogs: dict, read_cells) -> dict:
+    """Reverse-map one filled 安全指示ＫＹ記録書 back into a record.
+
+    ``cells`` is app.CELL and ``catalogs`` app.CHECK_CATALOGS (label -> cell
+    per kind); ``read_cells(data, refs)`` returns the text of those cells.
+    A check item is selected when its cell text starts with ✓; the その他
+    text is taken from inside its （…）.
+    """
+    wanted = set(cells.values()) | {c for items in catalogs.values() for c in items.values()}
+    values = read_cells(data, wanted)
+
+    rec = {key: values.get(ref, "").strip() for key, ref in cells.items()
+           if key not in ("work_content_1", "work_content_2")}
+    # a date typed into Excel by hand is stored as a day serial number
+    if _EXCEL_SERIAL_RE.match(rec.get("work_date", "")):
+        rec["work_date"] = (date(1899, 12, 30) + timedelta(days=int(float(rec["work_date"])))).strftime("%Y/%m/%d")
+    rec["work_content"] = "\n".join(
+        v for v in (values.get(cells["work_content_1"], ""), values.get(cells["work_content_2"], "")) if v.strip()
+    )
+    # the renderer appends 【入力者】name to the focus instructions
+    focus = rec.get("focus_instructions", "")
+    m = _INPUTTER_RE.search(focus)
+    if m:
+        rec["inputter_name"] = m.group("name").strip()
+        rec["focus_instructions"] = focus[:m.start()].strip()
+    for kind, items in catalogs.items():
+        rec[kind] = []
+        rec[f"{kind}_other"] = ""
+        for label, ref in items.items():
+            text = values.get(ref, "")
+            if not text.startswith("✓"):
+                continue
+            if label.startswith("その他"):
+                m = re.search(r"（(.*?)）", text, re.S)
+                rec[f"{kind}_other"] = m.group(1).strip() if m else ""
+            else:
+                rec[kind].append(label)
+    return rec
+
+
+def read_path(path: str, name: str | None, cells: dict, catalogs: dict, read_cells):
+    """Yield records from a .csv, .jsonl, .xlsx or a .zip of .xlsx files
+    (such as a bulk export). ``path`` may also be a binary file object."""
+    name = name or os.path.basename(str(path))
+    ext = os.path.splitext(name)[1].lower()
+    opened = open(path, "rb") if isinstance(path, (str, os.PathLike)) else None
+    f = opened or path
+    try:
+        if ext == ".csv":
+            yield from read_csv(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""), name)
+        elif ext in (".jsonl", ".ndjson"):
+            yield from read_jsonl(f, name)
+        elif ext == ".xlsx":
+            yield from _xlsx_one(f.read(), name, cells, catalogs, read_cells)
+        elif ext == ".zip":
+            with zipfile.ZipFile(f) as z:
+                for info in z.infolist():
+                    if info.filename.lower().endswith(".xlsx"):
+                        yield from _xlsx_one(z.read(info), f"{name}/{info.filename}", cells, catalogs, read_cells)
+        else:
+            yield name, ValueError(f"未対応の形式です: {ext or '(拡張子なし)'}")
+    finally:
+        if opened:
+            opened.close()
+
+
+def _xlsx_one(data: bytes, source: str, cells: dict, catalogs: dict, read_cells):
+    try:
+        yield source, read_xlsx(data, cells, catalogs, read_cells)
+    except (ValueError, KeyError, ParseError, zipfile.BadZipFile) as e:
+        yield source, ValueError(f"Excelを読めません: {e}")
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app reads its settings at import: never the real DB, always the repo's
+# seed and template
+os.environ["KY_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ky_test_"), "ky.sqlite3")
+os.environ["KY_SEED_PATH"] = os.path.join(ROOT, "seed.json")
+os.environ["KY_TEMPLATE_PATH"] = os.path.join(ROOT, "安全指示ＫＹ記録書.xlsx")
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Intents committed together by the group writer stay isolated."""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def _names(path):
+    con = sqlite3.connect(path)
+    try:
+        return sorted(r[0] for r in con.execute("SELECT name FROM t"))
+    finally:
+        con.close()
+
+
+def test_failed_intent_rolls_back_alone(tmp_path):
+    path = str(tmp_path / "w.sqlite3")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE t (name TEXT)")
+    con.close()
+    # a long group window, so the three intents below share one transaction
+    writer = app._GroupWriter(max_queue=16, group_ms=500, group_max=16, sync="NORMAL", timeout=10)
+
+    def bad(con):
+        con.execute("INSERT INTO t VALUES ('bad')")
+        raise ValueError("boom")
+
+    def good(name):
+        def fn(con):
+            con.execute("INSERT INTO t VALUES (?)", (name,))
+            return name
+        return fn
+
+    results = {}
+
+    def call(name, fn):
+        try:
+            results[name] = writer.submit(path, fn, wait=1)
+        except Exception as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=call, args=(name, fn))
+               for name, fn in (("before", good("before")), ("bad", bad), ("after", good("after")))]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    for t in threads:
+        t.join(10)
+
+    assert writer.groups == 1
+    assert writer.intents == 3
+    assert isinstance(results["bad"], ValueError)
+    assert results["before"] == "before" and results["after"] == "after"
+    assert _names(path) == ["after", "before"]
+
+
+def test_failed_intent_does_not_leak_into_next_group(tmp_path):
+    path = str(tmp_path / "w.sqlite3")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE t (name TEXT)")
+    con.close()
+    writer = app._GroupWriter(max_queue=16, group_ms=0, group_max=16, sync="NORMAL", timeout=10)
+
+    def bad(con):
+        con.execute("INSERT INTO t VALUES ('bad')")
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        writer.submit(path, bad, wait=1)
+    writer.submit(path, lambda con: con.execute("INSERT INTO t VALUES ('next')"), wait=1)
+    assert _names(path) == ["next"]
+
+
+def test_slow_commit_raises_still_running(tmp_path):
+    path = str(tmp_path / "w.sqlite3")
+    writer = app._GroupWriter(max_queue=16, group_ms=0, group_max=16, sync="NORMAL", timeout=0.2)
+    gate = threading.Event()
+    with pytest.raises(app.WriteStillRunning):
+        writer.submit(path, lambda con: gate.wait(5), wait=1)
+    gate.set()
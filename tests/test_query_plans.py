@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""Every hot query is served by an index (same check as `ky_cli.py check-plans`)."""
+import app
+
+
+def test_hot_queries_use_indexes(tmp_path, monkeypatch):
+    path = str(tmp_path / "plans.sqlite3")
+    monkeypatch.setattr(app, "DB_PATH", path)
+    app._bootstrap(path)
+    with app._db() as con:
+        assert app._explain_hot_queries(con) == []
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""The XML fast path fills the same cells as the openpyxl renderer."""
+import pytest
+
+import app
+from tools.bench_render import SAMPLES, _cells
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning:openpyxl")
+@pytest.mark.parametrize("record", SAMPLES, ids=range(len(SAMPLES)))
+def test_fast_render_matches_openpyxl(record):
+    assert _cells(app._render_excel_fast(record)) == _cells(app._render_excel(record))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Headless microbenchmarks for the data layer and Excel rendering.
+
+    python tools/bench.py --companies 6 --records 500000 --db /tmp/ky_bench.sqlite3
+    python tools/bench.py --save-baseline tools/bench_baseline.json
+    python tools/bench.py --baseline tools/bench_baseline.json --threshold 1.3
+
+The synthetic DB is built once per (companies, records) and reused on later
+runs. Each operation reports p50/p95/p99 latency and throughput. With
+--baseline, the run fails (exit 1) if an operation's p95 is more than
+``threshold`` times the baseline p95.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+PASSWORD = "bench-password"
+LOCATIONS = ["本館B1 電気室", "本館3F 機械室", "別館 屋上", "東棟 受変電設備", "西棟 ポンプ室", "駐車場"]
+TITLES = ["受変電設備点検", "空調機更新工事", "非常用発電機点検", "照明器具交換", "消防設備点検", "配管修繕"]
+NAMES = ["井月 大輔", "阿手 貴皓", "角田 一晃", "小森 一宏", "前田 克之", "津村 龍一"]
+
+
+def _company_ids(n: int):
+    return [f"bench-{i:02d}" for i in range(1, n + 1)]
+
+
+def _payload(company_id: str, rnd: random.Random) -> dict:
+    return {
+        "company_id": company_id,
+        "inputter_name": rnd.choice(NAMES),
+        "work_title": rnd.choice(TITLES),
+        "work_company": "ベンチ工業",
+        "phone": "03-0000-0000",
+        "work_date": "2026/02/19",
+        "start_time": "01:00",
+        "end_time": "07:00",
+        "location": rnd.choice(LOCATIONS),
+        "people_count": str(rnd.randint(1, 8)),
+        "work_content": "点検作業\n清掃",
+        "hazards": rnd.sample(app._mask_items("hazards", -1), 2),
+        "hazards_other": "",
+        "avoid": rnd.sample(app._mask_items("avoid", -1), 3),
+        "avoid_other": "",
+        "focus_instructions": "",
+        "finish": rnd.sample(app._mask_items("finish", -1), 2),
+        "finish_other": "",
+        "notes": "",
+    }
+
+
+def _insert_rows(con, company_ids, count: int, start: datetime, step: timedelta, rnd: random.Random):
+    rows = []
+    for i in range(count):
+        p = _payload(rnd.choice(company_ids), rnd)
+        ts = (start + step * i).isoformat()
+        rows.append((
+            app._new_id(), p["company_id"], ts, ts, p["inputter_name"], p["work_title"], p["work_company"],
+            p["phone"], p["work_date"], p["start_time"], p["end_time"], p["location"], p["people_count"],
+            p["work_content"], app._items_mask("hazards", p["hazards"]), "", app._items_mask("avoid", p["avoid"]), "",
+            "", app._items_mask("finish", p["finish"]), "", "",
+        ))
+        if len(rows) == 5000:
+            _flush(con, rows)
+    _flush(con, rows)
+
+
+def _flush(con, rows):
+    con.executemany("""
+    INSERT INTO ky_records(
+      id, company_id, created_at, updated_at, inputter_name,
+      work_title, work_company, phone, work_date, start_time, end_time, location, people_count, work_content,
+      hazards_mask, hazards_other, avoid_mask, avoid_other, focus_instructions, finish_mask, finish_other, notes
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", rows)
+    rows.clear()
+
+
+def build_db(path: str, companies: int, records: int, seed: int = 1):
+    """Create (or reuse) a synthetic DB at the requested scale."""
+    app.DB_PATH = path
+    app.SEED_PATH = os.path.join(os.path.dirname(path) or ".", "no-seed.json")  # no real companies in the bench DB
+    app._bootstrap(path)
+    scale = f"{companies}x{records}"
+    with app._db() as con:
+        row = con.execute("SELECT value FROM app_meta WHERE key='bench_scale'").fetchone()
+        if row and row["value"] == scale:
+            return
+        if row or con.execute("SELECT COUNT(*) FROM ky_records").fetchone()[0]:
+            sys.exit(f"{path} holds a different dataset; remove it or use another --db")
+
+    print(f"building {path}: {companies} companies x {records} records …", file=sys.stderr)
+    rnd = random.Random(seed)
+    ids = _company_ids(companies)
+    pw_hash = app._hash_password(PASSWORD)
+    now = datetime.utcnow()
+    t0 = time.perf_counter()
+    with app._db() as con, con:
+        con.executemany(
+            "INSERT INTO companies(company_id, company_name, password_hash, is_admin, is_enabled, created_at) VALUES (?,?,?,?,?,?)",
+            [(cid, f"ベンチ会社{cid[-2:]}", pw_hash, 0, 1, now.isoformat()) for cid in ids])
+        con.executemany("INSERT INTO name_candidates(company_id, name) VALUES (?,?)",
+                        [(cid, nm) for cid in ids for nm in NAMES])
+        # spread over the retention window, newest last
+        span = timedelta(days=365 * app.RETENTION_YEARS - 1)
+        _insert_rows(con, ids, records, now - span, span / max(records, 1), rnd)
+        con.execute("INSERT INTO app_meta(key, value) VALUES ('bench_scale', ?)", (scale,))
+    with app._db() as con:
+        con.execute("ANALYZE")
+    print(f"built in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def measure(fn, iterations: int, setup=None) -> dict:
+    samples = []
+    for i in range(iterations):
+        arg = setup(i) if setup else None
+        t0 = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    total = sum(samples)
+    return {
+        "n": iterations,
+        "p50_ms": _percentile(samples, 0.50) * 1000,
+        "p95_ms": _percentile(samples, 0.95) * 1000,
+        "p99_ms": _percentile(samples, 0.99) * 1000,
+        "ops_per_s": iterations / total if total else 0.0,
+    }
+
+
+def measure_concurrent(fn, iterations: int, threads: int) -> dict:
+    """``iterations`` calls spread over ``threads`` threads started together;
+    ops/s is calls over wall time, so it shows contention, not just latency."""
+    samples, lock = [], threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker(count):
+        mine = []
+        start.wait()
+        for _ in range(count):
+            t0 = time.perf_counter()
+            fn(None)
+            mine.append(time.perf_counter() - t0)
+        with lock:
+            samples.extend(mine)
+
+    pool = [threading.Thread(target=worker, args=(iterations // threads + (i < iterations % threads),))
+            for i in range(threads)]
+    for t in pool:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - t0
+    samples.sort()
+    return {
+        "n": iterations,
+        "p50_ms": _percentile(samples, 0.50) * 1000,
+        "p95_ms": _percentile(samples, 0.95) * 1000,
+        "p99_ms": _percentile(samples, 0.99) * 1000,
+        "ops_per_s": iterations / wall if wall else 0.0,
+    }
+
+
+def run(args) -> dict:
+    build_db(args.db, args.companies, args.records)
+    rnd = random.Random(2)
+    ids = _company_ids(args.companies)
+    with app._db() as con:
+        sample_ids = [(r["company_id"], r["id"]) for r in
+                      con.execute("SELECT company_id, id FROM ky_records ORDER BY random() LIMIT 1000")]
+    record = app._load_record(*sample_ids[0])
+    n = args.iterations
+
+    def expire_rows(_):
+        # untimed: add rows just past the retention cutoff for the next run to delete
+        old = datetime.utcnow() - timedelta(days=365 * app.RETENTION_YEARS + 30)
+        with app._db() as con, con:
+            _insert_rows(con, ids, args.retention_rows, old, timedelta(seconds=1), rnd)
+
+    benches = {
+        "save_record": (lambda _: app._save_record(_payload(rnd.choice(ids), rnd)), n, None),
+        "update_record": (lambda a: app._save_record(_payload(a[0], rnd), record_id=a[1]), n,
+                          lambda i: sample_ids[i % len(sample_ids)]),
+        # the first 自社履歴 page, as the app lists it
+        "history_page": (lambda cid: app._search_records(cid, limit=30), n, lambda i: ids[i % len(ids)]),
+        "search_records": (lambda cid: app._search_records(cid, "受変電", limit=30), n, lambda i: ids[i % len(ids)]),
+        # the DB read behind _load_record, bypassing the record cache so it
+        # stays comparable with baselines taken before the cache existed
+        "load_record": (lambda a: app._read_record(*a), n, lambda i: sample_ids[i % len(sample_ids)]),
+        # what the editor calls: a cache hit once the record was read
+        "load_record_cached": (lambda a: app._load_record(*a), n, lambda i: sample_ids[i % len(sample_ids)]),
+        "apply_retention": (lambda _: app._apply_retention(pause=0), max(3, n // 20), expire_rows),
+        "verify_login": (lambda cid: app._verify_login(cid, PASSWORD), max(3, n // 20), lambda i: ids[i % len(ids)]),
+        "render_excel": (lambda _: app._render_excel(record), max(3, n // 20), None),
+        "render_excel_fast": (lambda _: app._render_excel_fast(record), n, None),
+    }
+    # many sessions saving at once (shift start): exercises the group-commit writer
+    bursts = {
+        "save_burst": (lambda _: app._save_record(_payload(rnd.choice(ids), rnd)), n * 4),
+    }
+    selected = args.only.split(",") if args.only else list(benches) + list(bursts)
+    results = {}
+    for name in selected:
+        if name in bursts:
+            fn, iterations = bursts[name]
+            writer = app._group_writer(app.DB_PATH) if app.WRITE_QUEUE_MAX > 0 else None
+            before = (writer.groups, writer.intents) if writer else None
+            results[name] = measure_concurrent(fn, iterations, args.writers)
+            if writer and writer.groups > before[0]:
+                results[name]["mean_group"] = (writer.intents - before[1]) / (writer.groups - before[0])
+        else:
+            fn, iterations, setup = benches[name]
+            fn(setup(0) if setup else None)  # warm caches and statement cache
+            results[name] = measure(fn, iterations, setup)
+        r = results[name]
+        print(f"{name:<18} n={r['n']:<5} p50={r['p50_ms']:9.3f}ms p95={r['p95_ms']:9.3f}ms "
+              f"p99={r['p99_ms']:9.3f}ms {r['ops_per_s']:10.1f} ops/s"
+              + (f"  {r['mean_group']:.1f} saves/commit" if "mean_group" in r else ""))
+    return {
+        "meta": {
+            "companies": args.companies, "records": args.records, "iterations": n, "writers": args.writers,
+            "python": platform.python_version(), "sqlite": app.sqlite3.sqlite_version,
+            "machine": platform.machine(), "at": datetime.utcnow().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, r in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base and base["p95_ms"] > 0 and r["p95_ms"] > base["p95_ms"] * threshold:
+            regressions.append(f"{name}: p95 {r['p95_ms']:.3f}ms vs baseline {base['p95_ms']:.3f}ms "
+                               f"(x{r['p95_ms'] / base['p95_ms']:.2f} > x{threshold})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KY data-layer / Excel microbenchmarks")
+    parser.add_argument("--db", default=os.path.join(os.environ.get("TMPDIR", "/tmp"), "ky_bench.sqlite3"))
+    parser.add_argument("--companies", type=int, default=6)
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--retention-rows", type=int, default=2000, help="expired rows per retention run")
+    parser.add_argument("--writers", type=int, default=16, help="threads saving at once in save_burst")
+    parser.add_argument("--only", help="comma-separated subset of benchmarks")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the report as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare p95 against this baseline")
+    parser.add_argument("--threshold", type=float, default=1.3, help="allowed p95 ratio vs baseline")
+    args = parser.parse_args(argv)
+
+    # openpyxl warns on every load that the template's shapes are dropped
+    warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+    report = run(args)
+    for path in filter(None, (args.json, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            return 1
+        print(f"no regressions beyond x{args.threshold}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
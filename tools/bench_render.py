@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Compare the openpyxl renderer with the XML fast path.
+
+    python tools/bench_render.py [-n 50]
+
+Checks that both produce the same value in every cell of every sheet for a
+set of sample records, then prints per-export timings and the speedup.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from openpyxl import load_workbook  # noqa: E402
+
+SAMPLES = [
+    {},
+    {
+        "inputter_name": "井月 大輔", "work_title": "受変電設備点検", "work_company": "庄野電気工事",
+        "phone": "03-0000-0000", "work_date": "2026/02/19", "start_time": "01:00", "end_time": "07:00",
+        "location": "本館B1 電気室", "people_count": "4", "work_content": "高圧受電盤の点検\n絶縁抵抗測定\n清掃",
+        "hazards": ["感電・漏電事故", "停電事故"], "hazards_other": "挟まれ",
+        "avoid": ["活線作業の禁止", "保護具使用", "ヘルメット着用"], "avoid_other": "",
+        "focus_instructions": "停電範囲を事前に周知すること", "finish": ["部屋の施錠"], "finish_other": "鍵返却",
+        "notes": "特記事項 <なし> & \"引用\"",
+    },
+    {
+        "inputter_name": "前田 克之", "work_content": "1行のみ", "hazards": list(app.HAZARD_ITEMS),
+        "avoid": list(app.AVOID_ITEMS), "finish": list(app.FINISH_ITEMS), "avoid_other": "誘導員配置",
+    },
+]
+
+
+def _cells(xbytes: bytes) -> dict:
+    wb = load_workbook(io.BytesIO(xbytes))
+    out = {}
+    for ws in wb.worksheets:
+        for row in ws.iter_rows():
+            for c in row:
+                if c.value not in (None, ""):
+                    out[(ws.title, c.coordinate)] = c.value
+    return out
+
+
+def _timed(fn, record, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(record)
+    return (time.perf_counter() - t0) / n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=50, help="renders per renderer")
+    args = parser.parse_args(argv)
+    # openpyxl warns on every load that the template's shapes are dropped
+    warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+
+    for i, rec in enumerate(SAMPLES):
+        ref, fast = _cells(app._render_excel(rec)), _cells(app._render_excel_fast(rec))
+        if ref != fast:
+            diff = sorted(k for k in ref.keys() | fast.keys() if ref.get(k) != fast.get(k))
+            print(f"sample {i}: MISMATCH in {diff[:10]}")
+            return 1
+    print(f"{len(SAMPLES)} samples: cell values identical")
+
+    rec = SAMPLES[1]
+    app._render_excel_fast(rec)  # warm the template cache
+    slow = _timed(app._render_excel, rec, args.n)
+    fast = _timed(app._render_excel_fast, rec, args.n)
+    print(f"openpyxl : {slow * 1000:8.2f} ms/export")
+    print(f"fast path: {fast * 1000:8.2f} ms/export  ({slow / fast:.0f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
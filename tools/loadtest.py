@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""Load test: concurrent sessions driving app.py headlessly through AppTest.
+
+    python tools/loadtest.py --sessions 1,4,8,16 --duration 30
+    python tools/loadtest.py --sessions 1,4,8,16 --save-baseline load_baseline.json
+    python tools/loadtest.py --sessions 1,4,8,16 --baseline load_baseline.json --threshold 1.3
+
+For each concurrency level, that many sessions log in (spread over the
+synthetic companies of tools/bench.py's DB) and loop through what a crew
+does: open 自社履歴, pick a record, edit and 保存, then 保存してExcel出力.
+A step's latency is the wall time of the script run(s) its click triggers,
+i.e. what the user waits for on the server. All sessions share this
+process, as they share the Streamlit server: caches, connection pools, the
+group writer and the export workers are the app's own.
+
+Lock waits come from the app's metrics (written via KY_METRICS_FILE):
+``pool_wait`` a session waited for a DB connection, ``write_wait`` a save
+queued at the group writer, ``write_lock_wait`` the writer waited for
+SQLite's write lock. Errors are script exceptions, unexpected st.error
+messages and timeouts. The level where flows/s stops growing is reported
+as the saturation point.
+
+AppTest is built for one test at a time, so three process-wide pieces are
+shared here as the real server shares them; see _share_apptest_globals.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app  # noqa: E402
+import bench  # noqa: E402
+from streamlit import logger as streamlit_logger  # noqa: E402
+
+STEPS = ("login", "history", "open_record", "save", "save_export")
+LOCK_OPS = ("pool_wait", "write_wait", "write_lock_wait")
+_METRIC_RE = re.compile(r'^ky_op_duration_seconds_(count|sum)\{op="([^"]+)"\} (\S+)$', re.M)
+
+
+def _share_apptest_globals():
+    """Let AppTest sessions run side by side in one process.
+
+    - Each run installs a mock Runtime and removes it when done, which
+      pulls it from under any run still in flight; fall back to one
+      shared mock instead.
+    - Each run compiles app.py afresh, and CPython 3.11's compiler is not
+      thread-safe; the server compiles once for all sessions, so use one
+      ScriptCache here too.
+    - Each run toggles the global.appTest option; set it once for good.
+    - A click that ends in st.rerun() runs the script twice within one
+      AppTest run, and AppTest keeps the elements of the interrupted run
+      that the browser would drop (e.g. 自社履歴's inputs after picking a
+      record); start every script run with an empty message queue.
+    """
+    from unittest.mock import MagicMock
+
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner import ScriptRunnerEvent
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: cls._instance or shared)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    script_cache = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, path: get_bytecode(script_cache, path)
+
+    config.set_option("global.appTest", True)
+
+    init = LocalScriptRunner.__init__
+
+    def init_fresh_runs(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+
+        def on_event(sender, event, **_):
+            if event == ScriptRunnerEvent.SCRIPT_STARTED:
+                self.forward_msg_queue.clear()
+        self._fresh_runs = on_event  # Signal holds weak references
+        self.on_event.connect(on_event)
+    LocalScriptRunner.__init__ = init_fresh_runs
+
+
+class _Session:
+    """One browser tab: an AppTest plus the step timings it produced."""
+
+    def __init__(self, company_id: str, timeout: float, record):
+        from streamlit.testing.v1 import AppTest
+        self.company_id = company_id
+        self.at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+        self.record = record  # (step, seconds) / (outcome) callback
+        self.rnd = random.Random(company_id)
+
+    def _run(self, step: str, click):
+        t0 = time.perf_counter()
+        click()
+        self.at.run()
+        self.record(step, time.perf_counter() - t0)
+        if self.at.exception:
+            raise RuntimeError(f"{step}: {self.at.exception[0].value}")
+
+    def _buttons(self) -> dict:
+        return {b.label: b for b in self.at.button}
+
+    def login(self):
+        self.at.run()
+        self.at.text_input[0].input(self.company_id)
+        self.at.text_input[1].input(bench.PASSWORD)
+        self._run("login", self.at.button[0].click)
+        if "auth" not in self.at.session_state:
+            raise RuntimeError("login: " + (" / ".join(e.value for e in self.at.error) or "not logged in"))
+
+    def flow(self, n: int, think: float, outcome):
+        self._run("history", lambda: self.at.radio(key="view").set_value("history"))
+        time.sleep(think)
+        picks = [b for b in self.at.button if (b.key or "").startswith("pick_")]
+        if not picks:
+            raise RuntimeError("history: no records to pick")
+        self._run("open_record", self.rnd.choice(picks).click)
+        time.sleep(think)
+        self.at.text_input(key="ky_work_title").input(f"負荷試験 {self.company_id} #{n}")
+        self._run("save", self._buttons()["保存"].click)
+        errors = [e.value for e in self.at.error]
+        if errors:
+            raise RuntimeError("save: " + errors[0])
+        time.sleep(think)
+        self._run("save_export", self._buttons()["保存してExcel出力"].click)
+        errors = [e.value for e in self.at.error]
+        if errors:
+            raise RuntimeError("save_export: " + errors[0])
+        if self.at.get("download_button"):
+            outcome("export_ready")
+        elif self.at.warning:
+            outcome("export_queue_full")
+        else:
+            outcome("export_pending")
+
+
+def _read_metrics(path: str) -> dict:
+    # op -> [count, total seconds]
+    out = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return out
+    for kind, op, value in _METRIC_RE.findall(text):
+        out.setdefault(op, [0, 0.0])[0 if kind == "count" else 1] = float(value)
+    return out
+
+
+def _summary(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": bench._percentile(samples, 0.50) * 1000,
+        "p95_ms": bench._percentile(samples, 0.95) * 1000,
+        "p99_ms": bench._percentile(samples, 0.99) * 1000,
+        "max_ms": (samples[-1] if samples else 0.0) * 1000,
+    }
+
+
+def run_level(sessions: int, companies: list, args) -> dict:
+    lock = threading.Lock()
+    samples = {s: [] for s in STEPS}
+    errors, outcomes = Counter(), Counter()
+    flows = [0]
+    stop = time.perf_counter() + args.duration
+
+    def record(step, seconds):
+        with lock:
+            samples[step].append(seconds)
+
+    def outcome(name):
+        with lock:
+            outcomes[name] += 1
+
+    def user(i):
+        s = _Session(companies[i % len(companies)], args.timeout, record)
+        try:
+            s.login()
+        except Exception as e:
+            with lock:
+                errors[_error_key(e)] += 1
+            return
+        n = 0
+        while time.perf_counter() < stop:
+            n += 1
+            try:
+                s.flow(n, args.think, outcome)
+            except Exception as e:
+                with lock:
+                    errors[_error_key(e)] += 1
+                # start the next flow from a clean page, as a user would reload
+                s = _Session(s.company_id, args.timeout, record)
+                try:
+                    s.login()
+                except Exception as e2:
+                    with lock:
+                        errors[_error_key(e2)] += 1
+                    return
+                continue
+            with lock:
+                flows[0] += 1
+
+    before = _read_metrics(args.metrics_file)
+    threads = [threading.Thread(target=user, args=(i,), name=f"load-{i}") for i in range(sessions)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+        time.sleep(args.ramp / max(sessions, 1))
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    time.sleep(args.metrics_interval * 2.5)  # let the exporter write the level's last numbers
+    after = _read_metrics(args.metrics_file)
+
+    locks = {}
+    for op in LOCK_OPS:
+        count = after.get(op, [0, 0.0])[0] - before.get(op, [0, 0.0])[0]
+        total = after.get(op, [0, 0.0])[1] - before.get(op, [0, 0.0])[1]
+        locks[op] = {"count": int(count), "mean_ms": total / count * 1000 if count else 0.0}
+    return {
+        "sessions": sessions,
+        "wall_s": wall,
+        "flows": flows[0],
+        "flows_per_s": flows[0] / wall if wall else 0.0,
+        "steps": {s: _summary(v) for s, v in samples.items()},
+        "locks": locks,
+        "errors": dict(errors),
+        "outcomes": dict(outcomes),
+    }
+
+
+def _error_key(e: Exception) -> str:
+    # group "save: 保存が混み合っています…" etc. without record-specific detail
+    return re.sub(r"[0-9a-f]{24}", "<id>", str(e) or type(e).__name__)[:120]
+
+
+def _print_level(r: dict):
+    print(f"\n== {r['sessions']} sessions: {r['flows']} flows in {r['wall_s']:.1f}s "
+          f"({r['flows_per_s']:.2f} flows/s), {sum(r['errors'].values())} errors")
+    print(f"{'step':<12}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for step, s in r["steps"].items():
+        if s["n"]:
+            print(f"{step:<12}{s['n']:>6}{s['p50_ms']:>8.0f}ms{s['p95_ms']:>8.0f}ms"
+                  f"{s['p99_ms']:>8.0f}ms{s['max_ms']:>8.0f}ms")
+    print("lock waits: " + "  ".join(f"{op} {v['count']} (mean {v['mean_ms']:.1f}ms)"
+                                     for op, v in r["locks"].items()))
+    if r["outcomes"]:
+        print("exports: " + "  ".join(f"{k} {v}" for k, v in sorted(r["outcomes"].items())))
+    for msg, n in sorted(r["errors"].items(), key=lambda kv: -kv[1]):
+        print(f"  ERROR x{n}: {msg}")
+
+
+def _saturation(levels: list) -> int | None:
+    # the last level whose throughput still grew by 10% over the previous one
+    best = None
+    for prev, cur in zip(levels, levels[1:]):
+        if cur["flows_per_s"] < prev["flows_per_s"] * 1.1:
+            return prev["sessions"]
+        best = cur["sessions"]
+    return best
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    base_levels = {lv["sessions"]: lv for lv in baseline.get("levels", [])}
+    for lv in report["levels"]:
+        base = base_levels.get(lv["sessions"])
+        if not base:
+            continue
+        for step, s in lv["steps"].items():
+            b = base["steps"].get(step)
+            if b and b["p95_ms"] > 0 and s["p95_ms"] > b["p95_ms"] * threshold:
+                regressions.append(f"{lv['sessions']} sessions {step}: p95 {s['p95_ms']:.0f}ms vs baseline "
+                                   f"{b['p95_ms']:.0f}ms (x{s['p95_ms'] / b['p95_ms']:.2f} > x{threshold})")
+        if sum(lv["errors"].values()) > sum(base["errors"].values()):
+            regressions.append(f"{lv['sessions']} sessions: {sum(lv['errors'].values())} errors "
+                               f"vs baseline {sum(base['errors'].values())}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KY concurrent-session load test (AppTest)")
+    parser.add_argument("--db", default=os.path.join(os.environ.get("TMPDIR", "/tmp"), "ky_load.sqlite3"))
+    parser.add_argument("--companies", type=int, default=6)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--sessions", default="1,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of flows per level")
+    parser.add_argument("--think", type=float, default=0.2, help="seconds between a user's clicks")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which a level's sessions start")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds before a script run counts as hung")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the report as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare p95 and errors against this baseline")
+    parser.add_argument("--threshold", type=float, default=1.3, help="allowed p95 ratio vs baseline")
+    args = parser.parse_args(argv)
+
+    bench.build_db(args.db, args.companies, args.records)
+    args.metrics_file = args.db + ".metrics.prom"
+    args.metrics_interval = 0.5
+    if os.path.exists(args.metrics_file):
+        os.remove(args.metrics_file)  # counters start at zero in this process
+    # read by app.py on every script run
+    os.environ.update(KY_DB_PATH=args.db, KY_SEED_PATH=app.SEED_PATH,
+                      KY_TEMPLATE_PATH=os.path.join(ROOT, app.TEMPLATE_PATH),
+                      KY_METRICS_FILE=args.metrics_file, KY_METRICS_INTERVAL_SEC=str(args.metrics_interval))
+    _share_apptest_globals()
+    streamlit_logger.set_log_level(logging.ERROR)  # "missing ScriptRunContext" on every session_state peek
+
+    companies = bench._company_ids(args.companies)
+    levels = []
+    for n in (int(x) for x in args.sessions.split(",")):
+        levels.append(run_level(n, companies, args))
+        _print_level(levels[-1])
+
+    print(f"\n{'sessions':>8}{'flows/s':>10}{'save p95':>11}{'export p95':>12}{'errors':>8}")
+    for lv in levels:
+        print(f"{lv['sessions']:>8}{lv['flows_per_s']:>10.2f}{lv['steps']['save']['p95_ms']:>9.0f}ms"
+              f"{lv['steps']['save_export']['p95_ms']:>10.0f}ms{sum(lv['errors'].values()):>8}")
+    sat = _saturation(levels)
+    if sat is not None and len(levels) > 1:
+        print(f"saturation: throughput stops growing beyond ~{sat} sessions")
+
+    report = {
+        "meta": {
+            "companies": args.companies, "records": args.records, "duration_s": args.duration,
+            "think_s": args.think, "python": bench.platform.python_version(),
+            "sqlite": app.sqlite3.sqlite_version, "cpus": os.cpu_count(),
+            "at": datetime.utcnow().isoformat(timespec="seconds"),
+        },
+        "levels": levels,
+        "saturation_sessions": sat,
+    }
+    for path in filter(None, (args.json, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            return 1
+        print(f"no regressions beyond x{args.threshold}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
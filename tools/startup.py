@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Cold start: time from launching the server to the login form on screen.
+
+    python tools/startup.py --runs 5
+    python tools/startup.py --runs 5 --db /data/ky_app.sqlite3   # existing DB (persistent disk)
+    python tools/startup.py --runs 5 --budget 4.0                # exit 1 when slower
+
+Each run starts ``streamlit run app.py`` as the container does, waits for
+/_stcore/health, then opens a session over the same websocket a browser
+uses and times the first script run. Without --db every run gets a fresh
+DB, like a free instance whose /tmp was wiped, so seeding is included.
+
+Phases (seconds from launch): ``health`` server accepting requests,
+``first_element`` title sent, ``login_form`` the login inputs sent,
+``run_done`` first script run finished.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ("health", "first_element", "login_form", "run_done")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_healthy(port: int, proc, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"streamlit exited with {proc.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as r:
+                if r.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.02)
+    raise TimeoutError("server did not become healthy")
+
+
+async def _first_run(port: int, t0: float, timeout: float) -> dict:
+    ws = await websocket_connect(f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"])
+    back = BackMsg()
+    back.rerun_script.query_string = ""
+    back.rerun_script.page_script_hash = ""
+    await ws.write_message(back.SerializeToString(), binary=True)
+    marks = {}
+    deadline = time.perf_counter() + timeout
+    try:
+        while "run_done" not in marks:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"first run did not finish (got {sorted(marks)})")
+            data = await ws.read_message()
+            if data is None:
+                raise RuntimeError("websocket closed")
+            now = time.perf_counter() - t0
+            msg = ForwardMsg()
+            msg.ParseFromString(data)
+            kind = msg.WhichOneof("type")
+            if kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                marks.setdefault("first_element", now)
+                if msg.delta.new_element.WhichOneof("type") == "text_input":
+                    marks.setdefault("login_form", now)
+            elif kind == "script_finished":
+                marks["run_done"] = now
+    finally:
+        ws.close()
+    return marks
+
+
+def run_once(db_path: str, timeout: float) -> dict:
+    port = _free_port()
+    env = dict(os.environ, KY_DB_PATH=db_path,
+               KY_SEED_PATH=os.environ.get("KY_SEED_PATH", os.path.join(ROOT, "seed.json")),
+               KY_TEMPLATE_PATH=os.environ.get("KY_TEMPLATE_PATH", os.path.join(ROOT, "安全指示ＫＹ記録書.xlsx")))
+    cmd = [sys.executable, "-m", "streamlit", "run", "app.py", "--server.headless", "true",
+           "--server.port", str(port), "--server.address", "127.0.0.1"]
+    server_log = tempfile.TemporaryFile()
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        _wait_healthy(port, proc, timeout)
+        marks = {"health": time.perf_counter() - t0}
+        marks.update(IOLoop.current().run_sync(lambda: _first_run(port, t0, timeout)))
+        return marks
+    except Exception:
+        server_log.seek(0)
+        sys.stderr.write(server_log.read()[-4000:].decode("utf-8", "replace"))
+        raise
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--db", help="reuse this DB on every run (default: a fresh one per run)")
+    ap.add_argument("--timeout", type=float, default=60.0, help="seconds per phase before giving up")
+    ap.add_argument("--budget", type=float, help="fail (exit 1) when the median login_form exceeds this")
+    ap.add_argument("--json", help="also write the per-run results here")
+    args = ap.parse_args(argv)
+
+    results = []
+    for i in range(args.runs):
+        db = args.db or os.path.join(tempfile.mkdtemp(prefix="ky_startup_"), "ky_app.sqlite3")
+        marks = run_once(db, args.timeout)
+        results.append(marks)
+        print(f"run {i + 1}: " + "  ".join(f"{p} {marks[p]:.2f}s" for p in PHASES if p in marks))
+
+    print(f"\n{'phase':<14}{'median':>9}{'max':>9}")
+    for p in PHASES:
+        values = [m[p] for m in results if p in m]
+        if values:
+            print(f"{p:<14}{statistics.median(values):>8.2f}s{max(values):>8.2f}s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"db": "reused" if args.db else "fresh", "runs": results}, f, indent=2)
+    if args.budget is not None:
+        median = statistics.median(m.get("login_form", float("inf")) for m in results)
+        if median > args.budget:
+            print(f"\nFAIL login_form median {median:.2f}s > budget {args.budget:.2f}s")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())